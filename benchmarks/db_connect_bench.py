@@ -0,0 +1,176 @@
+"""
+db_connect Microbenchmarks
+
+Measures the cost of the db_connect persistence methods against a temporary
+persist.db for a range of condition history sizes and journal modes, and writes
+the results as JSON so runs from different commits can be compared.
+
+Usage:
+    python benchmarks/db_connect_bench.py --output bench.json
+    python benchmarks/db_connect_bench.py --sizes 5 1000 --journal-modes WAL
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classes.db_connect import db_connect
+
+
+def _percentile(samples: List[int], percent: float) -> float:
+    """Nearest-rank percentile of a sorted list of nanosecond samples, in milliseconds"""
+    index = min(len(samples) - 1, max(0, int(round(percent / 100 * len(samples))) - 1))
+    return samples[index] / 1e6
+
+
+def _measure(operation: Callable[[int], None], iterations: int) -> Dict[str, float]:
+    """
+    Time an operation and summarize its latency distribution
+
+    Args:
+        operation: Callable taking the iteration number
+        iterations: Number of timed calls
+
+    Returns:
+        Dictionary with ops/sec and p50/p99 latency in milliseconds
+    """
+    samples = []
+    started = time.perf_counter_ns()
+
+    for i in range(iterations):
+        before = time.perf_counter_ns()
+        operation(i)
+        samples.append(time.perf_counter_ns() - before)
+
+    elapsed = time.perf_counter_ns() - started
+    samples.sort()
+
+    return {
+        "iterations": iterations,
+        "ops_per_sec": iterations / (elapsed / 1e9),
+        "p50_ms": _percentile(samples, 50),
+        "p99_ms": _percentile(samples, 99)
+    }
+
+
+def _prefill_history(db, size: int) -> None:
+    """Fill conditionHistory with `size` rows and size the vote window to match"""
+    db.updateSetting(size, 'conditionHistoryLength')
+
+    now = int(time.time())
+    rows = [('Cloudy' if i % 3 else 'Clear', now - size + i) for i in range(size)]
+
+    with db._transaction() as cur:
+        cur.execute('DELETE FROM conditionHistory')
+        cur.executemany('INSERT INTO conditionHistory (condition, timestamp) VALUES (?, ?)', rows)
+
+    db._loadConditionWindow()
+
+
+def run_case(size: int, journal_mode: str, read_iterations: int, write_iterations: int,
+             write_behind: bool) -> Dict[str, Dict[str, float]]:
+    """
+    Benchmark every db_connect method for one history size and journal mode
+
+    Args:
+        size: Number of rows in the condition history window
+        journal_mode: SQLite journal mode (e.g. WAL or DELETE)
+        read_iterations: Timed calls for read-only methods
+        write_iterations: Timed calls for methods that write
+        write_behind: Whether to enable the db_connect write-behind queue
+
+    Returns:
+        Dictionary of method name to latency summary
+    """
+    workdir = tempfile.mkdtemp(prefix='db_connect_bench_')
+
+    try:
+        db = db_connect(dbPath=os.path.join(workdir, 'persist.db'), journalMode=journal_mode, writeBehind=write_behind)
+        _prefill_history(db, size)
+
+        conditions = ['Clear', 'Cloudy', 'Mostly Clear']
+        reading = {'solar': 25, 'altitude': 40.0, 'azimuth': 180.0, 'inArea': True}
+
+        results = {
+            'getSettings': _measure(lambda i: db.getSettings(), read_iterations),
+            'getSetting': _measure(lambda i: db.getSetting('solarThresh'), read_iterations),
+            'topConditionTypeFromHistory': _measure(lambda i: db.topConditionTypeFromHistory(), read_iterations),
+            'updateSetting': _measure(lambda i: db.updateSetting(float(i), 'lastAlt'), write_iterations),
+            'logCondition': _measure(lambda i: db.logCondition(conditions[i % 3], reading), write_iterations),
+            'applyStateUpdates': _measure(
+                lambda i: db.applyStateUpdates({'lastAlt': float(i), 'lastAzm': 180.0, 'lastInArea': True}, conditions[i % 3], reading),
+                write_iterations
+            )
+        }
+
+        db.flush()
+        db.disconnect()
+
+        return results
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _git_commit() -> str:
+    """Current commit hash, or 'unknown' outside a git checkout"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the db_connect persistence layer')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 100, 10000, 1000000],
+                        help='condition history sizes to benchmark')
+    parser.add_argument('--journal-modes', nargs='+', default=['WAL', 'DELETE'],
+                        help='SQLite journal modes to benchmark')
+    parser.add_argument('--read-iterations', type=int, default=10000)
+    parser.add_argument('--write-iterations', type=int, default=200)
+    parser.add_argument('--write-behind', action='store_true', help='enable the write-behind queue')
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args(argv)
+
+    report = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'write_behind': args.write_behind,
+        'cases': []
+    }
+
+    for journal_mode in args.journal_modes:
+        for size in args.sizes:
+            results = run_case(size, journal_mode, args.read_iterations, args.write_iterations, args.write_behind)
+            report['cases'].append({'journal_mode': journal_mode, 'history_size': size, 'methods': results})
+
+            for method, summary in results.items():
+                print('{mode:6} {size:>8} {method:30} {ops:>12.0f} ops/s  p50 {p50:8.3f} ms  p99 {p99:8.3f} ms'.format(
+                    mode=journal_mode, size=size, method=method, ops=summary['ops_per_sec'],
+                    p50=summary['p50_ms'], p99=summary['p99_ms']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,146 +1,940 @@
 import sqlite3
+import threading
+import atexit
+import time
+import queue
+import json
+from collections import deque, Counter
+from contextlib import contextmanager
+
+def _decodeInt(value):
+    if isinstance(value, bool):
+        raise ValueError('expected an integer but got {value!r}'.format(value=value))
+
+    if isinstance(value, int):
+        return value
+
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+
+    # '5' and '5.0' are both integers, '5.7' is rejected instead of truncated
+    number = float(value)
+    if not number.is_integer():
+        raise ValueError('expected an integer but got {value!r}'.format(value=value))
+
+    return int(number)
+
+def _decodeFloat(value):
+    return float(value)
+
+def _decodeBool(value):
+    if isinstance(value, bool):
+        return value
+
+    value = str(value).strip().lower()
+
+    if value in ('true', '1'):
+        return True
+    elif value in ('false', '0'):
+        return False
+
+    raise ValueError('expected true/false but got {value!r}'.format(value=value))
+
+def _encodeBool(value):
+    return 'true' if value else 'false'
+
+def _nullable(decoder):
+    # 'null' and empty strings are the sentinels the settings table has always used for "no value"
+    def decode(value):
+        if value is None or value == 'null' or value == '':
+            return None
+
+        return decoder(value)
+
+    return decode
+
+def _nullableFormat(formatter):
+    def encode(value):
+        return 'null' if value is None else formatter(value)
+
+    return encode
+
+def _decodeFloatList(value):
+    if isinstance(value, str):
+        value = json.loads(value)
+
+    return [float(v) for v in value]
+
+def _decodeStrList(value):
+    if isinstance(value, str):
+        # accept a JSON list or the comma separated form typed into the admin panel
+        if value.strip().startswith('['):
+            value = json.loads(value)
+        else:
+            value = [part.strip() for part in value.split(',') if part.strip() != '']
+
+    return [str(v) for v in value]
+
+# decoder and text formatter for each storable setting type
+settingTypes = {
+    'int':(_decodeInt, str),
+    'float':(_decodeFloat, repr),
+    'bool':(_decodeBool, _encodeBool),
+    'str':(str, str),
+    'floatList':(_decodeFloatList, json.dumps),
+    'strList':(_decodeStrList, json.dumps),
+    'nullableStr':(_nullable(str), _nullableFormat(str)),
+    'nullableFloat':(_nullable(_decodeFloat), _nullableFormat(repr))
+}
+
+def between(low, high):
+    def validate(value):
+        return low <= value <= high
+
+    return validate
+
+def oneOf(*options):
+    def validate(value):
+        return value in options
+
+    return validate
+
+class settingSpec:
+    def __init__(self, settingType, default, validator=None):
+        self.settingType = settingType
+        self.default = default
+        self.validator = validator
+        self.decode, self._format = settingTypes[settingType]
+
+    def encode(self, value):
+        value = self.decode(value)
+
+        if self.validator is not None and not self.validator(value):
+            raise ValueError('invalid value {value!r}'.format(value=value))
+
+        return self._format(value)
 
 class db_connect:
-    def __init__(self):
-        self.settingDefaults = {
-            'lastCondition':'null',
-            'validateShadeState':'null',
-            'startAzm':100,
-            'endAzm':260,
-            'startAlt':15,
-            'endAlt':15,
-            'lastInArea':'false',
-            'lastAzm':'null',
-            'lastAlt':'null',
-            'luxThresh':3000,
-            'conditionHistoryLength':5,
-            'commandOverride':0,
-            'solarThresh':20,
-            'changeBufferDurationSec':600,
-            'lastChangeDate':0,
-            'upperAlt':55,
-            'lowerAlt':15,
-            'upperAltPer':1,
-            'lowerAltPer':0.5,
-            'ticktockInterval':30
+    def __init__(self, dbPath='persist.db', journalMode='WAL', busyTimeoutMs=5000, poolSize=5, writeBehind=False, flushIntervalMs=500, flushRows=50, sharedCacheCheckMs=None):
+        # each setting is declared once with its type, default and validator
+        self.settingSpecs = {
+            'lastCondition':settingSpec('nullableStr', None, oneOf(None, 'open', 'close')),
+            'validateShadeState':settingSpec('nullableStr', None, oneOf(None, 'confirmRaise', 'confirmClose')),
+            'startAzm':settingSpec('float', 100, between(0, 360)),
+            'endAzm':settingSpec('float', 260, between(0, 360)),
+            'startAlt':settingSpec('float', 15, between(-90, 90)),
+            'endAlt':settingSpec('float', 15, between(-90, 90)),
+            'lastInArea':settingSpec('bool', False),
+            'lastAzm':settingSpec('nullableFloat', None),
+            'lastAlt':settingSpec('nullableFloat', None),
+            'luxThresh':settingSpec('int', 3000, between(0, float('inf'))),
+            'conditionHistoryLength':settingSpec('int', 5, between(1, float('inf'))),
+            'conditionMaxAgeSec':settingSpec('int', 0, between(0, float('inf'))),
+            'commandOverride':settingSpec('bool', False),
+            'solarThresh':settingSpec('float', 20, lambda value: value > 0),
+            'changeBufferDurationSec':settingSpec('int', 600, between(0, float('inf'))),
+            'lastChangeDate':settingSpec('int', 0),
+            'upperAlt':settingSpec('float', 55, between(-90, 90)),
+            'lowerAlt':settingSpec('float', 15, between(-90, 90)),
+            'upperAltPer':settingSpec('float', 1),
+            'lowerAltPer':settingSpec('float', 0.5),
+            'ticktockInterval':settingSpec('int', 30, between(1, float('inf'))),
+            'solarSmoothing':settingSpec('str', 'none', oneOf('none', 'ewma', 'median')),
+            'solarSmoothingAlpha':settingSpec('float', 0.3, lambda value: 0 < value <= 1),
+            'solarMedianWindow':settingSpec('int', 5, between(1, 60)),
+            'solarHysteresis':settingSpec('float', 0, between(0, 0.9)),
+            'smoothedSolar':settingSpec('nullableFloat', None),
+            'recentSolar':settingSpec('floatList', []),
+            'lastWeatherCondition':settingSpec('nullableStr', None),
+            'sunControlMode':settingSpec('str', 'pull', oneOf('pull', 'push')),
+            'solarSensorAccessory':settingSpec('str', 'Solar Sensor'),
+            'solarSensorCharacteristic':settingSpec('str', 'CurrentAmbientLightLevel'),
+            'shadeAccessories':settingSpec('strList', [])
         }
 
+        self.settingDefaults = {}
+        for s in self.settingSpecs:
+            self.settingDefaults[s] = self.settingSpecs[s].encode(self.settingSpecs[s].default)
+
         self.conditionDefaults = ['Clear','Mostly Clear']
-        
-        # connect to DB and get ready for queries
-        self.con = sqlite3.connect('persist.db')
-        self.cur = self.con.cursor()
+
+        # bucket width in seconds for each archive rollup, aligned to UTC
+        self.rollupPeriods = {'hour':3600, 'day':86400}
+
+        self.dbPath = dbPath
+        self.journalMode = journalMode
+        self.busyTimeoutMs = busyTimeoutMs
+        self.poolSize = poolSize
+
+        # connections are shared between request threads (or greenlets under gevent) through a
+        # small pool, so each caller gets its own connection and short-lived cursors
+        self._pool = queue.LifoQueue()
+        self._connections = []
+        self._poolLock = threading.Lock()
+        self._poolSlots = threading.BoundedSemaphore(poolSize)
+
+        # serializes writes so the in-memory caches are updated in the same order as the database
+        self._writeLock = threading.RLock()
+
+        # bumped whenever settings are changed through updateSetting(s), saveZones or updateDistinctConditions, or reloaded after
+        # another process wrote them, so callers can keep objects built from the settings until the generation they were built at goes stale
+        self._settingsGeneration = 0
+
+        # every write transaction bumps the cacheGeneration row; a value this process did not write
+        # means another process (e.g. a second gunicorn worker) changed the database under the caches.
+        # Only checked when sharedCacheCheckMs is set, and then at most once per that many ms, so a
+        # single process keeps answering cached reads without touching SQLite
+        self._cacheGeneration = None
+        self.sharedCacheCheckMs = sharedCacheCheckMs
+        self._nextCacheCheck = 0
+
+        # in write-behind mode these are queued to a background writer instead of committed per request
+        self.writeBehind = writeBehind
+        self.flushIntervalMs = flushIntervalMs
+        self.flushRows = flushRows
+        self.deferredSettings = ['lastAlt', 'lastAzm', 'smoothedSolar', 'recentSolar']
+
+        # each solar zone has its own watch area and its own copy of the sun control state,
+        # validated with the same specs as the global settings of the same name
+        self.zoneBoundSettings = ['startAzm', 'endAzm', 'startAlt', 'endAlt']
+        self.zoneStateSettings = ['lastCondition', 'validateShadeState', 'lastInArea', 'lastChangeDate']
 
         self._init_db()
+        self._loadCaches()
+
+        if self.writeBehind:
+            self._startWriter()
+
+    def _connect(self):
+        con = sqlite3.connect(self.dbPath, timeout=self.busyTimeoutMs / 1000, check_same_thread=False)
+        con.execute('PRAGMA busy_timeout = {ms}'.format(ms=int(self.busyTimeoutMs)))
+        con.execute('PRAGMA journal_mode = {mode}'.format(mode=self.journalMode))
+
+        if self.journalMode.upper() == 'WAL':
+            # in WAL mode NORMAL only syncs at checkpoints and is still safe against corruption
+            con.execute('PRAGMA synchronous = NORMAL')
+
+        return con
+
+    @contextmanager
+    def _connection(self):
+        self._poolSlots.acquire()
+
+        try:
+            con = self._pool.get_nowait()
+        except queue.Empty:
+            con = self._connect()
+
+            with self._poolLock:
+                self._connections.append(con)
+
+        try:
+            yield con
+        finally:
+            self._pool.put(con)
+            self._poolSlots.release()
+
+    @contextmanager
+    def _transaction(self):
+        # commits on success and rolls back if any statement fails
+        with self._connection() as con:
+            with con:
+                cur = con.cursor()
+
+                try:
+                    # taken first so the write lock is held for the whole transaction
+                    cur.execute('UPDATE cacheGeneration SET generation = generation + 1 WHERE id = 1')
+                    generation = cur.execute('SELECT generation FROM cacheGeneration WHERE id = 1').fetchone()[0]
+
+                    yield cur
+                finally:
+                    cur.close()
+
+        # only move forward if no other process wrote since the caches were loaded, otherwise the
+        # next read still sees a foreign generation and reloads
+        if generation - 1 == self._cacheGeneration:
+            self._cacheGeneration = generation
+
+    def _query(self, sql, params=()):
+        with self._connection() as con:
+            cur = con.cursor()
+
+            try:
+                cur.execute(sql, params)
+                return cur.fetchall()
+            finally:
+                cur.close()
 
     def _init_db(self):
-        self.cur.execute('CREATE TABLE IF NOT EXISTS settings (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, value TEXT, last_modified TEXT)')
-        self.cur.execute('CREATE TABLE IF NOT EXISTS conditionHistory (id INTEGER PRIMARY KEY AUTOINCREMENT, condition TEXT, timestamp TEXT)')
-        self.cur.execute('CREATE TABLE IF NOT EXISTS distinctConditions (id INTEGER PRIMARY KEY AUTOINCREMENT, condition TEXT, blindsClosed INTEGER)')
+        self._migrate()
 
-        for s in self.settingDefaults:
-            values = {"settingName":s,"defaultValue":self.settingDefaults[s]}
+        with self._transaction() as cur:
+            values = []
+            types = []
+            for s in self.settingDefaults:
+                values.append((s, self.settingDefaults[s], self.settingSpecs[s].settingType))
+                types.append((self.settingSpecs[s].settingType, s))
 
-            self.cur.execute('SELECT id FROM settings WHERE name = :settingName', values)
-            rs = self.cur.fetchall()
+            cur.executemany('INSERT OR IGNORE INTO settings (name, value, type, last_modified) VALUES (?, ?, ?, datetime(\'now\'))', values)
+            cur.executemany('UPDATE settings SET type = ? WHERE name = ? AND type IS NOT ?', [(t, n, t) for t, n in types])
+
+            cur.execute('SELECT id FROM distinctConditions LIMIT 1')
+            rs = cur.fetchall()
 
             if len(rs) == 0:
-                self.cur.execute('INSERT INTO settings (name, value, last_modified) VALUES (:settingName,:defaultValue,datetime(\'now\'))', values)
-                self.con.commit()
-
-        self.cur.execute('SELECT id FROM distinctConditions')
-        rs = self.cur.fetchall()
-
-        if len(rs) == 0:
-            for c in self.conditionDefaults:
-                values = {"condition":c}
-
-                self.cur.execute('INSERT INTO distinctConditions (condition, blindsClosed) VALUES (:condition, 1) ', values)
-                self.con.commit()
-        
-        self.cur.execute('SELECT id FROM conditionHistory')
-        rs = self.cur.fetchall()
-
-        if len(rs) == 0:
-            condition = 'Clear'
-            self.cur.execute('INSERT INTO conditionHistory (condition, timestamp) VALUES(?, datetime(\'now\'))', (condition,))
-            self.con.commit()
-    
+                for c in self.conditionDefaults:
+                    values = {"condition":c}
+
+                    cur.execute('INSERT INTO distinctConditions (condition, blindsClosed) VALUES (:condition, 1) ', values)
+
+            cur.execute('SELECT id FROM conditionHistory LIMIT 1')
+            rs = cur.fetchall()
+
+            if len(rs) == 0:
+                condition = 'Clear'
+                cur.execute('INSERT INTO conditionHistory (condition, timestamp) VALUES(?, ?)', (condition, int(time.time())))
+
+    def _migrate(self):
+        # each migration runs once, in order, in its own transaction and is recorded in schemaVersion
+        migrations = [
+            self._migration1BaseTables,
+            self._migration2IndexesAndEpochTimestamps,
+            self._migration3SettingTypes,
+            self._migration4ConditionArchive,
+            self._migration5SolarZones,
+            self._migration6CacheGeneration
+        ]
+
+        with self._connection() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS schemaVersion (version INTEGER PRIMARY KEY, applied_at INTEGER)')
+            con.commit()
+
+            currentVersion = con.execute('SELECT COALESCE(MAX(version), 0) FROM schemaVersion').fetchone()[0]
+
+            for version, migration in enumerate(migrations, start=1):
+                if version <= currentVersion:
+                    continue
+
+                with con:
+                    cur = con.cursor()
+
+                    try:
+                        cur.execute('BEGIN')
+                        migration(cur)
+                        cur.execute('INSERT INTO schemaVersion (version, applied_at) VALUES (?, ?)', (version, int(time.time())))
+                    finally:
+                        cur.close()
+
+    def _migration1BaseTables(self, cur):
+        cur.execute('CREATE TABLE IF NOT EXISTS settings (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, value TEXT, last_modified TEXT)')
+        cur.execute('CREATE TABLE IF NOT EXISTS conditionHistory (id INTEGER PRIMARY KEY AUTOINCREMENT, condition TEXT, timestamp TEXT)')
+        cur.execute('CREATE TABLE IF NOT EXISTS distinctConditions (id INTEGER PRIMARY KEY AUTOINCREMENT, condition TEXT, blindsClosed INTEGER)')
+
+    def _migration2IndexesAndEpochTimestamps(self, cur):
+        # drop duplicate rows (keeping the newest) so the lookup columns can be made unique
+        cur.execute('DELETE FROM settings WHERE id NOT IN (SELECT MAX(id) FROM settings GROUP BY name)')
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_settings_name ON settings (name)')
+
+        cur.execute('DELETE FROM distinctConditions WHERE id NOT IN (SELECT MAX(id) FROM distinctConditions GROUP BY condition)')
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_distinctConditions_condition ON distinctConditions (condition)')
+
+        # move history timestamps from datetime('now') text to integer epoch seconds
+        cur.execute('CREATE TABLE conditionHistoryEpoch (id INTEGER PRIMARY KEY AUTOINCREMENT, condition TEXT, timestamp INTEGER)')
+        cur.execute('INSERT INTO conditionHistoryEpoch (id, condition, timestamp) SELECT id, condition, CAST(strftime(\'%s\', timestamp) AS INTEGER) FROM conditionHistory')
+        cur.execute('DROP TABLE conditionHistory')
+        cur.execute('ALTER TABLE conditionHistoryEpoch RENAME TO conditionHistory')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_conditionHistory_timestamp ON conditionHistory (timestamp)')
+
+    def _migration3SettingTypes(self, cur):
+        cur.execute('ALTER TABLE settings ADD COLUMN type TEXT')
+
+    def _migration4ConditionArchive(self, cur):
+        # append-only record of every reading, plus hourly and daily rollups maintained as rows arrive
+        cur.execute('CREATE TABLE conditionArchive (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp INTEGER, condition TEXT, solar REAL, altitude REAL, azimuth REAL, inArea INTEGER)')
+        cur.execute('CREATE INDEX idx_conditionArchive_timestamp ON conditionArchive (timestamp)')
+        cur.execute('CREATE TABLE conditionRollup (period TEXT, bucket INTEGER, samples INTEGER, solarSamples INTEGER, solarMin REAL, solarMax REAL, solarSum REAL, inAreaSamples INTEGER, PRIMARY KEY (period, bucket))')
+        cur.execute('CREATE TABLE conditionRollupCounts (period TEXT, bucket INTEGER, condition TEXT, samples INTEGER, PRIMARY KEY (period, bucket, condition))')
+
+    def _migration5SolarZones(self, cur):
+        cur.execute('CREATE TABLE solarZones (name TEXT PRIMARY KEY, shades TEXT, startAzm REAL, endAzm REAL, startAlt REAL, endAlt REAL, '
+            'lastCondition TEXT, validateShadeState TEXT, lastInArea INTEGER, lastChangeDate INTEGER)')
+
+    def _migration6CacheGeneration(self, cur):
+        cur.execute('CREATE TABLE cacheGeneration (id INTEGER PRIMARY KEY CHECK (id = 1), generation INTEGER NOT NULL)')
+        cur.execute('INSERT INTO cacheGeneration (id, generation) VALUES (1, 0)')
+
+    def _readCacheGeneration(self):
+        return self._query('SELECT generation FROM cacheGeneration WHERE id = 1')[0][0]
+
+    def _loadCaches(self):
+        # the generation is read first, so a write that lands during the load only causes another reload
+        generation = self._readCacheGeneration()
+
+        self._loadSettings()
+        self._loadConditionWindow()
+        self._loadZones()
+
+        self._cacheGeneration = generation
+
+    def _syncCaches(self):
+        if self.sharedCacheCheckMs is None:
+            return
+
+        now = time.monotonic()
+        if now < self._nextCacheCheck:
+            return
+
+        self._nextCacheCheck = now + self.sharedCacheCheckMs / 1000
+
+        if self._readCacheGeneration() == self._cacheGeneration:
+            return
+
+        with self._writeLock:
+            # another reader may have reloaded while this one waited for the lock
+            if self._readCacheGeneration() == self._cacheGeneration:
+                return
+
+            # queued writes are already in the caches but not yet in the database, so reloading now
+            # would lose them; the next read tries again once the writer has caught up
+            if self.writeBehind and self._writeQueue.unfinished_tasks > 0:
+                self._nextCacheCheck = 0
+                return
+
+            self._loadCaches()
+            self._settingsGeneration += 1
+
+    @property
+    def settingsGeneration(self):
+        self._syncCaches()
+
+        return self._settingsGeneration
+
+    def _loadSettings(self):
+        # settings are read on every request but rarely change, so keep a parsed copy in memory
+        # and write through to it whenever a setting is updated
+        rs = self._query('SELECT name, value FROM settings')
+
+        self.settingsCache = {}
+        for r in rs:
+            if r[0] in self.settingSpecs:
+                try:
+                    self.settingsCache[r[0]] = self.settingSpecs[r[0]].decode(r[1])
+                except (TypeError, ValueError):
+                    # a value stored before settings were typed must not stop the app from starting
+                    print('### Stored value ' + repr(r[1]) + ' for ' + r[0] + ' is invalid, using the default ###')
+                    self.settingsCache[r[0]] = self.settingSpecs[r[0]].default
+
+    def _loadConditionWindow(self):
+        # the majority vote only ever looks at the newest conditionHistoryLength rows, so keep them
+        # in a ring with a running count per blindsClosed type instead of re-querying on every tick
+        self.conditionTypes = {}
+        for r in self._query('SELECT condition, blindsClosed FROM distinctConditions'):
+            self.conditionTypes[r[0]] = r[1]
+
+        self._closeConditions = None
+
+        histLengthMax = self.settingsCache['conditionHistoryLength']
+        rs = self._query('SELECT condition, timestamp FROM conditionHistory ORDER BY id DESC LIMIT ?', (histLengthMax,))
+
+        # (condition, epoch seconds) pairs, so votes can leave out readings that are too old
+        self.conditionWindow = deque(reversed([(r[0], r[1]) for r in rs]), maxlen=histLengthMax)
+        self.historyRows = self._query('SELECT COUNT(*) FROM conditionHistory')[0][0]
+        self._countConditionWindow()
+
+    def _loadZones(self):
+        columns = ['name', 'shades'] + self.zoneBoundSettings + self.zoneStateSettings
+
+        self.zonesCache = {}
+        for r in self._query('SELECT ' + ', '.join(columns) + ' FROM solarZones ORDER BY rowid ASC'):
+            zone = dict(zip(columns, r))
+            zone['shades'] = json.loads(zone['shades'])
+            zone['lastInArea'] = bool(zone['lastInArea'])
+
+            self.zonesCache[zone['name']] = zone
+
+    def _countConditionWindow(self):
+        self.conditionTypeCounts = {0:0, 1:0}
+        for condition, timestamp in self.conditionWindow:
+            self.conditionTypeCounts[self.conditionTypes.get(condition, 0)] += 1
+
+    def _resizeConditionWindow(self):
+        histLengthMax = self.settingsCache['conditionHistoryLength']
+
+        if histLengthMax != self.conditionWindow.maxlen:
+            # growing the window may need rows that have already left the ring, so reload it
+            rs = self._query('SELECT condition, timestamp FROM conditionHistory ORDER BY id DESC LIMIT ?', (histLengthMax,))
+
+            self.conditionWindow = deque(reversed([(r[0], r[1]) for r in rs]), maxlen=histLengthMax)
+            self._countConditionWindow()
+
+    def _rememberCondition(self, condition, timestamp):
+        if condition not in self.conditionTypes:
+            self.conditionTypes[condition] = 0
+            self._closeConditions = None
+
+        if len(self.conditionWindow) == self.conditionWindow.maxlen:
+            evicted = self.conditionWindow[0][0]
+            self.conditionTypeCounts[self.conditionTypes.get(evicted, 0)] -= 1
+
+        self.conditionWindow.append((condition, timestamp))
+        self.conditionTypeCounts[self.conditionTypes[condition]] += 1
+
     def disconnect(self):
-        self.con.close()
+        self._stopWriter()
+
+        with self._poolLock:
+            for con in self._connections:
+                con.close()
+
+            self._connections = []
+
+    def _writeSetting(self, cur, value, settingName):
+        cur.execute('UPDATE settings SET value = ?, last_modified = datetime(\'now\') WHERE name = ?', (value, settingName))
+
+    def _encodeSettings(self, settings):
+        # encoding validates every value up front so a bad one never reaches the database
+        encoded = {}
+        for settingName in settings:
+            if settingName not in self.settingSpecs:
+                raise ValueError('unknown setting {name}'.format(name=settingName))
+
+            try:
+                encoded[settingName] = self.settingSpecs[settingName].encode(settings[settingName])
+            except (TypeError, ValueError) as e:
+                raise ValueError('{name}: {error}'.format(name=settingName, error=e))
+
+        return encoded
+
+    def _decodeZoneValues(self, values, allowed):
+        # round trip through the setting specs so zone values get the same validation and types
+        decoded = {}
+        for settingName in values:
+            if settingName not in allowed:
+                raise ValueError('unknown zone setting {name}'.format(name=settingName))
+
+            spec = self.settingSpecs[settingName]
+
+            try:
+                decoded[settingName] = spec.decode(spec.encode(values[settingName]))
+            except (TypeError, ValueError) as e:
+                raise ValueError('{name}: {error}'.format(name=settingName, error=e))
+
+        return decoded
+
+    def _writeZoneState(self, cur, zoneName, state):
+        assignments = ', '.join(settingName + ' = ?' for settingName in state)
+        cur.execute('UPDATE solarZones SET ' + assignments + ' WHERE name = ?', list(state.values()) + [zoneName])
+
+    def _cacheSettings(self, settings):
+        for settingName in settings:
+            self.settingsCache[settingName] = self.settingSpecs[settingName].decode(settings[settingName])
+
+        if 'conditionHistoryLength' in settings:
+            self._resizeConditionWindow()
 
     def updateSetting(self, value, settingName):
-        self.cur.execute('UPDATE settings SET value = ?, last_modified = datetime(\'now\') WHERE name = ?', (value, settingName))
-        self.con.commit()
-    
+        self.updateSettings({settingName:value})
+
+    def updateSettings(self, settings):
+        settings = self._encodeSettings(settings)
+
+        with self._writeLock:
+            with self._transaction() as cur:
+                for settingName in settings:
+                    self._writeSetting(cur, settings[settingName], settingName)
+
+            self._cacheSettings(settings)
+            self._settingsGeneration += 1
+
     def getSetting(self, settingName):
-        self.cur.execute('SELECT value FROM settings WHERE name = :name', {'name':settingName})
-        rs = self.cur.fetchall() 
+        self._syncCaches()
+
+        return self.settingsCache[settingName]
 
-        return int(rs[0][0]) if rs[0][0].isdigit() else float(rs[0][0]) if self.is_float(rs[0][0]) else rs[0][0]
-    
     def getSettings(self):
-        names = []
+        self._syncCaches()
+
+        return dict(self.settingsCache)
+
+    def _encodeZoneStateUpdates(self, zoneStateUpdates):
+        # a zone removed by saveZones while its decision was in flight has no state left to update
+        zoneStateUpdates = zoneStateUpdates or {}
+
+        return {zoneName:self._decodeZoneValues(zoneStateUpdates[zoneName], self.zoneStateSettings) for zoneName in zoneStateUpdates if zoneName in self.zonesCache}
+
+    def applyStateUpdates(self, stateUpdates, condition=None, reading=None, zoneStateUpdates=None):
+        # apply every state change from one sun control decision, and optionally log the
+        # observed condition, in a single transaction so they are committed or rolled back together
+        if not self.writeBehind:
+            conditionLog = [] if condition is None else [(condition, reading, int(time.time()))]
+            self.applyBatchStateUpdates(stateUpdates, conditionLog, zoneStateUpdates)
+            return
+
+        stateUpdates = self._encodeSettings(stateUpdates)
+        zoneStateUpdates = self._encodeZoneStateUpdates(zoneStateUpdates)
+
+        # decision-critical state is still committed before returning, the rest is queued
+        deferred = {}
+        for settingName in self.deferredSettings:
+            if settingName in stateUpdates:
+                deferred[settingName] = stateUpdates.pop(settingName)
+
+        with self._writeLock:
+            if len(stateUpdates) > 0 or len(zoneStateUpdates) > 0:
+                with self._transaction() as cur:
+                    for settingName in stateUpdates:
+                        self._writeSetting(cur, stateUpdates[settingName], settingName)
+
+                    for zoneName in zoneStateUpdates:
+                        self._writeZoneState(cur, zoneName, zoneStateUpdates[zoneName])
+
+            self._cacheSettings(stateUpdates)
+            self._cacheSettings(deferred)
+            self._cacheZoneState(zoneStateUpdates)
+
+            if len(deferred) > 0:
+                self._writeQueue.put(('settings', deferred))
+
+            if condition is not None:
+                self._queueCondition(condition, reading)
+
+    def applyBatchStateUpdates(self, stateUpdates, conditionLog, zoneStateUpdates=None):
+        # final state after a sequence of decisions plus one history row per decision, given as
+        # (condition, reading, timestamp), committed together in a single transaction
+        stateUpdates = self._encodeSettings(stateUpdates)
+        zoneStateUpdates = self._encodeZoneStateUpdates(zoneStateUpdates)
+
+        # rows already queued by the writer are older than these, so let them land first
+        with self._flushedWriteLock():
+            historyRows = self.historyRows
+
+            try:
+                with self._transaction() as cur:
+                    for settingName in stateUpdates:
+                        self._writeSetting(cur, stateUpdates[settingName], settingName)
+
+                    for zoneName in zoneStateUpdates:
+                        self._writeZoneState(cur, zoneName, zoneStateUpdates[zoneName])
+
+                    newConditions = set()
+                    for condition, reading, timestamp in conditionLog:
+                        newCondition = condition not in self.conditionTypes and condition not in newConditions
+                        newConditions.add(condition)
+
+                        self.historyRows = self._logCondition(cur, condition, reading, int(timestamp), newCondition)
+            except Exception:
+                # nothing was committed, so the row count must not move either
+                self.historyRows = historyRows
+                raise
+
+            self._cacheSettings(stateUpdates)
+            self._cacheZoneState(zoneStateUpdates)
+
+            for condition, reading, timestamp in conditionLog:
+                self._rememberCondition(condition, int(timestamp))
+
+    def _cacheZoneState(self, zoneStateUpdates):
+        for zoneName in zoneStateUpdates:
+            self.zonesCache[zoneName].update(zoneStateUpdates[zoneName])
+
+    def getZones(self):
+        self._syncCaches()
+
+        return [dict(zone, shades=list(zone['shades'])) for zone in self.zonesCache.values()]
+
+    def saveZones(self, zones):
+        # replaces the zone definitions; zones that keep their name keep their control state
+        definitions = []
+        for zone in zones:
+            name = zone.get('name')
+            shades = zone.get('shades')
+
+            if not isinstance(name, str) or name == '':
+                raise ValueError('zone name must be a non-empty string')
+
+            if not isinstance(shades, list) or not all(isinstance(shade, str) for shade in shades):
+                raise ValueError('{name}: shades must be a list of names'.format(name=name))
+
+            bounds = {settingName:zone[settingName] for settingName in self.zoneBoundSettings if settingName in zone}
+            if len(bounds) != len(self.zoneBoundSettings):
+                raise ValueError('{name}: zones need {bounds}'.format(name=name, bounds=', '.join(self.zoneBoundSettings)))
+
+            definitions.append(dict(self._decodeZoneValues(bounds, self.zoneBoundSettings), name=name, shades=list(shades)))
+
+        if len(set(zone['name'] for zone in definitions)) != len(definitions):
+            raise ValueError('zone names must be unique')
+
+        with self._writeLock:
+            with self._transaction() as cur:
+                cur.execute('DELETE FROM solarZones WHERE name NOT IN (' + ', '.join('?' * len(definitions)) + ')', [zone['name'] for zone in definitions])
+
+                for zone in definitions:
+                    values = [zone['name'], json.dumps(zone['shades'])] + [zone[settingName] for settingName in self.zoneBoundSettings]
+                    defaults = [self.settingSpecs[settingName].default for settingName in self.zoneStateSettings]
+
+                    cur.execute('INSERT INTO solarZones (name, shades, ' + ', '.join(self.zoneBoundSettings + self.zoneStateSettings) + ') '
+                        'VALUES (' + ', '.join('?' * (len(values) + len(defaults))) + ') '
+                        'ON CONFLICT (name) DO UPDATE SET shades = excluded.shades, ' + ', '.join(settingName + ' = excluded.' + settingName for settingName in self.zoneBoundSettings),
+                        values + defaults)
+
+            self._loadZones()
+            self._settingsGeneration += 1
+
+    def logCondition(self, condition, reading=None):
+        with self._writeLock:
+            if self.writeBehind:
+                self._queueCondition(condition, reading)
+                return
 
-        for s in self.settingDefaults:
-            names.append(s)
-        
-        sql = 'SELECT name, value FROM settings WHERE name IN ({seq})'.format(seq=','.join(['?']*len(names)))
+            timestamp = int(time.time())
 
-        self.cur.execute(sql, names)
-        res = self.cur.fetchall()
+            with self._transaction() as cur:
+                newCondition = condition not in self.conditionTypes
+                historyRows = self._logCondition(cur, condition, reading, timestamp, newCondition)
 
-        result = {}
-        if len(res) > 0:
-            for r in res:
-                result[r[0]] = int(r[1]) if r[1].isdigit() else float(r[1]) if self.is_float(r[1]) else r[1]
+            self._rememberCondition(condition, timestamp)
+            self.historyRows = historyRows
 
-        return result
+    def _queueCondition(self, condition, reading):
+        # the in-memory window is updated straight away so the vote never waits on the writer
+        newCondition = condition not in self.conditionTypes
+        timestamp = int(time.time())
 
-    def logCondition(self, condition):
-        self.cur.execute('INSERT INTO conditionHistory (condition, timestamp) VALUES(?, datetime(\'now\'))', (condition,))
-        self.con.commit()
+        self._writeQueue.put(('condition', condition, reading, timestamp, newCondition))
+        self._rememberCondition(condition, timestamp)
 
-        self.cur.execute('SELECT id FROM distinctConditions WHERE condition = ?', (condition,))
-        rs = self.cur.fetchall()
+    def _logCondition(self, cur, condition, reading, timestamp, newCondition):
+        cur.execute('INSERT INTO conditionHistory (condition, timestamp) VALUES(?, ?)', (condition, timestamp))
+        self._archiveCondition(cur, timestamp, condition, reading or {})
 
-        if len(rs) == 0:
-            self.cur.execute('INSERT INTO distinctConditions (condition, blindsClosed) VALUES (?, 0)', (condition,))
-            self.con.commit()
+        if newCondition:
+            cur.execute('INSERT OR IGNORE INTO distinctConditions (condition, blindsClosed) VALUES (?, 0)', (condition,))
 
-        self.cur.execute('SELECT value FROM settings WHERE name = \'conditionHistoryLength\'')
-        rs = self.cur.fetchall()
+        histLengthMax = self.settingsCache['conditionHistoryLength']
+        historyRows = self.historyRows + 1
 
-        histLengthMax = int(rs[0][0])
+        # prune in batches once the table holds twice the window rather than on every insert
+        if historyRows > histLengthMax * 2:
+            cur.execute('DELETE FROM conditionHistory WHERE id NOT IN (SELECT id FROM conditionHistory ORDER BY id DESC LIMIT ?)', (histLengthMax,))
+            historyRows = histLengthMax
 
-        self.cur.execute('SELECT COUNT(*) FROM conditionHistory')
-        rs = self.cur.fetchall()
+        return historyRows
 
-        currentHistLength = int(rs[0][0])
+    def _startWriter(self):
+        self._writeQueue = queue.Queue()
+        self._writer = threading.Thread(target=self._writeBehindLoop, name='db_connect-writer', daemon=True)
+        self._writer.start()
 
-        if (currentHistLength > histLengthMax):
-            deleteCount = currentHistLength - histLengthMax
+        atexit.register(self._stopWriter)
+
+    def _writeBehindLoop(self):
+        while True:
+            # block for the first item, then keep collecting until the batch is full or the interval passes
+            batch = [self._writeQueue.get()]
+            deadline = time.monotonic() + self.flushIntervalMs / 1000
+
+            while batch[-1] is not None and len(batch) < self.flushRows:
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    break
+
+                try:
+                    batch.append(self._writeQueue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # any failure drops only this batch; letting it escape would kill the writer and leave
+            # every later write and flush() waiting on a queue nobody drains
+            try:
+                self._writeBatch([item for item in batch if item is not None])
+            except Exception as e:
+                print('### Write-behind batch of ' + str(len(batch)) + ' dropped: ' + repr(e) + ' ###')
+            finally:
+                for item in batch:
+                    self._writeQueue.task_done()
+
+            if batch[-1] is None:
+                return
+
+    def _writeBatch(self, batch):
+        if len(batch) == 0:
+            return
+
+        with self._writeLock:
+            historyRows = self.historyRows
+
+            try:
+                with self._transaction() as cur:
+                    for item in batch:
+                        if item[0] == 'settings':
+                            for settingName in item[1]:
+                                self._writeSetting(cur, item[1][settingName], settingName)
+                        else:
+                            self.historyRows = self._logCondition(cur, *item[1:])
+            except Exception:
+                # nothing in the batch was committed, so the row count must not move either
+                self.historyRows = historyRows
+                raise
+
+    def flush(self):
+        if not self.writeBehind:
+            return
+
+        # same as Queue.join(), but gives up instead of blocking forever if the writer has died
+        with self._writeQueue.all_tasks_done:
+            while self._writeQueue.unfinished_tasks:
+                if not self._writer.is_alive():
+                    raise sqlite3.OperationalError('write-behind writer is not running, ' + str(self._writeQueue.unfinished_tasks) + ' writes not saved')
+
+                self._writeQueue.all_tasks_done.wait(1)
+
+    @contextmanager
+    def _flushedWriteLock(self):
+        # holds the write lock with nothing left in the write-behind queue; writes are only queued
+        # while holding the lock, so nothing queued earlier can land after the caller's own writes
+        while True:
+            self.flush()
+            self._writeLock.acquire()
+
+            if not self.writeBehind or self._writeQueue.unfinished_tasks == 0:
+                break
+
+            # another thread queued a write between the flush and the lock, so flush again
+            self._writeLock.release()
+
+        try:
+            yield
+        finally:
+            self._writeLock.release()
+
+    def _stopWriter(self):
+        if self.writeBehind and self._writer.is_alive():
+            self._writeQueue.put(None)
+            self._writer.join()
+
+    def _archiveCondition(self, cur, timestamp, condition, reading):
+        solar = reading.get('solar')
+        inArea = reading.get('inArea')
+
+        cur.execute('INSERT INTO conditionArchive (timestamp, condition, solar, altitude, azimuth, inArea) VALUES (?, ?, ?, ?, ?, ?)',
+            (timestamp, condition, solar, reading.get('altitude'), reading.get('azimuth'), None if inArea is None else int(bool(inArea))))
+
+        for period in self.rollupPeriods:
+            bucket = timestamp - timestamp % self.rollupPeriods[period]
+
+            values = {
+                'period':period,
+                'bucket':bucket,
+                'solarSamples':0 if solar is None else 1,
+                'solar':solar,
+                'inArea':1 if inArea else 0,
+                'condition':condition
+            }
+
+            cur.execute('INSERT INTO conditionRollup (period, bucket, samples, solarSamples, solarMin, solarMax, solarSum, inAreaSamples) VALUES (:period, :bucket, 1, :solarSamples, :solar, :solar, COALESCE(:solar, 0), :inArea) '
+                'ON CONFLICT (period, bucket) DO UPDATE SET samples = samples + 1, solarSamples = solarSamples + excluded.solarSamples, '
+                'solarMin = MIN(COALESCE(solarMin, excluded.solarMin), COALESCE(excluded.solarMin, solarMin)), '
+                'solarMax = MAX(COALESCE(solarMax, excluded.solarMax), COALESCE(excluded.solarMax, solarMax)), '
+                'solarSum = solarSum + excluded.solarSum, inAreaSamples = inAreaSamples + excluded.inAreaSamples', values)
+            cur.execute('INSERT INTO conditionRollupCounts (period, bucket, condition, samples) VALUES (:period, :bucket, :condition, 1) '
+                'ON CONFLICT (period, bucket, condition) DO UPDATE SET samples = samples + 1', values)
+
+    def getConditionRollups(self, period, start=None, end=None):
+        if period not in self.rollupPeriods:
+            raise ValueError('unknown rollup period {period}'.format(period=period))
+
+        bounds = (period, start if start is not None else 0, end if end is not None else 2**63 - 1)
+
+        rollups = {}
+        for r in self._query('SELECT bucket, samples, solarSamples, solarMin, solarMax, solarSum, inAreaSamples FROM conditionRollup WHERE period = ? AND bucket >= ? AND bucket < ? ORDER BY bucket ASC', bounds):
+            rollups[r[0]] = {
+                'bucket':r[0],
+                'samples':r[1],
+                'solarMin':r[3],
+                'solarMean':r[5] / r[2] if r[2] > 0 else None,
+                'solarMax':r[4],
+                'inAreaShare':r[6] / r[1],
+                'conditions':{}
+            }
+
+        for r in self._query('SELECT bucket, condition, samples FROM conditionRollupCounts WHERE period = ? AND bucket >= ? AND bucket < ?', bounds):
+            if r[0] in rollups:
+                rollups[r[0]]['conditions'][r[1]] = r[2]
+
+        return list(rollups.values())
+
+    def getArchivedReadings(self, start=None, end=None):
+        bounds = (start if start is not None else 0, end if end is not None else 2**63 - 1)
+
+        return self._query('SELECT timestamp, solar FROM conditionArchive WHERE timestamp >= ? AND timestamp < ? AND solar IS NOT NULL ORDER BY timestamp ASC, id ASC', bounds)
+
+    def getConditionWindow(self):
+        # (condition, epoch seconds) pairs the majority vote counts, oldest first
+        self._syncCaches()
+
+        return list(self.conditionWindow)
 
-            self.cur.execute('DELETE FROM conditionHistory ORDER BY timestamp ASC LIMIT :count', {'count':deleteCount})
-            self.con.commit()
-    
     def topConditionFromHistory(self):
-        self.cur.execute('SELECT condition, COUNT(*) as histCount FROM conditionHistory GROUP BY condition ORDER BY histCount DESC')
-        rs = self.cur.fetchall()
+        self._syncCaches()
 
-        return rs[0][0]
+        return Counter(condition for condition, timestamp in self.conditionWindow).most_common(1)[0][0]
 
     def topConditionTypeFromHistory(self):
-        self.cur.execute('SELECT blindsClosed, COUNT(timestamp) AS histCount FROM conditionHistory INNER JOIN distinctConditions ON conditionHistory.condition = distinctConditions.condition GROUP BY blindsClosed ORDER BY histCount DESC')
-        rs = self.cur.fetchall()
+        self._syncCaches()
 
-        retval = "close" if rs[0][0] == 1 else "open"
+        retval = "close" if self.conditionTypeCounts[1] > self.conditionTypeCounts[0] else "open"
 
         return retval
-    
-    def is_float(self, string):
-        try:
-            float(string)
-            return True
-        except ValueError:
-            return False
+
+    def getCloseConditions(self):
+        # built from the in-memory blindsClosed mapping and kept until a condition is added or remapped
+        self._syncCaches()
+
+        closeConditions = self._closeConditions
+
+        if closeConditions is None:
+            with self._writeLock:
+                closeConditions = frozenset(condition for condition in self.conditionTypes if self.conditionTypes[condition] == 1)
+                self._closeConditions = closeConditions
+
+        return closeConditions
+
+    def getDistinctConditions(self):
+        return self._query('SELECT condition, blindsClosed FROM distinctConditions ORDER BY condition ASC')
+
+    def updateDistinctConditions(self, distinctConditions):
+        with self._writeLock:
+            with self._transaction() as cur:
+                for condition in distinctConditions:
+                    cur.execute('UPDATE distinctConditions SET blindsClosed = ? WHERE condition = ?', (distinctConditions[condition], condition))
+
+            for condition in distinctConditions:
+                if condition in self.conditionTypes:
+                    self.conditionTypes[condition] = int(distinctConditions[condition])
+
+            self._closeConditions = None
+            self._countConditionWindow()
+
+            # controllers are built with the close conditions, so treat a remap as a settings change
+            self._settingsGeneration += 1
+
+    def getConditionHistory(self, since=None, before=None, limit=None):
+        # since and before are row id cursors, so pages stay stable while new rows are logged
+        sql = 'SELECT condition, datetime(timestamp, \'unixepoch\'), id FROM conditionHistory WHERE id > ? AND id < ? ORDER BY id DESC LIMIT ?'
+        params = (since if since is not None else 0, before if before is not None else 2**63 - 1, limit if limit is not None else -1)
+
+        return self._query(sql, params)
+
+    def getLatestConditionId(self):
+        rs = self._query('SELECT MAX(id) FROM conditionHistory')
+
+        return rs[0][0]
+
+    def getLastConditionTimestamp(self):
+        rs = self._query('SELECT MAX(timestamp) FROM conditionHistory')
+
+        return rs[0][0]
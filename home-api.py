@@ -1,13 +1,14 @@
 from flask import Flask, request, Response, redirect, url_for, render_template
 import json
 import datetime
-import calendar
+import time
 import pytz
 import sqlite3
 import importlib
 import os
 import atexit
 import socket
+import requests
 from apscheduler.schedulers.background import BackgroundScheduler
 from noaa_sdk import NOAA
 from pywebostv.connection import WebOSClient
@@ -16,7 +17,9 @@ from pywebostv.controls import ApplicationControl
 from classes.db_connect import db_connect
 from classes.usps_api_control import USPSApi, SFDCApi, USPSError, SFDCError
 from classes.sun_control import sun_control_master
-from classes.hbapi_control import hb_authorize, acc_char_data
+from classes.hbapi_control import hb_authorize, acc_char_data, hb_session_manager, hb_http_executor, hb_batch_writer, hb_state_mirror
+from routes.condition_history_routes import condition_history_route
+from routes.solar_blind_routes import ControllerCache, solar_blind_push, register_solar_blind_routes
 
 hbCliHelper = importlib.import_module('homebridgeUIAPI-python.classes.cliHelper')
 # from homebridgeUIAPIpython.classes import cliHelp as hbCliHelper
@@ -30,8 +33,10 @@ uspsAuthFile = "./secrets/uspsAuth.json"
 sfdcAuthFile = "./secrets/sfdcAuth.json"
 sfdcPrivateKey = "./secrets/private.key"
 lgAuthFile = "./secrets/lgtoken.json"
+dbConfigFile = "./secrets/dbConfig.json"
 
 ticktockJob = {"status":"Stopped","job":None,"interval":30}
+conditionHistoryPageSize = 500
 
 ####################
 ### Load Secrets ###
@@ -49,11 +54,45 @@ with open(sfdcAuthFile) as f:
 with open(sfdcPrivateKey) as f:
     secrets['sfdcPKey'] = f.read()
 
-###############################################
-### Initialize a single database connection ###
-###############################################
+# optional database tuning; without it every write is committed before the request returns
+secrets['dbConfig'] = {}
+if os.path.exists(dbConfigFile):
+    with open(dbConfigFile) as f:
+        secrets['dbConfig'] = json.loads(f.read())
+
+#########################################
+### Shared Homebridge session manager ###
+#########################################
+
+# one pooled keep-alive connection set and one login, reused by the scheduler and request handlers
+hbExecutor = hb_http_executor(secrets['hbCreds']['host'], secrets['hbCreds']['port'], secrets['hbCreds']['secure'],
+    secrets['hbCreds'].get('poolSize', 4), secrets['hbCreds'].get('connectTimeoutSec', 3.05), secrets['hbCreds'].get('readTimeoutSec', 10),
+    secrets['hbCreds'].get('accessoryIndexTtlSec', 300))
+hbSession = hb_session_manager(hbExecutor, hb_authorize(secrets['hbCreds']['host'], secrets['hbCreds']['port'], secrets['hbCreds']['username'], secrets['hbCreds']['password'],None,secrets['hbCreds']['secure']))
+hbWriter = hb_batch_writer(secrets['hbCreds'].get('poolSize', 4))
+
+# optional live copy of accessory state fed by the Homebridge UI socket, so repeated reads of shade
+# positions and sensor values are answered in-process while it is connected
+hbMirror = None
+if secrets['hbCreds'].get('stateMirror', False):
+    hbMirror = hb_state_mirror(hbSession, secrets['hbCreds'].get('stateMirrorMaxAgeSec', 30))
+    if hbMirror.start():
+        hbSession.mirror = hbMirror
+    else:
+        hbMirror = None
+
+##############################################
+### Initialize the pooled database session ###
+##############################################
+
+# write-behind commits history and non-critical state in batches, at the cost of losing up to one
+# flush interval of those writes if the process dies; sharedCacheCheckMs must be set when more than
+# one worker process serves the app, so each notices the others' writes within that many ms
+db_session = db_connect(writeBehind=secrets['dbConfig'].get('writeBehind', False), flushIntervalMs=secrets['dbConfig'].get('flushIntervalMs', 500),
+    flushRows=secrets['dbConfig'].get('flushRows', 50), sharedCacheCheckMs=secrets['dbConfig'].get('sharedCacheCheckMs'))
 
-db_session = db_connect()
+# controller used by the server-driven sun control loop, rebuilt when settings change
+solarControllers = ControllerCache(db_session)
 
 ####################################
 ### Front-end for homebridge API ###
@@ -68,10 +107,16 @@ def hb_auth():
     config = request.json.get('config')
     secure = request.json.get('secure')
 
+    # the other /hbapi routes send the returned token to the configured Homebridge, so only log in there
+    if host not in (None, secrets['hbCreds']['host']) or (port is not None and str(port) != str(secrets['hbCreds']['port'])) or secure not in (None, secrets['hbCreds']['secure']):
+        return json.dumps({'status':'Error','message':'only the configured Homebridge host can be authorized'})
+
     hb_auth_payload = hb_authorize(host, port, user, passwd, config, secure)
 
-    thisExec = hbCliHelper.cliExecutor()
-    result = thisExec.authorize(hb_auth_payload)
+    try:
+        result = hbExecutor.authorize(hb_auth_payload)
+    except Exception as e:
+        return json.dumps({'status':'Error','message':str(e)})
 
     return json.dumps(result)
 
@@ -83,11 +128,39 @@ def set_acc_char():
 
     set_acc_char_payload = acc_char_data(name, chars, session)
 
-    thisExec = hbCliHelper.cliExecutor()
-    result = thisExec.setaccessorychar(set_acc_char_payload)
+    try:
+        result = hbExecutor.setaccessorychar(set_acc_char_payload)
+    except requests.RequestException as e:
+        return json.dumps({'status':'Error','message':str(e)})
 
     return json.dumps(result)
 
+@app.route('/hbapi/setaccessorychars', methods=['POST'])
+def set_acc_chars():
+    session = request.headers.get('sessionId')
+
+    writes = request.json.get('writes') if isinstance(request.json, dict) else request.json
+    if not isinstance(writes, list):
+        return json.dumps({'status':'Error','message':'expected a list of {name, type, value} writes'})
+
+    # malformed items are answered in place so the valid ones are still sent
+    results = [None] * len(writes)
+    payloads = []
+    for index, w in enumerate(writes):
+        if isinstance(w, dict) and isinstance(w.get('name'), str) and isinstance(w.get('type'), str) and 'value' in w:
+            payloads.append((index, acc_char_data(w['name'], [w['type'], w['value']], session)))
+        else:
+            results[index] = {'status':'Error', 'message':'each write needs a name, type and value', 'elapsedMs':0}
+
+    started = time.perf_counter()
+    for (index, payload), item in zip(payloads, hbWriter.write(hbExecutor, [payload for index, payload in payloads])):
+        results[index] = item
+    elapsedMs = round((time.perf_counter() - started) * 1000, 1)
+
+    status = 'success' if all(r['status'] == 'success' for r in results) else 'Error'
+
+    return json.dumps({'status':status, 'elapsedMs':elapsedMs, 'results':results})
+
 @app.route('/hbapi/getaccessorycharvals', methods=['POST'])
 def get_acc_chars():
     name = request.json.get('name')
@@ -96,8 +169,17 @@ def get_acc_chars():
 
     get_acc_char_payload = acc_char_data(name,chars,session)
 
-    thisExec = hbCliHelper.cliExecutor()
-    result = thisExec.accessorycharvalues(get_acc_char_payload)
+    # the mirror is filled with the server's own login, so it only answers callers whose token
+    # Homebridge accepts; anyone else goes to Homebridge and gets its answer as before
+    try:
+        result = None
+        if hbMirror is not None and hbExecutor.checkSession(session):
+            result = hbMirror.lookup(name, chars)
+
+        if result is None:
+            result = hbExecutor.accessorycharvalues(get_acc_char_payload)
+    except requests.RequestException as e:
+        return json.dumps({'status':'Error','message':str(e)})
 
     return json.dumps(result)
 
@@ -108,11 +190,27 @@ def list_acc_chars():
 
     list_acc_char_payload = acc_char_data(name,None,session)
 
-    thisExec = hbCliHelper.cliExecutor()
-    result = thisExec.listaccessorychars(list_acc_char_payload)
+    try:
+        result = hbExecutor.listaccessorychars(list_acc_char_payload)
+    except requests.RequestException as e:
+        return json.dumps({'status':'Error','message':str(e)})
 
     return json.dumps(result)
 
+@app.route('/hbapi/invalidateaccessoryindex', methods=['POST'])
+def invalidate_acc_index():
+    # forces the next characteristic call to rebuild the accessory name index
+    hbExecutor.invalidateIndex()
+
+    return json.dumps({'status':'success', 'index':hbExecutor.indexStatus()})
+
+@app.route('/hbapi/statemirror', methods=['GET'])
+def state_mirror_status():
+    if hbMirror is None:
+        return json.dumps({'status':'disabled'})
+
+    return json.dumps({'status':'success', 'mirror':hbMirror.status()})
+
 ############################################
 ### USPS Informed Delivery Notifications ###
 ############################################
@@ -163,7 +261,14 @@ def extract_ups():
 @app.route('/override_sync', methods=['GET'])
 def override_sync():
     if request.method == 'GET':
-        db_session.updateSetting(str(request.args.get('state')), 'commandOverride')
+        state = request.args.get('state')
+        if state is None:
+            return json.dumps({'status':'Error','message':'state is required'})
+
+        try:
+            db_session.updateSetting(state, 'commandOverride')
+        except ValueError as e:
+            return json.dumps({'status':'Error','message':str(e)})
 
         result = {
                 'status':'success'
@@ -177,129 +282,10 @@ def override_sync():
 ### Controls the blinds based on sun position ###
 #################################################
 
-@app.route('/sun_control', methods=['GET'])
-def sun_control():
-    if request.method == 'GET':
-        the_sun = sun_control_master(db_session)
-        settings = db_session.getSettings()
-
-        #condition = db_session.topConditionFromHistory()
-        condition = db_session.topConditionTypeFromHistory()
-
-        shade_state = json.loads(request.args.get('shade_state'))
-
-        now = datetime.datetime.now(tz=pytz.timezone('US/Pacific'))
-        nowUTC = datetime.datetime.now(tz=pytz.UTC)
-
-        # test times
-        # now = datetime.datetime.now(tz=pytz.timezone('US/Pacific')) - datetime.timedelta (hours=7)
-        # nowUTC = datetime.datetime.now(tz=pytz.UTC) - datetime.timedelta (hours=7)
-
-        # get the altitude and azimuth of the sun
-        the_sun.get_pos(now)
-
-        db_session.updateSetting(the_sun.alt, 'lastAlt')
-        db_session.updateSetting(the_sun.azm, 'lastAzm')
-
-        # use condition passed in from iOS Weather
-        # db_session.logCondition(request.args.get('condition'))
-
-        # alternative approach, use lux from the doorbell instead (this needs a better sensor to function)
-        #luxString = request.args.get('lux')
-        #luxInt = float(luxString.split(" ")[0].replace(",", ""))
-        #luxCondition = 'Cloudy' if luxInt < settings['luxThresh'] else 'Clear'
-        #db_session.logCondition(luxCondition)
-
-        # another alternative approach, get the weather from the government (very slow update frequency)
-        #n = NOAA()
-        #weatherSample = n.get_observations_by_lat_lon(the_sun.latitude, the_sun.longitude)
-        #for obs in weatherSample:
-        #    db_session.logCondition(obs['textDescription'])
-        #    break
-
-        weightedSolarThresh = 0
-
-        # solar state weighting logic
-        if the_sun.alt < settings['lowerAlt']:
-            weightedSolarThresh = settings['solarThresh'] * settings['lowerAltPer']
-        elif the_sun.alt > settings['upperAlt']:
-            weightedSolarThresh = settings['solarThresh'] * settings['upperAltPer']
-        else:
-            solarAltWeight = (the_sun.alt - settings['lowerAlt'])/(settings['upperAlt']-settings['lowerAlt'])
-            solarAltWeightPer = ((settings['upperAltPer']-settings['lowerAltPer'])*solarAltWeight)+settings['lowerAltPer']
-            weightedSolarThresh = settings['solarThresh'] * solarAltWeightPer
-            # print(str(weightedSolarThresh) + " " + str(solarAltWeightPer) + " " + str(solarAltWeight))
-
-        # solar state
-        solarStatus = int(request.args.get('solar'))
-        solarCondition = 'Cloudy' if solarStatus < weightedSolarThresh else 'Clear'
-        db_session.logCondition(solarCondition)
-        
-        in_area = the_sun.sunInArea(the_sun.azm, the_sun.alt, settings['startAzm'], settings['endAzm'], settings['startAlt'], settings['endAlt'])
-
-        result = {
-            'status':'success',
-            'commands':[]
-        }
-        
-        # logic to retry shade commands if the blinds aren't in the correct state
-        if settings['validateShadeState'] != 'null' and (condition == settings['lastCondition'] or settings['lastCondition'] == 'null'):
-            validateShades = the_sun.validateShadeState(settings['validateShadeState'],shade_state)
-            
-            if validateShades == None:
-                db_session.updateSetting('null', 'validateShadeState')
-            else:
-                if settings['commandOverride'] != 1:
-                    result['commands'].append(validateShades)
-        
-        if settings['commandOverride'] != 1:
-            if in_area:
-
-                # check for duration since last change to make sure we're not raising/lowering too frequently
-                lastChangeDate = datetime.datetime.fromtimestamp(settings['lastChangeDate'], tz=pytz.UTC)
-
-                diffSinceLastChangeDate = nowUTC - lastChangeDate
-                diffSeconds = diffSinceLastChangeDate.total_seconds()
-                print(diffSeconds)
-                print(settings['lastChangeDate'])
-
-
-                if diffSeconds > settings['changeBufferDurationSec']:
-
-                    # raise or lower the blinds depending on the weather
-                    if condition != settings['lastCondition']:
-                        state = ""
-                        if condition == "close":
-                            if settings['lastCondition'] != "close":
-                                result['commands'].append('closeAll')
-                                state = 'confirmClose'
-                                
-                        else:
-                            if settings['lastCondition'] == "close":
-                                result['commands'].append('raiseAll')
-                                state = 'confirmRaise'
-                        
-                        db_session.updateSetting(state, 'validateShadeState')
-                        db_session.updateSetting(condition, 'lastCondition')
-                        db_session.updateSetting(calendar.timegm(nowUTC.timetuple()), 'lastChangeDate')
-                    
-                    db_session.updateSetting('true','lastInArea')
-
-            else:
-                # if the last update position was within the watch area, raise the blinds
-                if settings['lastInArea'] == 'true':
-                    if settings['lastCondition'] != "null":
-                        result['commands'].append('raiseAll')
-
-                        db_session.updateSetting('null', 'lastCondition')
-                        db_session.updateSetting('confirmRaise', 'validateShadeState')
-                
-                    db_session.updateSetting('false','lastInArea')
-
-        print(result)
-        return json.dumps(result)
-    else:
-        return ('', 204)
+# GET /sun_control for HomeKit-driven readings, POST /sun_control for buffered batches, and the
+# solar zone endpoints, all decided by SolarBlindController through the same controller cache as
+# push mode, so the reading filter, hysteresis and zone settings apply everywhere
+register_solar_blind_routes(app, db_session, solarControllers)
 
 ###############################################
 ### Controls the color of the console light ###
@@ -375,48 +361,30 @@ def adminPanel():
 
 @app.route('/getSettingVals')
 def getSettingVals():
-    db_session.cur.execute('SELECT name, value FROM settings')
-    rs = db_session.cur.fetchall()
-    
-    result = {}
-    if len(rs) > 0:
-        for r in rs:
-            result[r[0]] = int(r[1]) if r[1].isdigit() else float(r[1]) if is_float(r[1]) else r[1]
+    result = db_session.getSettings()
 
     # blatant hack to load the refresh interval to memory from the database
     ticktockJob['interval'] = int(result['ticktockInterval'])
 
     return json.dumps(result)
 
-def is_float(string):
-    try:
-        float(string)
-        return True
-    except ValueError:
-        return False
-
 @app.route('/saveSettingVals', methods=["POST"])
 def saveSettingVals():
     payload = json.loads(request.data)
 
-    for condition in payload['distinctConditions'].keys():
-        db_session.cur.execute('UPDATE distinctConditions SET blindsClosed = ? WHERE condition = ?', (payload['distinctConditions'][condition], condition))
+    distinctConditions = payload.pop('distinctConditions')
 
-    payload.pop('distinctConditions')
+    try:
+        db_session.updateSettings(payload)
+    except ValueError as e:
+        return json.dumps({'status':'Error','message':str(e)})
 
-    for setting in payload:
-        db_session.cur.execute('UPDATE settings SET value = ?, last_modified = datetime(\'now\') WHERE name = ?', (payload[setting], setting))
-        db_session.con.commit()
+    db_session.updateDistinctConditions(distinctConditions)
 
     # set the commandOverride switch status
-    thisExec = hbCliHelper.cliExecutor()
-
-    hb_auth_payload = hb_authorize(secrets['hbCreds']['host'], secrets['hbCreds']['port'], secrets['hbCreds']['username'], secrets['hbCreds']['password'],None,secrets['hbCreds']['secure'])
-    authResult = thisExec.authorize(hb_auth_payload)
-
     # TODO: Need to make the switch name configurable
-    override_sync_payload = acc_char_data("Blinds Override", ["On",str(payload['commandOverride'])], authResult['sessionId'])
-    thisExec.setaccessorychar(override_sync_payload)
+    override_sync_payload = acc_char_data("Blinds Override", ["On",str(payload['commandOverride'])])
+    hbSession.setaccessorychar(override_sync_payload)
 
     # set the interval in the current runtime
     ticktockJob['interval'] = int(payload['ticktockInterval'])
@@ -425,43 +393,94 @@ def saveSettingVals():
 
 @app.route('/getConditionHistory')
 def getConditionHistory():
-    db_session.cur.execute('SELECT condition, timestamp FROM conditionHistory ORDER BY timestamp DESC')
-    rs = db_session.cur.fetchall()
+    return condition_history_route(db_session, conditionHistoryPageSize)
+
+@app.route('/getConditionRollups')
+def getConditionRollups():
+    period = request.args.get('period', 'hour')
+    start = request.args.get('start', type=int)
+    end = request.args.get('end', type=int)
+
+    try:
+        rs = db_session.getConditionRollups(period, start, end)
+    except ValueError as e:
+        return json.dumps({'status':'Error','message':str(e)})
 
     return json.dumps(rs)
 
 @app.route('/getDistinctConditions')
 def getDistinctConditions():
-    db_session.cur.execute('SELECT condition, blindsClosed FROM distinctConditions ORDER BY condition ASC')
-    rs = db_session.cur.fetchall()
+    rs = db_session.getDistinctConditions()
 
     return json.dumps(rs)
 
 @app.route('/getTimeSinceLastCheck')
 def getTimeSinceLastCheck():
-    db_session.cur.execute('SELECT timestamp, datetime(\'now\') FROM conditionHistory ORDER BY timestamp DESC LIMIT 1')
-    rs = db_session.cur.fetchall()
+    newestTimestamp = db_session.getLastConditionTimestamp()
+
+    difference = time.time() - newestTimestamp
+
+    return json.dumps(difference)
+
+def watchAreas():
+    # zones replace the global watch area when configured, each with its own bounds and control state
+    return db_session.getZones() or [db_session.getSettings()]
+
+def sunControlNeeded():
+    # outside the watch windows there is nothing to decide, unless blinds still have to be
+    # raised on the way out or a shade command is waiting to be confirmed
+    areas = watchAreas()
 
-    newestDate = datetime.datetime.strptime(rs[0][0], '%Y-%d-%m %H:%M:%S')
-    nowDate = datetime.datetime.strptime(rs[0][1], '%Y-%d-%m %H:%M:%S')
+    for area in areas:
+        if area['lastInArea'] or area['validateShadeState'] is not None:
+            return True
 
-    difference = nowDate - newestDate
+    the_sun = sun_control_master()
+    now = datetime.datetime.now(tz=pytz.UTC)
 
-    return json.dumps(difference.total_seconds())
+    for area in areas:
+        if the_sun.sunInWindow(now, area['startAzm'], area['endAzm'], area['startAlt'], area['endAlt']):
+            return True
+
+    return False
+
+def watchTransitions(cachedOnly):
+    the_sun = sun_control_master()
+    now = datetime.datetime.now(tz=pytz.UTC)
+
+    transitions = [the_sun.nextTransition(now, area['startAzm'], area['endAzm'], area['startAlt'], area['endAlt'], cachedOnly) for area in watchAreas()]
+
+    return [transition for transition in transitions if transition is not None]
 
 def ticktock():
     print("tick")
 
-    thisExec = hbCliHelper.cliExecutor()
+    tick_set_acc_char_payload = acc_char_data("Tick", ["On","1"])
+    light_set_acc_char_payload = acc_char_data("ConsoleLightUpdate", ["On","1"])
 
-    hb_auth_payload = hb_authorize(secrets['hbCreds']['host'], secrets['hbCreds']['port'], secrets['hbCreds']['username'], secrets['hbCreds']['password'],None,secrets['hbCreds']['secure'])
-    authResult = thisExec.authorize(hb_auth_payload)
+    writes = [light_set_acc_char_payload]
 
-    tick_set_acc_char_payload = acc_char_data("Tick", ["On","1"], authResult['sessionId'])
-    light_set_acc_char_payload = acc_char_data("ConsoleLightUpdate", ["On","1"], authResult['sessionId'])
+    if sunControlNeeded():
+        if db_session.getSetting('sunControlMode') == 'push':
+            # decide in-process and drive the shades directly instead of waking the HomeKit automation;
+            # a failed cycle must not stop the console light update below
+            try:
+                solar_blind_push(db_session, solarControllers, hbSession, None, hbWriter)
+            except Exception as e:
+                print('### Push sun control failed: ' + str(e) + ' ###')
+        else:
+            writes.append(tick_set_acc_char_payload)
+
+    # the switch writes go out together rather than one after the other
+    for item in hbWriter.write(hbSession, writes):
+        if item['status'] != 'success':
+            print('### ' + item['name'] + ' switch write failed: ' + str(item.get('message', item.get('result'))) + ' ###')
 
-    thisExec.setaccessorychar(tick_set_acc_char_payload)
-    thisExec.setaccessorychar(light_set_acc_char_payload)
+    # warm the watch windows here so statusTicktock only ever reads them from the cache
+    try:
+        watchTransitions(False)
+    except Exception as e:
+        print('### Watch window prefetch failed: ' + str(e) + ' ###')
 
 @app.route('/startTicktock')
 def startTicktock():
@@ -486,7 +505,11 @@ def stopTicktock():
 
 @app.route('/statusTicktock')
 def statusTicktock():
-    result = {"status":ticktockJob['status']}
+    # reports only what the scheduler has already computed, null until the first tick has run
+    transitions = watchTransitions(True)
+    nextTransition = min(transitions) if transitions else None
+
+    result = {"status":ticktockJob['status'], "nextWatchTransition":nextTransition.isoformat() if nextTransition else None}
 
     return json.dumps(result)
 
@@ -496,6 +519,10 @@ if __name__ == "__main__":
 # Cleanup when the app terminates
 @atexit.register
 def on_terminate():
+    if hbMirror is not None:
+        hbMirror.stop()
+    hbWriter.close()
+    hbExecutor.close()
     db_session.disconnect()
     print("### Closed the DB Connection ###")
 
@@ -0,0 +1,46 @@
+"""
+Condition History Routes
+
+Thin Flask route handler for the logged weather conditions. Pages are
+addressed by row id cursors and carry an ETag, so a client polling for new
+rows gets a 304 until one is logged.
+"""
+
+import json
+from flask import request, Response
+
+
+# Largest number of rows returned by one request
+CONDITION_HISTORY_PAGE_SIZE = 500
+
+
+def condition_history_route(db_session, page_size: int = CONDITION_HISTORY_PAGE_SIZE) -> Response:
+    """
+    Page through the condition history, newest first
+
+    Args:
+        db_session: Database session holding the history
+        page_size: Largest number of rows returned, also the default limit
+
+    Returns:
+        JSON list of [condition, timestamp, id] rows, or 304 when the
+        client already holds this page
+    """
+    since = request.args.get('since', type=int)
+    before = request.args.get('before', type=int)
+    limit = max(1, min(request.args.get('limit', page_size, type=int), page_size))
+
+    # history only changes when a row is logged, so the newest row id plus the page asked for
+    # identifies the response; the cursors are normalized so equivalent requests share a tag
+    cursors = '-'.join('' if value is None else str(value) for value in (since, before, limit))
+    etag = f"history-{db_session.getLatestConditionId()}-{cursors}"
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    rs = db_session.getConditionHistory(since, before, limit)
+
+    response = Response(json.dumps(rs), mimetype='application/json')
+    response.set_etag(etag)
+
+    return response
@@ -2,48 +2,43 @@
 Solar Blind Routes
 
 Thin Flask route handler for solar blind control functionality.
-Delegates business logic to SolarBlindController.
+Delegates business logic to SolarBlindController. The same decision path is
+used by the pull endpoint and by the server-driven push mode, which reads and
+writes Homebridge directly from the scheduler.
 """
 
 import json
 import datetime
+from typing import Any, Dict, List
 import pytz
 from flask import request, jsonify, Response
 from classes.solar_blind_control import (
     SolarBlindController,
     SolarBlindConfig,
-    SolarControlRequest
+    SolarControlRequest,
+    SolarControlResult,
+    SolarZone
 )
+from classes.solar_blind_driver import HomebridgeBlindDriver, HomebridgeDriverError, write_failed
 
 
-def solar_blind_route(db_session) -> Response:
+# Largest number of readings accepted by one batch request
+MAX_BATCH_READINGS = 10000
+
+
+def config_from_settings(settings: dict, zones: list = (), close_conditions=("Clear", "Mostly Clear")) -> SolarBlindConfig:
     """
-    Control automated blinds based on sun position and weather
+    Build a SolarBlindConfig from database settings
 
     Args:
-        db_session: Database session for settings and logging
+        settings: Dictionary of settings from db_session.getSettings()
+        zones: Zone definitions from db_session.getZones()
+        close_conditions: Conditions mapped to blindsClosed, from db_session.getCloseConditions()
 
     Returns:
-        JSON response with status and blind commands
+        SolarBlindConfig for the current settings
     """
-    # Load settings from database
-    settings = db_session.getSettings()
-
-    # Parse request parameters
-    try:
-        shade_state = json.loads(request.args.get('shade_state'))
-        solar_reading = int(request.args.get('solar'))
-    except (json.JSONDecodeError, ValueError, TypeError) as e:
-        return jsonify({
-            "status": "Error",
-            "message": f"Invalid request parameters: {e}"
-        })
-
-    # Get current timestamp
-    now = datetime.datetime.now(tz=pytz.timezone('US/Pacific'))
-
-    # Create configuration from database settings
-    config = SolarBlindConfig(
+    return SolarBlindConfig(
         latitude=45.46692,  # TODO: make configurable via database
         longitude=-122.79286,  # TODO: make configurable via database
         timezone_name="US/Pacific",
@@ -57,48 +52,446 @@ def solar_blind_route(db_session) -> Response:
         lower_altitude_percent=settings.get('lowerAltPer', 0.5),
         upper_altitude_percent=settings.get('upperAltPer', 1.0),
         change_buffer_duration_sec=settings.get('changeBufferDurationSec', 1800),
-        command_override=settings.get('commandOverride', 0) == 1,
-        close_conditions=["Cloudy"]  # Could be made configurable
+        smoothing=settings.get('solarSmoothing', 'none'),
+        smoothing_alpha=settings.get('solarSmoothingAlpha', 0.3),
+        median_window=settings.get('solarMedianWindow', 5),
+        hysteresis_band=settings.get('solarHysteresis', 0.0),
+        command_override=settings.get('commandOverride', False),
+        close_conditions=sorted(close_conditions),
+        condition_history_length=settings.get('conditionHistoryLength', 5),
+        condition_max_age_sec=settings.get('conditionMaxAgeSec', 0),
+        zones=[
+            SolarZone(
+                name=zone['name'],
+                shades=zone['shades'],
+                start_azimuth=zone['startAzm'],
+                end_azimuth=zone['endAzm'],
+                start_altitude=zone['startAlt'],
+                end_altitude=zone['endAlt']
+            )
+            for zone in zones
+        ]
     )
 
-    # Create request object
+
+class ControllerCache:
+    """Long-lived SolarBlindController, rebuilt when the settings generation changes
+
+    The generation also moves when the condition mapping (distinctConditions)
+    is edited, since close_conditions is part of the config.
+    """
+
+    def __init__(self, db_session):
+        """
+        Initialize Controller Cache
+
+        Args:
+            db_session: Database session whose settingsGeneration is watched
+        """
+        self.db_session = db_session
+        self._entry = (None, None)  # (generation, controller)
+
+    def get(self) -> SolarBlindController:
+        """
+        Get a controller for the current settings
+
+        Returns:
+            SolarBlindController, reused while settings are unchanged
+        """
+        generation, controller = self._entry
+
+        if controller is None or generation != self.db_session.settingsGeneration:
+            # read the generation before building so a concurrent update forces another rebuild
+            generation = self.db_session.settingsGeneration
+            controller = SolarBlindController(config_from_settings(
+                self.db_session.getSettings(),
+                self.db_session.getZones(),
+                self.db_session.getCloseConditions()
+            ))
+            self._entry = (generation, controller)
+
+        return controller
+
+
+def run_solar_control(
+    db_session,
+    controllers: ControllerCache,
+    shade_state: dict,
+    solar_reading: float,
+    now: datetime.datetime
+) -> SolarControlResult:
+    """
+    Decide blind commands for one reading and persist the resulting state
+
+    Args:
+        db_session: Database session for settings and logging
+        controllers: Cache holding the controller built from current settings
+        shade_state: Map of shade name to position (0=closed, 100=open)
+        solar_reading: Solar sensor reading
+        now: Timestamp of the reading
+
+    Returns:
+        SolarControlResult with commands, state updates and diagnostics
+    """
+    # Load settings from database
+    settings = db_session.getSettings()
+
+    # Create request object; the logged conditions feed the same majority vote as the pull path
     control_request = SolarControlRequest(
         shade_state=shade_state,
         solar_reading=solar_reading,
-        timestamp=now
+        timestamp=now,
+        condition_history=db_session.getConditionWindow()
     )
 
-    # Create controller and execute
-    controller = SolarBlindController(config)
-    result = controller.determine_blind_command(control_request, settings)
+    # Reuse the controller unless settings changed since it was built
+    controller = controllers.get()
 
-    # Persist state updates to database
-    for key, value in result.state_updates.items():
-        if key == 'lastCondition_logged':
-            # Special case: log weather condition to history
-            db_session.logCondition(value)
-        else:
-            # Regular setting update
-            db_session.updateSetting(value, key)
+    # With zones configured every facade is decided in one pass with per-zone commands
+    if controller.config.zones:
+        zone_settings = {zone['name']: zone for zone in db_session.getZones()}
+        result = controller.determine_zone_commands(control_request, settings, zone_settings)
+    else:
+        result = controller.determine_blind_command(control_request, settings)
+
+    if result.status != "success":
+        return result
+
+    # Persist state updates and the weather condition log in one transaction
+    state_updates = dict(result.state_updates)
+    logged_condition = state_updates.pop('lastCondition_logged', None)
+    reading = {
+        'solar': solar_reading,
+        'altitude': result.sun_altitude,
+        'azimuth': result.sun_azimuth,
+        'inArea': result.diagnostics.get('in_watch_area')
+    }
+    db_session.applyStateUpdates(state_updates, logged_condition, reading, result.zone_state_updates)
 
     # Debug output (matches original behavior)
     print(result.to_dict())
 
+    return result
+
+
+def solar_blind_route(db_session, controllers: ControllerCache) -> Response:
+    """
+    Control automated blinds based on sun position and weather
+
+    Args:
+        db_session: Database session for settings and logging
+        controllers: Cache holding the controller built from current settings
+
+    Returns:
+        JSON response with status and blind commands
+    """
+    # Parse request parameters
+    try:
+        shade_state = json.loads(request.args.get('shade_state'))
+        solar_reading = int(request.args.get('solar'))
+    except (json.JSONDecodeError, ValueError, TypeError) as e:
+        return jsonify({
+            "status": "Error",
+            "message": f"Invalid request parameters: {e}"
+        })
+
+    # Get current timestamp
+    now = datetime.datetime.now(tz=pytz.timezone('US/Pacific'))
+
+    result = run_solar_control(db_session, controllers, shade_state, solar_reading, now)
+
     # Return JSON response
     return jsonify(result.to_dict())
 
 
-def register_solar_blind_routes(app, db_session):
+def parse_batch_readings(payload: Any) -> List[Dict[str, Any]]:
+    """
+    Validate and normalize the readings of a batch request
+
+    Args:
+        payload: Decoded JSON body, {"readings": [{"timestamp", "solar", "shade_state"}, ...]}.
+            Timestamps are epoch seconds or ISO 8601 strings (naive values are UTC).
+
+    Returns:
+        List of readings with the timestamp as an aware datetime
+
+    Raises:
+        ValueError: If the payload is malformed or out of order
+    """
+    if not isinstance(payload, dict) or not isinstance(payload.get('readings'), list):
+        raise ValueError("body must be an object with a readings list")
+
+    readings = payload['readings']
+    if len(readings) > MAX_BATCH_READINGS:
+        raise ValueError(f"at most {MAX_BATCH_READINGS} readings per request")
+
+    parsed = []
+    for index, item in enumerate(readings):
+        try:
+            timestamp = item['timestamp']
+            if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+                timestamp = datetime.datetime.fromtimestamp(timestamp, tz=pytz.UTC)
+            else:
+                timestamp = datetime.datetime.fromisoformat(str(timestamp))
+                if timestamp.tzinfo is None:
+                    timestamp = timestamp.replace(tzinfo=pytz.UTC)
+
+            solar_reading = item['solar']
+            if not isinstance(solar_reading, (int, float)) or isinstance(solar_reading, bool):
+                raise ValueError("solar must be numeric")
+
+            shade_state = item['shade_state']
+            if not isinstance(shade_state, dict):
+                raise ValueError("shade_state must be an object")
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"reading {index}: {e}")
+
+        if parsed and timestamp < parsed[-1]['timestamp']:
+            raise ValueError(f"reading {index}: readings must be in timestamp order")
+
+        parsed.append({'timestamp': timestamp, 'solar': solar_reading, 'shade_state': shade_state})
+
+    return parsed
+
+
+def run_solar_control_batch(
+    db_session,
+    controllers: ControllerCache,
+    readings: List[Dict[str, Any]]
+) -> List[SolarControlResult]:
+    """
+    Evaluate an ordered series of readings and persist the outcome once
+
+    Each reading is decided against the state left by the previous one, held
+    in memory. Only the final state and one condition-log row per reading are
+    written, in a single transaction. Nothing is written if any step fails.
+    Sun positions come from the vectorized batch engine in one call, so a
+    replay spanning past days does not build per-day ephemeris tables or push
+    today's out of the live cache.
+
+    Args:
+        db_session: Database session for settings and logging
+        controllers: Cache holding the controller built from current settings
+        readings: Readings from parse_batch_readings
+
+    Returns:
+        One SolarControlResult per reading; on failure the list ends with the
+        failing step's error result
+    """
+    settings = db_session.getSettings()
+    zone_settings = {zone['name']: zone for zone in db_session.getZones()}
+    controller = controllers.get()
+    condition_history = db_session.getConditionWindow()
+    altitudes, azimuths = controller.calculate_sun_positions([reading['timestamp'] for reading in readings])
+
+    results = []
+    final_updates: Dict[str, Any] = {}
+    final_zone_updates: Dict[str, Dict[str, Any]] = {}
+    condition_log = []
+
+    for reading, altitude, azimuth in zip(readings, altitudes.tolist(), azimuths.tolist()):
+        control_request = SolarControlRequest(
+            shade_state=reading['shade_state'],
+            solar_reading=reading['solar'],
+            timestamp=reading['timestamp'],
+            condition_history=list(condition_history),
+            sun_position=(altitude, azimuth)
+        )
+
+        if controller.config.zones:
+            result = controller.determine_zone_commands(control_request, settings, zone_settings)
+        else:
+            result = controller.determine_blind_command(control_request, settings)
+
+        results.append(result)
+        if result.status != "success":
+            return results
+
+        # thread the state to the next step in memory
+        state_updates = dict(result.state_updates)
+        logged_condition = state_updates.pop('lastCondition_logged', None)
+
+        settings.update(state_updates)
+        final_updates.update(state_updates)
+
+        for zone_name, zone_updates in result.zone_state_updates.items():
+            zone_settings[zone_name].update(zone_updates)
+            final_zone_updates.setdefault(zone_name, {}).update(zone_updates)
+
+        if logged_condition is not None:
+            condition_history.append((logged_condition, reading['timestamp'].timestamp()))
+            del condition_history[:-controller.config.condition_history_length]
+
+            condition_log.append((logged_condition, {
+                'solar': reading['solar'],
+                'altitude': result.sun_altitude,
+                'azimuth': result.sun_azimuth,
+                'inArea': result.diagnostics.get('in_watch_area')
+            }, reading['timestamp'].timestamp()))
+
+    db_session.applyBatchStateUpdates(final_updates, condition_log, final_zone_updates)
+
+    return results
+
+
+def solar_blind_batch_route(db_session, controllers: ControllerCache) -> Response:
+    """
+    Evaluate a batch of buffered readings in order
+
+    Args:
+        db_session: Database session for settings and logging
+        controllers: Cache holding the controller built from current settings
+
+    Returns:
+        JSON response with one result per reading
+    """
+    try:
+        readings = parse_batch_readings(json.loads(request.data))
+    except (json.JSONDecodeError, ValueError) as e:
+        return jsonify({
+            "status": "Error",
+            "message": f"Invalid request body: {e}"
+        })
+
+    results = run_solar_control_batch(db_session, controllers, readings)
+
+    steps = []
+    for reading, result in zip(readings, results):
+        step = result.to_dict()
+        step["timestamp"] = reading['timestamp'].isoformat()
+        steps.append(step)
+
+    if results and results[-1].status != "success":
+        return jsonify({
+            "status": "Error",
+            "message": f"Reading {len(results) - 1} failed: {results[-1].message}",
+            "results": steps
+        })
+
+    return jsonify({
+        "status": "success",
+        "processed": len(results),
+        "results": steps
+    })
+
+
+def solar_blind_push(db_session, controllers: ControllerCache, executor, session_id: str, writer=None) -> SolarControlResult:
+    """
+    Run one server-driven control cycle against Homebridge
+
+    Reads the solar sensor and shade positions through the accessory
+    characteristic calls, decides with the shared controller, and writes the
+    resulting shade targets back without a HomeKit automation in between.
+    A failed shade write is logged; the confirmRaise/confirmClose check on the
+    following cycles sees the shade out of position and sends the command again.
+
+    Args:
+        db_session: Database session for settings and logging
+        controllers: Cache holding the controller built from current settings
+        executor: hbCliHelper cliExecutor, or an hb_session_manager that
+            supplies its own session id
+        session_id: Authorized Homebridge session id (None with a session manager)
+        writer: Optional hb_batch_writer so all shade targets are sent concurrently
+
+    Returns:
+        SolarControlResult for the cycle
+    """
+    settings = db_session.getSettings()
+    controller = controllers.get()
+    driver = HomebridgeBlindDriver(executor, session_id, writer)
+
+    # zones name their own shades, otherwise every configured shade follows the global commands
+    if controller.config.zones:
+        shade_names = list(dict.fromkeys(name for zone in controller.config.zones for name in zone.shades))
+    else:
+        shade_names = settings['shadeAccessories']
+
+    # deciding without any shade to move would persist commands that never happen
+    if not shade_names:
+        result = SolarControlResult(status="Error", message="Push mode has no shades to drive: set shadeAccessories or save solar zones")
+        print(result.to_dict())
+        return result
+
+    try:
+        solar_reading = driver.read_solar(settings['solarSensorAccessory'], settings['solarSensorCharacteristic'])
+        shade_state = driver.read_shade_state(shade_names)
+    except HomebridgeDriverError as e:
+        result = SolarControlResult(status="Error", message=f"Homebridge read failed: {e}")
+        print(result.to_dict())
+        return result
+
+    now = datetime.datetime.now(tz=pytz.timezone('US/Pacific'))
+    result = run_solar_control(db_session, controllers, shade_state, solar_reading, now)
+
+    if result.status == "success":
+        targets = driver.targets_for(result, shade_names)
+
+        for (name, target), response in zip(targets, driver.write_targets(targets)):
+            if write_failed(response):
+                print(f"### Shade {name} was not moved to {target}: {response} ###")
+
+    return result
+
+
+def solar_zones_route(db_session) -> Response:
+    """
+    List the configured solar zones with their persisted state
+
+    Args:
+        db_session: Database session holding the zones
+
+    Returns:
+        JSON response with the zone definitions
+    """
+    return jsonify(db_session.getZones())
+
+
+def save_solar_zones_route(db_session) -> Response:
+    """
+    Replace the solar zone definitions
+
+    Args:
+        db_session: Database session holding the zones
+
+    Returns:
+        JSON response with the save status
+    """
+    try:
+        db_session.saveZones(json.loads(request.data))
+    except (json.JSONDecodeError, ValueError, AttributeError) as e:
+        return jsonify({
+            "status": "Error",
+            "message": f"Invalid zones: {e}"
+        })
+
+    return jsonify({"status": "success"})
+
+
+def register_solar_blind_routes(app, db_session, controllers: ControllerCache = None):
     """
     Register solar blind routes with Flask app
 
     Args:
         app: Flask application instance
         db_session: Database session for settings and logging
+        controllers: Controller cache to share with push mode, or None for a new one
     """
-    @app.route('/sun_control', methods=['GET'])
+    if controllers is None:
+        controllers = ControllerCache(db_session)
+
+    @app.route('/sun_control', methods=['GET', 'POST'])
     def sun_control():
         if request.method == 'GET':
-            return solar_blind_route(db_session)
+            return solar_blind_route(db_session, controllers)
+        elif request.method == 'POST':
+            return solar_blind_batch_route(db_session, controllers)
         else:
             return ('', 204)
+
+    @app.route('/getSolarZones', methods=['GET'])
+    def get_solar_zones():
+        return solar_zones_route(db_session)
+
+    @app.route('/saveSolarZones', methods=['POST'])
+    def save_solar_zones():
+        return save_solar_zones_route(db_session)
@@ -33,12 +33,21 @@ function loadSettings() {
         document.getElementsByName('luxThresh')[0].value = response['luxThresh'];
         document.getElementsByName('solarThresh')[0].value = response['solarThresh'];
         document.getElementsByName('conditionHistoryLength')[0].value = response['conditionHistoryLength'];
+        document.getElementsByName('conditionMaxAgeSec')[0].value = response['conditionMaxAgeSec'];
         document.getElementsByName('changeBufferDurationSec')[0].value = response['changeBufferDurationSec'];
         document.getElementsByName('upperAlt')[0].value = response['upperAlt'];
         document.getElementsByName('lowerAlt')[0].value = response['lowerAlt'];
         document.getElementsByName('upperAltPer')[0].value = response['upperAltPer'];
         document.getElementsByName('lowerAltPer')[0].value = response['lowerAltPer'];
         document.getElementsByName('ticktockInterval')[0].value = response['ticktockInterval'];
+        document.getElementsByName('sunControlMode')[0].value = response['sunControlMode'];
+        document.getElementsByName('solarSensorAccessory')[0].value = response['solarSensorAccessory'];
+        document.getElementsByName('solarSensorCharacteristic')[0].value = response['solarSensorCharacteristic'];
+        document.getElementsByName('shadeAccessories')[0].value = response['shadeAccessories'].join(', ');
+        document.getElementsByName('solarSmoothing')[0].value = response['solarSmoothing'];
+        document.getElementsByName('solarSmoothingAlpha')[0].value = response['solarSmoothingAlpha'];
+        document.getElementsByName('solarMedianWindow')[0].value = response['solarMedianWindow'];
+        document.getElementsByName('solarHysteresis')[0].value = response['solarHysteresis'];
 
         document.getElementById('lastAzm').innerHTML = response['lastAzm'];
         document.getElementById('lastAlt').innerHTML = response['lastAlt'];
@@ -46,26 +55,50 @@ function loadSettings() {
         document.getElementById('validateShadeState').innerHTML = response['validateShadeState'];
         document.getElementById('lastInArea').innerHTML = response['lastInArea'];
         document.getElementById('lastChangeDate').innerHTML = new Date(response['lastChangeDate'] * 1000);
+        document.getElementById('lastWeatherCondition').innerHTML = response['lastWeatherCondition'];
+        document.getElementById('smoothedSolar').innerHTML = response['solarSmoothing'] == 'median' ? response['recentSolar'].join(', ') : response['smoothedSolar'];
         
         if (response['commandOverride'] == 1) document.getElementById('override').checked = true;
     });
 }
 
+let lastHistoryId = 0;
+
+// polling only ever adds rows, so drop the oldest once the table holds this many
+const maxHistoryRows = 500;
+
 function loadHistory() {
     makeHttpRequest("GET", condition_history_url, (response) => {
-        let table = document.getElementById("historyTable");
-
-        for (let row in response) {
-            let newRow = table.insertRow(-1);
-            let conditionCell = newRow.insertCell(0);
-            let timestampCell = newRow.insertCell(1);
+        addHistoryRows(response);
 
-            conditionCell.innerHTML = response[row][0];
-            timestampCell.innerHTML = response[row][1];
-        }
+        // after the first load only ask for rows newer than the ones already shown
+        setInterval(loadNewHistory, 30000);
     });
 }
 
+function loadNewHistory() {
+    makeHttpRequest("GET", condition_history_url + "?since=" + lastHistoryId, addHistoryRows);
+}
+
+function addHistoryRows(response) {
+    let table = document.getElementById("historyTable");
+
+    for (let row = 0; row < response.length; row++) {
+        let newRow = table.insertRow(row);
+        let conditionCell = newRow.insertCell(0);
+        let timestampCell = newRow.insertCell(1);
+
+        conditionCell.innerHTML = response[row][0];
+        timestampCell.innerHTML = response[row][1];
+
+        lastHistoryId = Math.max(lastHistoryId, response[row][2]);
+    }
+
+    while (table.rows.length > maxHistoryRows) {
+        table.deleteRow(-1);
+    }
+}
+
 function loadConditions() {
     makeHttpRequest("GET", distinct_conditions_url, (response) => {
         let closeBlindsSelect = document.getElementById("closeBlindsCon");
@@ -115,6 +148,7 @@ function saveSettings() {
     let startAlt = document.getElementsByName('startAlt')[0].value;
     let endAlt = document.getElementsByName('endAlt')[0].value;
     let conditionHistoryLength = document.getElementsByName('conditionHistoryLength')[0].value;
+    let conditionMaxAgeSec = document.getElementsByName('conditionMaxAgeSec')[0].value;
     let luxThresh = document.getElementsByName('luxThresh')[0].value;
     let solarThresh = document.getElementsByName('solarThresh')[0].value;
     let changeBufferDurationSec = document.getElementsByName('changeBufferDurationSec')[0].value;
@@ -123,6 +157,14 @@ function saveSettings() {
     let upperAltPer = document.getElementsByName('upperAltPer')[0].value;
     let lowerAltPer = document.getElementsByName('lowerAltPer')[0].value;
     let ticktockInterval = document.getElementsByName('ticktockInterval')[0].value;
+    let sunControlMode = document.getElementsByName('sunControlMode')[0].value;
+    let solarSensorAccessory = document.getElementsByName('solarSensorAccessory')[0].value;
+    let solarSensorCharacteristic = document.getElementsByName('solarSensorCharacteristic')[0].value;
+    let shadeAccessories = document.getElementsByName('shadeAccessories')[0].value;
+    let solarSmoothing = document.getElementsByName('solarSmoothing')[0].value;
+    let solarSmoothingAlpha = document.getElementsByName('solarSmoothingAlpha')[0].value;
+    let solarMedianWindow = document.getElementsByName('solarMedianWindow')[0].value;
+    let solarHysteresis = document.getElementsByName('solarHysteresis')[0].value;
     let commandOverride = document.getElementById('override').checked == true ? 1 : 0;
 
     let payload = {
@@ -131,6 +173,7 @@ function saveSettings() {
         "startAlt":startAlt,
         "endAlt":endAlt,
         "conditionHistoryLength":conditionHistoryLength,
+        "conditionMaxAgeSec":conditionMaxAgeSec,
         "commandOverride":commandOverride,
         "luxThresh":luxThresh,
         "solarThresh":solarThresh,
@@ -140,6 +183,14 @@ function saveSettings() {
         "upperAltPer":upperAltPer,
         "lowerAltPer":lowerAltPer,
         "ticktockInterval":ticktockInterval,
+        "sunControlMode":sunControlMode,
+        "solarSensorAccessory":solarSensorAccessory,
+        "solarSensorCharacteristic":solarSensorCharacteristic,
+        "shadeAccessories":shadeAccessories,
+        "solarSmoothing":solarSmoothing,
+        "solarSmoothingAlpha":solarSmoothingAlpha,
+        "solarMedianWindow":solarMedianWindow,
+        "solarHysteresis":solarHysteresis,
         "distinctConditions":{}
     };
     
@@ -0,0 +1,67 @@
+import json
+from flask import Flask
+from classes.db_connect import db_connect
+from routes.condition_history_routes import condition_history_route
+
+
+def make_client(db_session, page_size=3):
+    app = Flask(__name__)
+    app.add_url_rule('/getConditionHistory', 'history', lambda: condition_history_route(db_session, page_size))
+    return app.test_client()
+
+
+def make_session(path, conditions):
+    db_session = db_connect(str(path))
+    db_session.updateSetting(100, 'conditionHistoryLength')
+    for condition in conditions:
+        db_session.logCondition(condition)
+    return db_session
+
+
+def rows(response):
+    return json.loads(response.get_data())
+
+
+def test_cursors_page_newest_first(tmp_path):
+    # the fresh database starts with one 'Clear' row, so these get ids 2 to 8
+    db_session = make_session(tmp_path / 'history.db', ['A', 'B', 'C', 'D', 'E', 'F', 'G'])
+    client = make_client(db_session)
+
+    first = rows(client.get('/getConditionHistory'))
+    assert [r[0] for r in first] == ['G', 'F', 'E']
+
+    second = rows(client.get('/getConditionHistory', query_string={'before': first[-1][2]}))
+    assert [r[0] for r in second] == ['D', 'C', 'B']
+
+    newer = rows(client.get('/getConditionHistory', query_string={'since': second[0][2]}))
+    assert [r[0] for r in newer] == ['G', 'F', 'E']
+
+
+def test_limit_is_clamped_to_the_page_size(tmp_path):
+    db_session = make_session(tmp_path / 'limit.db', ['A', 'B', 'C', 'D', 'E'])
+    client = make_client(db_session)
+
+    assert len(rows(client.get('/getConditionHistory', query_string={'limit': 100}))) == 3
+    assert len(rows(client.get('/getConditionHistory', query_string={'limit': 0}))) == 1
+    assert len(rows(client.get('/getConditionHistory', query_string={'limit': -1}))) == 1
+
+
+def test_etag_answers_304_only_for_the_same_page(tmp_path):
+    db_session = make_session(tmp_path / 'etag.db', ['A', 'B', 'C', 'D', 'E'])
+    client = make_client(db_session)
+
+    first = client.get('/getConditionHistory')
+    etag = first.headers['ETag']
+
+    assert client.get('/getConditionHistory', headers={'If-None-Match': etag}).status_code == 304
+
+    # another page never matches the first page's tag
+    other = client.get('/getConditionHistory', query_string={'before': 3}, headers={'If-None-Match': etag})
+    assert other.status_code == 200
+    assert other.headers['ETag'] != etag
+
+    # a new row changes every page's tag
+    db_session.logCondition('F')
+    refreshed = client.get('/getConditionHistory', headers={'If-None-Match': etag})
+    assert refreshed.status_code == 200
+    assert rows(refreshed)[0][0] == 'F'
@@ -0,0 +1,303 @@
+import sqlite3
+
+import pytest
+
+from classes.db_connect import db_connect
+
+@pytest.fixture
+def db(tmp_path):
+    db = db_connect(str(tmp_path / 'persist.db'), writeBehind=True, flushIntervalMs=20)
+    yield db
+    db._stopWriter()
+
+def test_writer_survives_a_failed_batch(db):
+    writeBatch = db._writeBatch
+    calls = []
+
+    def failOnce(batch):
+        calls.append(batch)
+        if len(calls) == 1:
+            raise KeyError('bad item')
+
+        writeBatch(batch)
+
+    db._writeBatch = failOnce
+
+    db.logCondition('Clear', {'solar':1})
+    db.flush()
+    assert db._writer.is_alive()
+
+    db.logCondition('Cloudy', {'solar':1})
+    db.flush()
+    assert len(calls) == 2
+    assert db.getConditionWindow()[-1][0] == 'Cloudy'
+
+def test_flush_fails_fast_without_a_writer(db):
+    db._stopWriter()
+    db._writeQueue.put(('condition', 'Clear', {}, 0, False))
+
+    with pytest.raises(sqlite3.OperationalError):
+        db.flush()
+
+def test_caches_follow_writes_from_another_process(tmp_path):
+    # two sessions on one file stand in for two gunicorn workers
+    path = str(tmp_path / 'shared.db')
+    first = db_connect(path, sharedCacheCheckMs=0)
+    second = db_connect(path, sharedCacheCheckMs=0)
+
+    generation = second.settingsGeneration
+    first.updateSetting('push', 'sunControlMode')
+    first.updateDistinctConditions({'Clear':0})
+    first.logCondition('Rain')
+
+    assert second.getSetting('sunControlMode') == 'push'
+    assert 'Clear' not in second.getCloseConditions()
+    assert second.getConditionWindow()[-1][0] == 'Rain'
+    assert second.settingsGeneration > generation
+
+    # a session's own writes do not count as foreign changes
+    generation = first.settingsGeneration
+    first.logCondition('Clear')
+    assert first.settingsGeneration == generation
+
+def test_batch_lands_after_queued_writes(db):
+    db.logCondition('Rain', {'solar':1})
+    db.applyBatchStateUpdates({'lastCondition':'open'}, [('Clear', {'solar':2}, 100)])
+
+    rows = db._query('SELECT condition FROM conditionHistory ORDER BY id DESC LIMIT 2')
+    assert [r[0] for r in rows] == ['Clear', 'Rain']
+    assert db._writeQueue.unfinished_tasks == 0
+
+def test_failed_batch_leaves_caches_alone(db):
+    historyRows = db.historyRows
+    window = db.getConditionWindow()
+
+    def fail(cur, condition, reading, timestamp, newCondition):
+        raise KeyError('bad reading')
+
+    db._logCondition = fail
+
+    with pytest.raises(KeyError):
+        db.applyBatchStateUpdates({'lastCondition':'close'}, [('Clear', {}, 100)])
+
+    assert db.historyRows == historyRows
+    assert db.getConditionWindow() == window
+    assert db.getSetting('lastCondition') is None
+
+def test_shared_cache_check_is_opt_in_and_rate_limited(tmp_path):
+    path = str(tmp_path / 'shared.db')
+    writer = db_connect(path)
+    single = db_connect(path)
+    limited = db_connect(path, sharedCacheCheckMs=60000)
+
+    # the first limited read spends its check, so the write below is not seen until the next one
+    limited.getSettings()
+    writer.updateSetting('push', 'sunControlMode')
+
+    single._readCacheGeneration = limited._readCacheGeneration = None
+    assert single.getSetting('sunControlMode') == 'pull'
+    assert limited.getSetting('sunControlMode') == 'pull'
+
+def test_int_settings_reject_fractions(db):
+    db.updateSetting('7.0', 'conditionHistoryLength')
+    assert db.getSetting('conditionHistoryLength') == 7
+
+    for value in ['5.7', 5.7, True]:
+        with pytest.raises(ValueError):
+            db.updateSetting(value, 'conditionHistoryLength')
+
+    assert db.getSetting('conditionHistoryLength') == 7
+
+def test_invalid_stored_value_loads_as_default(tmp_path):
+    path = str(tmp_path / 'persist.db')
+
+    with db_connect(path)._transaction() as cur:
+        cur.execute("UPDATE settings SET value = '5.7' WHERE name = 'conditionHistoryLength'")
+
+    assert db_connect(path).getSetting('conditionHistoryLength') == 5
+
+def windowCounts(db):
+    closed = db.getCloseConditions()
+    counts = {0:0, 1:0}
+    for condition, timestamp in db.getConditionWindow():
+        counts[1 if condition in closed else 0] += 1
+
+    return counts
+
+def test_condition_window_keeps_the_newest_rows_and_their_counts(tmp_path):
+    db = db_connect(str(tmp_path / 'persist.db'))
+
+    # the fresh database starts with one 'Clear' row, a close condition by default
+    for condition in ['Rain', 'Rain', 'Clear', 'Rain', 'Snow', 'Rain']:
+        db.logCondition(condition)
+
+    assert [c for c, t in db.getConditionWindow()] == ['Rain', 'Clear', 'Rain', 'Snow', 'Rain']
+    assert db.conditionTypeCounts == windowCounts(db) == {0:4, 1:1}
+    assert db.topConditionFromHistory() == 'Rain'
+    assert db.topConditionTypeFromHistory() == 'open'
+
+    # remapping a condition recounts the window without reloading it
+    db.updateDistinctConditions({'Rain':1})
+    assert db.conditionTypeCounts == windowCounts(db) == {0:1, 1:4}
+    assert db.topConditionTypeFromHistory() == 'close'
+
+def test_resizing_the_condition_window_reloads_from_history(tmp_path):
+    db = db_connect(str(tmp_path / 'persist.db'))
+
+    for condition in ['Rain', 'Rain', 'Rain', 'Snow', 'Snow', 'Snow']:
+        db.logCondition(condition)
+
+    db.updateSetting(3, 'conditionHistoryLength')
+    assert [c for c, t in db.getConditionWindow()] == ['Snow', 'Snow', 'Snow']
+    assert db.conditionTypeCounts == {0:3, 1:0}
+
+    # growing needs rows that already left the ring
+    db.updateSetting(6, 'conditionHistoryLength')
+    assert [c for c, t in db.getConditionWindow()] == ['Rain', 'Rain', 'Rain', 'Snow', 'Snow', 'Snow']
+    assert db.conditionTypeCounts == windowCounts(db) == {0:6, 1:0}
+
+    # a new session builds the same window from the table
+    assert db_connect(db.dbPath).getConditionWindow() == db.getConditionWindow()
+
+def makeBaselineDb(path):
+    # the schema and values the untyped settings store wrote before schemaVersion existed
+    con = sqlite3.connect(path)
+    con.execute('CREATE TABLE settings (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, value TEXT, last_modified TEXT)')
+    con.execute('CREATE TABLE conditionHistory (id INTEGER PRIMARY KEY AUTOINCREMENT, condition TEXT, timestamp TEXT)')
+    con.execute('CREATE TABLE distinctConditions (id INTEGER PRIMARY KEY AUTOINCREMENT, condition TEXT, blindsClosed INTEGER)')
+
+    settings = [('lastCondition', 'null'), ('startAzm', '100'), ('startAzm', '120'), ('lastInArea', 'false'),
+        ('lastAlt', 'null'), ('commandOverride', '0'), ('conditionHistoryLength', '3'), ('lowerAltPer', '0.5')]
+    con.executemany('INSERT INTO settings (name, value, last_modified) VALUES (?, ?, datetime(\'now\'))', settings)
+
+    con.executemany('INSERT INTO distinctConditions (condition, blindsClosed) VALUES (?, ?)', [('Clear', 1), ('Rain', 0), ('Rain', 1)])
+    con.executemany('INSERT INTO conditionHistory (condition, timestamp) VALUES (?, ?)',
+        [('Clear', '2024-06-01 12:00:00'), ('Rain', '2024-06-01 12:05:00'), ('Rain', '2024-06-01 12:10:00')])
+    con.commit()
+    con.close()
+
+def test_baseline_database_migrates_to_the_current_schema(tmp_path):
+    path = str(tmp_path / 'persist.db')
+    makeBaselineDb(path)
+
+    db = db_connect(path)
+
+    assert [r[0] for r in db._query('SELECT version FROM schemaVersion ORDER BY version')] == [1, 2, 3, 4, 5, 6]
+
+    # duplicates keep the newest row, and every stored value decodes to its declared type
+    assert db.getSetting('startAzm') == 120.0
+    assert db.getSetting('lastCondition') is None
+    assert db.getSetting('lastInArea') is False
+    assert db.getSetting('commandOverride') is False
+    assert db.getSetting('conditionHistoryLength') == 3
+    assert db.getSetting('sunControlMode') == 'pull'
+    assert dict(db.getDistinctConditions()) == {'Clear':1, 'Rain':1}
+    assert db._query('SELECT type FROM settings WHERE name = ?', ('startAzm',))[0][0] == 'float'
+
+    # text timestamps become epoch seconds
+    assert db.getConditionWindow() == [('Clear', 1717243200), ('Rain', 1717243500), ('Rain', 1717243800)]
+    assert db.getZones() == []
+
+    # a reopened database runs no migration twice
+    applied = db._query('SELECT version, applied_at FROM schemaVersion')
+    reopened = db_connect(path)
+    assert reopened._query('SELECT version, applied_at FROM schemaVersion') == applied
+    assert reopened.getSetting('startAzm') == 120.0
+
+def test_settings_are_stored_and_read_as_their_type(tmp_path):
+    db = db_connect(str(tmp_path / 'persist.db'))
+
+    db.updateSettings({'lastInArea':'true', 'lastAlt':'12.5', 'lastCondition':'close', 'luxThresh':'2500',
+        'shadeAccessories':'Office Shade, Den Shade', 'recentSolar':[1, '2.5']})
+
+    expected = {'lastInArea':True, 'lastAlt':12.5, 'lastCondition':'close', 'luxThresh':2500,
+        'shadeAccessories':['Office Shade', 'Den Shade'], 'recentSolar':[1.0, 2.5]}
+
+    for session in [db, db_connect(db.dbPath)]:
+        settings = session.getSettings()
+        assert {name:settings[name] for name in expected} == expected
+
+    # 'null' and empty strings clear nullable settings
+    db.updateSettings({'lastAlt':'', 'lastCondition':'null'})
+    assert db.getSetting('lastAlt') is None
+    assert db.getSetting('lastCondition') is None
+
+    stored = dict(db._query('SELECT name, value FROM settings WHERE name IN (?, ?)', ('lastInArea', 'lastAlt')))
+    assert stored == {'lastInArea':'true', 'lastAlt':'null'}
+
+@pytest.mark.parametrize('settings', [
+    {'lastInArea':'maybe'},
+    {'startAzm':'north'},
+    {'startAzm':400},
+    {'lastCondition':'half'},
+    {'sunControlMode':'auto'},
+    {'solarThresh':0},
+    {'recentSolar':'[1, "x"]'},
+    {'noSuchSetting':1}
+])
+def test_invalid_settings_are_rejected_without_a_partial_write(tmp_path, settings):
+    db = db_connect(str(tmp_path / 'persist.db'))
+    before = db.getSettings()
+
+    # a valid value in the same update is not written either
+    with pytest.raises(ValueError) as e:
+        db.updateSettings(dict(settings, luxThresh=100))
+
+    assert next(iter(settings)) in str(e.value)
+    assert db.getSettings() == before
+    assert db_connect(db.dbPath).getSettings() == before
+
+def test_archive_keeps_hourly_and_daily_rollups(tmp_path):
+    db = db_connect(str(tmp_path / 'persist.db'))
+    db.updateSetting(1, 'conditionHistoryLength')
+    day = 1717200000  # 2024-06-01 00:00 UTC
+
+    log = [
+        ('Clear', {'solar':10, 'inArea':True}, day + 60),
+        ('Clear', {'solar':30, 'inArea':False}, day + 120),
+        ('Rain', {'inArea':True}, day + 600),
+        ('Rain', {'solar':5, 'inArea':False}, day + 3600 + 60),
+        ('Clear', {'solar':50, 'inArea':True}, day + 86400 + 60)
+    ]
+    db.applyBatchStateUpdates({}, log)
+
+    hours = db.getConditionRollups('hour', day, day + 86400)
+    assert [h['bucket'] for h in hours] == [day, day + 3600]
+    assert hours[0] == {'bucket':day, 'samples':3, 'solarMin':10, 'solarMean':20, 'solarMax':30,
+        'inAreaShare':2 / 3, 'conditions':{'Clear':2, 'Rain':1}}
+    assert hours[1]['conditions'] == {'Rain':1}
+    assert hours[1]['solarMean'] == 5
+
+    days = db.getConditionRollups('day')
+    assert [(d['bucket'], d['samples'], d['solarMin'], d['solarMax']) for d in days] == [(day, 4, 5, 30), (day + 86400, 1, 50, 50)]
+    assert days[0]['solarMean'] == 15
+    assert days[0]['inAreaShare'] == 0.5
+
+    # the archive outlives the pruned history window
+    assert db._query('SELECT COUNT(*) FROM conditionHistory')[0][0] < 5
+    assert db._query('SELECT COUNT(*) FROM conditionArchive')[0][0] == 5
+    assert [r[1] for r in db.getArchivedReadings(day, day + 86400)] == [10, 30, 5]
+
+    with pytest.raises(ValueError):
+        db.getConditionRollups('week')
+
+def test_saved_zones_keep_their_state_by_name(tmp_path):
+    db = db_connect(str(tmp_path / 'persist.db'))
+    west = {'name':'West', 'shades':['Office Shade'], 'startAzm':180, 'endAzm':300, 'startAlt':10, 'endAlt':10}
+    south = {'name':'South', 'shades':['Den Shade'], 'startAzm':90, 'endAzm':270, 'startAlt':15, 'endAlt':15}
+
+    db.saveZones([west, south])
+    db.applyStateUpdates({}, zoneStateUpdates={'West':{'lastCondition':'close', 'lastInArea':True}})
+
+    # resaving with new bounds keeps West's state, and a dropped zone is gone for good
+    db.saveZones([dict(west, startAzm='200')])
+    db.saveZones([dict(west, startAzm='200'), south])
+
+    zones = {zone['name']:zone for zone in db_connect(db.dbPath).getZones()}
+    assert zones['West']['startAzm'] == 200.0
+    assert (zones['West']['lastCondition'], zones['West']['lastInArea']) == ('close', True)
+    assert (zones['South']['lastCondition'], zones['South']['lastInArea']) == (None, False)
+
+    # state for an unknown zone is dropped rather than failing the decision
+    db.applyStateUpdates({}, zoneStateUpdates={'East':{'lastCondition':'open'}})
+    assert [zone['name'] for zone in db.getZones()] == ['West', 'South']
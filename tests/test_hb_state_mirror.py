@@ -0,0 +1,160 @@
+import threading
+import time
+from urllib.parse import parse_qs
+
+import pytest
+
+socketio = pytest.importorskip('socketio')
+pytest.importorskip('websocket')
+pytest.importorskip('simple_websocket')
+
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+from classes.hbapi_control import acc_char_data, hb_authorize, hb_http_executor, hb_session_manager, hb_state_mirror
+
+NAMESPACE = '/accessories'
+
+class FakeHomebridgeUI:
+    # stand-in for the Homebridge UI: REST login, token check and accessory reads, plus the
+    # accessories socket that sends a snapshot on request and pushes changes afterwards
+    def __init__(self):
+        self.state = {'Shade':{'CurrentPosition':100}, 'Solar Sensor':{'CurrentAmbientLightLevel':42.0}}
+        self.token = 'tok1'
+        self.logins = 0
+        self.accessoryGets = 0
+        self.connectTokens = []
+
+        self.sio = socketio.Server(async_mode='threading')
+        app = Flask('fake-homebridge')
+        app.wsgi_app = socketio.WSGIApp(self.sio, app.wsgi_app)
+
+        @app.post('/api/auth/login')
+        def login():
+            self.logins += 1
+            return jsonify(access_token=self.token, expires_in=28800)
+
+        @app.get('/api/auth/check')
+        def check():
+            if request.headers.get('Authorization') != 'Bearer ' + self.token:
+                return jsonify(message='Unauthorized'), 401
+
+            return jsonify(status='OK')
+
+        @app.get('/api/accessories')
+        def accessories():
+            return jsonify([self.service(name) for name in self.state])
+
+        @app.get('/api/accessories/<uniqueId>')
+        def accessory(uniqueId):
+            self.accessoryGets += 1
+            return jsonify(self.service(uniqueId[2:]))
+
+        @self.sio.on('connect', namespace=NAMESPACE)
+        def connect(sid, environ, auth=None):
+            token = parse_qs(environ.get('QUERY_STRING', '')).get('token', [None])[0]
+            self.connectTokens.append(token)
+
+            return token == self.token
+
+        @self.sio.on('get-accessories', namespace=NAMESPACE)
+        def snapshot(sid):
+            self.sio.emit('accessories-data', [self.service(name) for name in self.state], namespace=NAMESPACE, to=sid)
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.port = self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def service(self, name):
+        values = self.state[name]
+
+        return {'serviceName':name, 'uniqueId':'u-' + name, 'values':dict(values),
+            'serviceCharacteristics':[{'type':charType, 'value':value} for charType, value in values.items()]}
+
+    def push(self, name, charType, value):
+        self.state[name][charType] = value
+        self.sio.emit('accessories-data', self.service(name), namespace=NAMESPACE)
+
+    def disconnectAll(self):
+        for sid in list(self.sio.manager.get_participants(NAMESPACE, None)):
+            self.sio.disconnect(sid[0], namespace=NAMESPACE)
+
+    def close(self):
+        self.server.shutdown()
+
+def wait_for(check, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if check():
+            return True
+
+        time.sleep(0.05)
+
+    return False
+
+@pytest.fixture
+def homebridge():
+    server = FakeHomebridgeUI()
+    yield server
+    server.close()
+
+@pytest.fixture
+def mirror(homebridge):
+    executor = hb_http_executor('127.0.0.1', homebridge.port)
+    session = hb_session_manager(executor, hb_authorize('127.0.0.1', homebridge.port, 'user', 'pass'))
+
+    mirror = hb_state_mirror(session, maxAgeSec=1, reconnectSec=0.2, connectTimeoutSec=2)
+    assert mirror.start()
+    session.mirror = mirror
+
+    assert wait_for(lambda: mirror.status()['connected'] and mirror.status()['accessories'] == 2)
+    yield mirror
+    mirror.stop()
+
+def read(mirror, name, charType):
+    return mirror.session.accessorycharvalues(acc_char_data(name, [charType]))
+
+def test_snapshot_answers_reads_without_rest_calls(homebridge, mirror):
+    for _ in range(20):
+        result = read(mirror, 'Solar Sensor', 'CurrentAmbientLightLevel')
+
+    # the same accessory object a REST read returns
+    assert result == homebridge.service('Solar Sensor')
+    assert homebridge.accessoryGets == 0
+
+def test_incremental_update_replaces_value(homebridge, mirror):
+    homebridge.push('Shade', 'CurrentPosition', 0)
+
+    assert wait_for(lambda: read(mirror, 'Shade', 'CurrentPosition')['values'] == {'CurrentPosition':0})
+    assert homebridge.accessoryGets == 0
+
+def test_disconnect_serves_until_max_age_then_falls_back(homebridge, mirror):
+    # keep the mirror from reconnecting so only the age limit decides
+    mirror._stopping.set()
+    homebridge.disconnectAll()
+    assert wait_for(lambda: not mirror.status()['connected'])
+
+    assert mirror.lookup('Shade', ['CurrentPosition']) is not None
+
+    time.sleep(mirror.maxAgeSec + 0.2)
+    assert mirror.lookup('Shade', ['CurrentPosition']) is None
+
+    result = read(mirror, 'Shade', 'CurrentPosition')
+    assert result == homebridge.service('Shade')
+    assert homebridge.accessoryGets == 1
+
+def test_rejected_token_logs_in_again_before_reconnecting(homebridge, mirror):
+    homebridge.token = 'tok2'
+    homebridge.disconnectAll()
+
+    assert wait_for(lambda: mirror.status()['connected'] and homebridge.connectTokens[-1] == 'tok2')
+    assert homebridge.logins == 2
+    assert 'tok1' in homebridge.connectTokens[1:]
+
+def test_check_session_only_accepts_current_token(homebridge, mirror):
+    executor = mirror.session.executor
+
+    assert executor.checkSession('tok1')
+    assert not executor.checkSession('forged')
+    assert not executor.checkSession(None)
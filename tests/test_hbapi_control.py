@@ -0,0 +1,250 @@
+import base64
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+from classes.hbapi_control import acc_char_data, hb_authorize, hb_batch_writer, hb_http_executor, hb_session_manager
+
+def makeToken(name, expiresAt):
+    payload = base64.urlsafe_b64encode(json.dumps({'sub':name, 'exp':expiresAt}).encode()).decode().rstrip('=')
+
+    return 'header.' + payload + '.signature'
+
+def httpError(status):
+    response = requests.Response()
+    response.status_code = status
+
+    return requests.HTTPError(str(status), response=response)
+
+class FakeExecutor:
+    # logs in with numbered tokens and rejects any token listed in rejected
+    def __init__(self, lifetimeSec=28800):
+        self.lifetimeSec = lifetimeSec
+        self.logins = 0
+        self.calls = []
+        self.rejected = set()
+        self.raiseOnReject = False
+
+    def authorize(self, authPayload):
+        self.logins += 1
+
+        return {'sessionId':makeToken('tok' + str(self.logins), time.time() + self.lifetimeSec), 'expires_in':self.lifetimeSec}
+
+    def setaccessorychar(self, payload):
+        self.calls.append(payload.sessionId)
+
+        if payload.sessionId in self.rejected:
+            if self.raiseOnReject:
+                raise httpError(401)
+
+            return {'statusCode':401, 'message':'Unauthorized'}
+
+        return {'statusCode':200}
+
+def write(session):
+    return session.setaccessorychar(acc_char_data('Tick', ['On', '1']))
+
+def test_session_is_reused_until_shortly_before_expiry():
+    executor = FakeExecutor()
+    session = hb_session_manager(executor, hb_authorize())
+
+    for _ in range(5):
+        assert write(session) == {'statusCode':200}
+
+    assert executor.logins == 1
+    assert len(set(executor.calls)) == 1
+
+    # a token inside the refresh margin is replaced before it is sent
+    executor.lifetimeSec = 30
+    session.invalidate()
+    write(session)
+    write(session)
+
+    assert executor.logins == 3
+
+@pytest.mark.parametrize('raiseOnReject', [False, True])
+def test_rejected_session_logs_in_again_and_retries_once(raiseOnReject):
+    executor = FakeExecutor()
+    executor.raiseOnReject = raiseOnReject
+    session = hb_session_manager(executor, hb_authorize())
+
+    first = session.sessionId()
+    executor.rejected.add(first)
+
+    assert write(session) == {'statusCode':200}
+    assert executor.logins == 2
+    assert executor.calls == [first, session.sessionId()]
+
+def test_retry_happens_only_once():
+    executor = FakeExecutor()
+    session = hb_session_manager(executor, hb_authorize())
+
+    # every token is refused, so the second answer goes back to the caller
+    executor.setaccessorychar = lambda payload: (executor.calls.append(payload.sessionId), {'statusCode':401})[1]
+
+    assert write(session) == {'statusCode':401}
+    assert len(executor.calls) == 2
+    assert executor.logins == 2
+
+def test_concurrent_callers_share_one_login():
+    executor = FakeExecutor()
+    authorize = executor.authorize
+
+    def slowAuthorize(authPayload):
+        time.sleep(0.05)
+        return authorize(authPayload)
+
+    executor.authorize = slowAuthorize
+    session = hb_session_manager(executor, hb_authorize())
+
+    threads = [threading.Thread(target=write, args=(session,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert executor.logins == 1
+    assert len(executor.calls) == 8
+
+class FakeBridge:
+    # answers hb_http_executor requests from a dict of accessories, counting full listings
+    def __init__(self):
+        self.accessories = {'Shade':'u-1', 'Tick':'u-2'}
+        self.listings = 0
+        self.requests = []
+
+    def request(self, method, path, sessionId=None, body=None):
+        self.requests.append((method, path))
+
+        if path == '/api/accessories':
+            self.listings += 1
+            return [{'serviceName':name, 'uniqueId':uniqueId, 'serviceCharacteristics':[{'type':'On'}, {'type':'CurrentPosition'}]}
+                for name, uniqueId in self.accessories.items()]
+
+        uniqueId = path.rsplit('/', 1)[1]
+        if uniqueId not in self.accessories.values():
+            raise httpError(404)
+
+        return {'uniqueId':uniqueId, 'values':{'On':1}}
+
+@pytest.fixture
+def bridge():
+    return FakeBridge()
+
+def makeExecutor(bridge, **kwargs):
+    executor = hb_http_executor('127.0.0.1', 1, **kwargs)
+    executor._request = bridge.request
+
+    return executor
+
+def read(executor, name, charType='On'):
+    return executor.accessorycharvalues(acc_char_data(name, [charType], 'tok'))
+
+def test_index_is_built_once_and_rebuilt_after_its_ttl(bridge):
+    executor = makeExecutor(bridge, indexTtlSec=300)
+
+    for _ in range(5):
+        assert read(executor, 'Shade')['uniqueId'] == 'u-1'
+
+    # one listing, then a single request per call
+    assert bridge.listings == 1
+    assert len(bridge.requests) == 6
+    assert executor.indexStatus()['accessories'] == 2
+
+    executor._indexBuiltAt -= 300
+    read(executor, 'Shade')
+    assert bridge.listings == 2
+
+    executor.invalidateIndex()
+    read(executor, 'Shade')
+    assert bridge.listings == 3
+
+def test_a_miss_rebuilds_the_index_at_most_every_miss_interval(bridge):
+    executor = makeExecutor(bridge, missRefreshSec=10)
+    read(executor, 'Shade')
+
+    # a new accessory is found once the miss interval has passed
+    bridge.accessories['Lamp'] = 'u-3'
+    assert read(executor, 'Lamp')['statusCode'] == 404
+    assert bridge.listings == 1
+
+    executor._indexBuiltAt -= 10
+    assert read(executor, 'Lamp')['uniqueId'] == 'u-3'
+    assert bridge.listings == 2
+
+    # a name that keeps missing does not rebuild on every call
+    for _ in range(3):
+        assert read(executor, 'Nowhere')['statusCode'] == 404
+
+    assert bridge.listings == 2
+
+def test_unknown_characteristic_is_answered_from_the_index(bridge):
+    executor = makeExecutor(bridge)
+    result = executor.setaccessorychar(acc_char_data('Shade', ['Brightness', 50], 'tok'))
+
+    assert result['statusCode'] == 400
+    assert ('PUT', '/api/accessories/u-1') not in bridge.requests
+
+def test_stale_unique_id_is_retried_once_on_a_fresh_index(bridge):
+    executor = makeExecutor(bridge)
+    read(executor, 'Shade')
+
+    # the bridge restarted and the accessory got a new uniqueId
+    bridge.accessories['Shade'] = 'u-9'
+    assert read(executor, 'Shade')['uniqueId'] == 'u-9'
+    assert bridge.listings == 2
+
+class SlowWriter:
+    # each write takes delaySec; names decide the outcome
+    def __init__(self, delaySec=0.1):
+        self.delaySec = delaySec
+
+    def setaccessorychar(self, payload):
+        time.sleep(self.delaySec)
+
+        if payload.name == 'Broken':
+            raise requests.ConnectionError('connection reset')
+
+        if payload.name == 'Missing':
+            return {'statusCode':404, 'message':'accessory Missing not found'}
+
+        return {'statusCode':200}
+
+@pytest.fixture
+def writer():
+    writer = hb_batch_writer(maxWorkers=4)
+    yield writer
+    writer.close()
+
+def test_batch_reports_each_write_in_order(writer):
+    names = ['Shade', 'Broken', 'Tick', 'Missing']
+    results = writer.write(SlowWriter(0), [acc_char_data(name, ['On', '1'], 'tok') for name in names])
+
+    assert [(r['name'], r['status']) for r in results] == [('Shade', 'success'), ('Broken', 'Error'), ('Tick', 'success'), ('Missing', 'Error')]
+    assert results[1]['message'] == 'connection reset'
+    assert results[3]['result']['statusCode'] == 404
+    assert all(r['type'] == 'On' and r['value'] == '1' and r['elapsedMs'] >= 0 for r in results)
+
+def test_batch_writes_run_concurrently(writer):
+    payloads = [acc_char_data('Light ' + str(i), ['On', '1'], 'tok') for i in range(4)]
+
+    started = time.perf_counter()
+    results = writer.write(SlowWriter(0.2), payloads)
+    elapsed = time.perf_counter() - started
+
+    assert all(r['status'] == 'success' for r in results)
+    assert elapsed < 0.6
+
+def test_batch_through_a_session_manager_logs_in_once(writer):
+    executor = FakeExecutor()
+    session = hb_session_manager(executor, hb_authorize())
+
+    results = writer.write(session, [acc_char_data('Light ' + str(i), ['On', '1']) for i in range(8)])
+
+    assert all(r['status'] == 'success' for r in results)
+    assert executor.logins == 1
+    assert len(set(executor.calls)) == 1
+
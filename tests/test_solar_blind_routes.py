@@ -0,0 +1,219 @@
+import json
+import requests
+from flask import Flask
+from classes.db_connect import db_connect
+from classes.solar_ephemeris import get_ephemeris
+from routes.solar_blind_routes import ControllerCache, solar_blind_route, solar_blind_push, register_solar_blind_routes, \
+    parse_batch_readings, run_solar_control_batch
+
+
+SHADES = ['Office Shade', 'Den Shade']
+
+# watch area covering the whole sky, so every reading is decided whatever the time of day
+SETTINGS = {
+    'startAzm': 0,
+    'endAzm': 360,
+    'startAlt': -90,
+    'endAlt': -90,
+    'changeBufferDurationSec': 0,
+    'solarThresh': 20,
+    'shadeAccessories': SHADES
+}
+
+READINGS = [5, 5, 5, 50, 50, 50, 50, 5, 50, 5, 5, 5, 5]
+
+
+class FakeHomebridge:
+    """Answers characteristic reads from fixed values and records shade writes"""
+
+    def __init__(self):
+        self.solar = None
+        self.positions = {name: 100 for name in SHADES}
+        self.writes = []
+
+    def accessorycharvalues(self, payload):
+        char_type = payload.charSet[0]
+        if payload.name == 'Solar Sensor':
+            return {'name': payload.name, 'values': {char_type: self.solar}}
+
+        return {'name': payload.name, 'values': {char_type: self.positions[payload.name]}}
+
+    def setaccessorychar(self, payload):
+        self.writes.append((payload.name, payload.charSet[1]))
+        return {'statusCode': 200}
+
+
+class FailingHomebridge(FakeHomebridge):
+    def accessorycharvalues(self, payload):
+        raise requests.ConnectionError('connection refused')
+
+
+def make_session(path):
+    db_session = db_connect(str(path))
+    db_session.updateSettings(SETTINGS)
+    return db_session
+
+
+def state_of(db_session):
+    settings = db_session.getSettings()
+    return {key: settings[key] for key in ('lastCondition', 'validateShadeState', 'lastInArea', 'lastWeatherCondition')}
+
+
+def test_pull_and_push_reach_the_same_decisions(tmp_path):
+    pull_session = make_session(tmp_path / 'pull.db')
+    push_session = make_session(tmp_path / 'push.db')
+    pull_controllers = ControllerCache(pull_session)
+    push_controllers = ControllerCache(push_session)
+
+    app = Flask(__name__)
+    app.add_url_rule('/sun_control', 'sun_control', lambda: solar_blind_route(pull_session, pull_controllers))
+    client = app.test_client()
+
+    homebridge = FakeHomebridge()
+    shade_state = {name: 100 for name in SHADES}
+
+    for solar in READINGS:
+        pulled = client.get('/sun_control', query_string={'shade_state': json.dumps(shade_state), 'solar': solar}).get_json()
+
+        homebridge.solar = solar
+        homebridge.positions = dict(shade_state)
+        pushed = solar_blind_push(push_session, push_controllers, homebridge, 'session')
+
+        assert pulled['status'] == pushed.status == 'success'
+        assert pulled['commands'] == pushed.commands
+        assert state_of(pull_session) == state_of(push_session)
+
+        # both modes leave the shades where the commands put them
+        for command in pulled['commands']:
+            shade_state = {name: 0 if command == 'closeAll' else 100 for name in SHADES}
+
+    # the mapping in distinctConditions decides: clear sky closes the blinds
+    assert ('Office Shade', '0') in homebridge.writes
+
+
+def test_remapped_conditions_rebuild_the_controller(tmp_path):
+    db_session = make_session(tmp_path / 'remap.db')
+    controllers = ControllerCache(db_session)
+
+    assert 'Clear' in controllers.get().config.close_conditions
+
+    db_session.updateDistinctConditions({'Clear': 0})
+
+    assert 'Clear' not in controllers.get().config.close_conditions
+
+
+def test_push_reports_transport_errors_without_persisting(tmp_path):
+    db_session = make_session(tmp_path / 'failing.db')
+    before = state_of(db_session)
+
+    result = solar_blind_push(db_session, ControllerCache(db_session), FailingHomebridge(), 'session')
+
+    assert result.status == 'Error'
+    assert 'connection refused' in result.message
+    assert state_of(db_session) == before
+
+
+def test_push_without_shades_is_an_error(tmp_path):
+    db_session = make_session(tmp_path / 'empty.db')
+    db_session.updateSetting([], 'shadeAccessories')
+
+    result = solar_blind_push(db_session, ControllerCache(db_session), FakeHomebridge(), 'session')
+
+    assert result.status == 'Error'
+    assert 'shadeAccessories' in result.message
+
+
+def test_old_conditions_vote_unless_a_max_age_is_set(tmp_path):
+    db_session = make_session(tmp_path / 'age.db')
+    controllers = ControllerCache(db_session)
+    now = 1780000000
+    overnight = [('Clear', now - 36000)] * 5
+
+    # by default the whole window votes, however old
+    assert controllers.get()._blind_condition('Cloudy', overnight, now) == 'close'
+
+    db_session.updateSetting(900, 'conditionMaxAgeSec')
+    assert controllers.get()._blind_condition('Cloudy', overnight, now) == 'open'
+    assert controllers.get()._blind_condition('Cloudy', [('Clear', now - 60)] * 5, now) == 'close'
+
+
+def test_registered_routes_share_the_push_controllers(tmp_path):
+    db_session = make_session(tmp_path / 'registered.db')
+    controllers = ControllerCache(db_session)
+
+    app = Flask(__name__)
+    register_solar_blind_routes(app, db_session, controllers)
+    client = app.test_client()
+
+    pulled = client.get('/sun_control', query_string={'shade_state': json.dumps({name: 100 for name in SHADES}), 'solar': 50}).get_json()
+    assert pulled['status'] == 'success'
+
+    # the route built the controller the push mode reuses
+    assert controllers._entry[1] is not None
+    assert client.get('/getSolarZones').get_json() == []
+
+
+def test_batch_replay_leaves_the_live_ephemeris_alone(tmp_path):
+    db_session = make_session(tmp_path / 'replay.db')
+    controllers = ControllerCache(db_session)
+    config = controllers.get().config
+    ephemeris = get_ephemeris(config.latitude, config.longitude)
+    cached = ephemeris.cached_days()
+
+    # one reading a day for two weeks, well past the day cache size
+    start = 1700000000
+    payload = {'readings': [{'timestamp': start + day * 86400, 'solar': solar, 'shade_state': {name: 100 for name in SHADES}}
+        for day, solar in enumerate(READINGS)]}
+    results = run_solar_control_batch(db_session, controllers, parse_batch_readings(payload))
+
+    assert [r.status for r in results] == ['success'] * len(READINGS)
+    assert ephemeris.cached_days() == cached
+
+
+def test_zones_get_their_own_commands_and_state(tmp_path):
+    db_session = make_session(tmp_path / 'zones.db')
+    controllers = ControllerCache(db_session)
+
+    app = Flask(__name__)
+    register_solar_blind_routes(app, db_session, controllers)
+    client = app.test_client()
+
+    # one zone sees the whole sky, the other never does
+    zones = [
+        {'name': 'West', 'shades': ['Office Shade'], 'startAzm': 0, 'endAzm': 360, 'startAlt': -90, 'endAlt': -90},
+        {'name': 'North', 'shades': ['Den Shade'], 'startAzm': 0, 'endAzm': 0, 'startAlt': -90, 'endAlt': -90}
+    ]
+    assert client.post('/saveSolarZones', data=json.dumps(zones)).get_json() == {'status': 'success'}
+
+    pulled = client.get('/sun_control', query_string={'shade_state': json.dumps({name: 100 for name in SHADES}), 'solar': 50}).get_json()
+
+    assert pulled['commands'] == []
+    assert pulled['zones'] == [
+        {'zone': 'West', 'shades': ['Office Shade'], 'commands': ['closeAll']},
+        {'zone': 'North', 'shades': ['Den Shade'], 'commands': []}
+    ]
+
+    saved = {zone['name']: zone for zone in client.get('/getSolarZones').get_json()}
+    assert (saved['West']['lastCondition'], saved['West']['lastInArea']) == ('close', True)
+    assert (saved['North']['lastCondition'], saved['North']['lastInArea']) == (None, False)
+
+    # push mode drives only the shades of the zone that closed
+    homebridge = FakeHomebridge()
+    homebridge.solar = 50
+    assert solar_blind_push(db_session, controllers, homebridge, 'session').status == 'success'
+    assert homebridge.writes == [('Office Shade', '0')]
+
+
+def test_invalid_zones_are_rejected(tmp_path):
+    db_session = make_session(tmp_path / 'bad_zones.db')
+
+    app = Flask(__name__)
+    register_solar_blind_routes(app, db_session)
+    client = app.test_client()
+
+    zone = {'name': 'West', 'shades': ['Office Shade'], 'startAzm': 0, 'endAzm': 360, 'startAlt': -90, 'endAlt': -90}
+    for zones in [{'name': 'West'}, [dict(zone, startAzm=400)], [dict(zone, shades='Office Shade')], [zone, zone], 'not json']:
+        response = client.post('/saveSolarZones', data=zones if isinstance(zones, str) else json.dumps(zones)).get_json()
+        assert response['status'] == 'Error'
+
+    assert db_session.getZones() == []
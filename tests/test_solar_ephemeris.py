@@ -0,0 +1,22 @@
+import datetime
+
+from classes.solar_ephemeris import SolarEphemeris, WatchAreaBounds
+
+BOUNDS = WatchAreaBounds(90, 270, 10, 10)
+
+def test_cached_only_transition_never_computes_tables():
+    ephemeris = SolarEphemeris(45.46692, -122.79286, use_batch_engine=True)
+    now = datetime.datetime(2024, 6, 21, 12, tzinfo=datetime.timezone.utc)
+
+    assert ephemeris.next_transition(now, BOUNDS, cached_only=True) is None
+    assert ephemeris.cached_days() == []
+
+    warmed = ephemeris.next_transition(now, BOUNDS)
+    assert warmed is not None
+    assert ephemeris.next_transition(now, BOUNDS, cached_only=True) == warmed
+
+    # a day past the cached ones is not computed either
+    later = now + datetime.timedelta(days=1)
+    cached = ephemeris.cached_days()
+    assert ephemeris.next_transition(later, BOUNDS, cached_only=True) is None
+    assert ephemeris.cached_days() == cached